@@ -1,9 +1,15 @@
 #! usr/bin/python3
 import os
 import sys
+if __name__ == "__main__":
+    #The command line lives in QKD_api.py.  It imports this module, and with it
+    #NetSquid, only for a des run, so --help and the other engines start
+    #without NetSquid; nothing below runs in the script itself
+    from QKD_api import main
+    main()
+    sys.exit()
 import netsquid as ns
-from optparse import OptionParser
-from random import randint
+import random
 from netsquid.components.qchannel import QuantumChannel
 from netsquid.components import QuantumMemory
 from netsquid.qubits import StateSampler
@@ -20,24 +26,18 @@ from netsquid.nodes.connections import Connection
 from netsquid.components import ClassicalChannel
 from netsquid.components.models import FibreDelayModel
 from netsquid.protocols import Protocol
-
-def printToFile(filename, line, length):
-    with open(f'{filename}{length}.txt', 'a') as f:
-            f.write(line+'\n')
-
-def addParserOptions():
-    parser = OptionParser()
-    parser.add_option("-l", "--length",
-                      dest = "length", type = "int", help="Set length of secret key", default = 4)
-    parser.add_option("-n", "--quantumNoise", default = 1e7,
-                      dest = "quantumNoise", type = "int", help = "rate of depolar and dephase errors")
-    parser.add_option("-f", "--sourceFrequency", default = 2e7,
-                      dest = "sourceFrequency", type = "int", help = "rate of entanglement pairs")
-    parser.add_option("-t", "--delay", default = 1e9,
-                      dest = "setDelay", type = "int", help = "based on fraction of source frequency")
-    parser.add_option("-d", "--distance", default = 1,
-                      dest = "nodeDistance", type = "float", help = "Distance between nodes")
-    return parser.parse_args()
+from netsquid.components.component import Message
+from QKD_formalism import setFormalism, makeNoiseModel
+from QKD_fidelity import FidelityTracker
+from QKD_simstats import simEventCount
+from QKD_seeding import runStreams
+from QKD_results import ResultWriter, runParams
+from QKD_qber import QBEREstimator
+from QKD_profile import NULL_PROFILER
+from QKD_distill import runFastQKD, qberEstimator, postProcess, recordResults
+from QKD_keystore import PackedBits, GrowingArray
+from QKD_ENT_fast import linkTiming
+from QKD_api import DEFAULTS
 
 class ClassicalConnectionA2B(Connection):
         def __init__(self, length):
@@ -47,10 +47,13 @@ class ClassicalConnectionA2B(Connection):
             self.subcomponents["Channel_A2B"].ports['recv'].forward_output(self.ports['B'])
 
 class EntanglingConnection(Connection):
-        def __init__(self, length, source_frequency, depolarRate, set_delay):
+        def __init__(self, length, source_frequency, depolarRate, set_delay, formalism="DM"):
                 super().__init__(name="EntanglingConnection")
-                noise_model = DepolarNoiseModel(depolar_rate=depolarRate)
+                noise_model = makeNoiseModel(depolarRate, formalism)
                 timing_model = FixedDelayModel(delay=(set_delay / source_frequency))
+                #Kept for retuning a reused network
+                self.noise_model = noise_model
+                self.timing_model = timing_model
                 qsource = QSource("qsource", StateSampler([ks.b00], [1.0]), num_ports=2,timing_model=timing_model,status=SourceStatus.INTERNAL)
                 self.add_subcomponent(qsource)
                 qchannel_c2a = QuantumChannel("qchannel_C2A", length=length / 2,models={"delay_model": FibreDelayModel(),"noise_model": noise_model})
@@ -62,15 +65,17 @@ class EntanglingConnection(Connection):
                 qsource.ports["qout0"].connect(qchannel_c2a.ports["send"])
                 qsource.ports["qout1"].connect(qchannel_c2b.ports["send"])
 
-def example_network_setup(node_distance, depolar_rate, source_frequency, delay):
+def example_network_setup(node_distance, depolar_rate, source_frequency, delay, window=0, formalism="DM"):
     # Setup nodes Alice and Bob with quantum memories:
-    noise_model = DepolarNoiseModel(depolar_rate=depolar_rate)
+    noise_model = makeNoiseModel(depolar_rate, formalism)
     alice = Node("Alice", port_names=['qin_charlie', 'cout_bob','cin_bob'],qmemory=QuantumMemory("AliceMemory", num_positions=2,memory_noise_models=[noise_model] * 2))
     #alice = Node("Alice", port_names=['qin_charlie', 'cout_bob','cin_bob'],qmemory=QuantumMemory("AliceMemory", num_positions=2))
     alice.ports['qin_charlie'].forward_input(alice.qmemory.ports['qin1'])
-    bob = Node("Bob", port_names=['qin_charlie', 'cin_alice','cout_alice'], qmemory=QuantumMemory("BobMemory", num_positions=1, memory_noise_models=[noise_model]))
+    bob = Node("Bob", port_names=['qin_charlie', 'cin_alice','cout_alice'], qmemory=QuantumMemory("BobMemory", num_positions=max(window, 1), memory_noise_models=[noise_model] * max(window, 1)))
     #bob = Node("Bob", port_names=['qin_charlie', 'cin_alice','cout_alice'], qmemory=QuantumMemory("BobMemory", num_positions=1))
-    bob.ports['qin_charlie'].forward_input(bob.qmemory.ports['qin0']) 
+    #The pipelined protocol stores the incoming halves in rotating positions itself
+    if window == 0:
+        bob.ports['qin_charlie'].forward_input(bob.qmemory.ports['qin0'])
     # Setup classical connection between nodes:
     c_conn1 = ClassicalConnectionA2B(length=node_distance)
     c_conn2 = ClassicalConnectionA2B(length=node_distance)
@@ -79,7 +84,7 @@ def example_network_setup(node_distance, depolar_rate, source_frequency, delay):
     alice.ports['cin_bob'].connect(c_conn2.ports['B'])
     bob.ports['cout_alice'].connect(c_conn2.ports['A'])
     #Setup entangling connection between nodes:
-    q_conn = EntanglingConnection(length=node_distance, source_frequency=source_frequency, depolarRate=depolar_rate, set_delay=delay)
+    q_conn = EntanglingConnection(length=node_distance, source_frequency=source_frequency, depolarRate=depolar_rate, set_delay=delay, formalism=formalism)
     alice.ports['qin_charlie'].connect(q_conn.ports['A'])
     bob.ports['qin_charlie'].connect(q_conn.ports['B'])
     return alice, bob, q_conn
@@ -97,15 +102,22 @@ def Compare_measurement(num_bits,stateList,opList):
     return matchList
 
 class AliceProtocol(NodeProtocol):
-    def __init__(self, node,length):
+    def __init__(self, node,length,fidelity=None,rng=None,qber=None,profiler=None):
         super().__init__(node)
+        self.rng=random if rng is None else rng
+        self.qber=QBEREstimator() if qber is None else qber
+        self.profiler=NULL_PROFILER if profiler is None else profiler
+        #Called once the key is complete; QKD_star.py replaces it to keep the
+        #other pairs of a shared simulation running
+        self.onDone=ns.sim_stop
        # self.stateList, self.qlist=Create_random_qubits(1)
         self.matchList=[]
         self.length=length
         self.ent_swap=False
+        self.fidelity=FidelityTracker() if fidelity is None else fidelity
 
     def randomState(self, mem_pos):
-        state=randint(0,3)
+        state=self.rng.randint(0,3)
         #Random operation
         if   state == 0: # 0 state
             pass
@@ -115,6 +127,7 @@ class AliceProtocol(NodeProtocol):
             self.node.qmemory.operate(ns.H,mem_pos)
         elif state == 3: # - state    #XH
             self.node.qmemory.operate(ns.X,mem_pos)
+            self.node.qmemory.operate(ns.H,mem_pos)
         else :
             print("Create random bits ERROR!!")
         return state
@@ -125,77 +138,94 @@ class AliceProtocol(NodeProtocol):
     def getSentTimes(self):
         return self.qubitSendTimes
 
+    def getSimTime(self):
+        return self.simTime
+
     def run(self):
-        self.key_A=[]
-        self.qubitSendTimes=[]
+        self.key_A=PackedBits(self.length)
+        self.qubitSendTimes=GrowingArray(2*self.length)
         self.qubitCounter=0
+        self.simTime=None
         mem_pos = self.node.qmemory.unused_positions[0]
         while True:
                 self.matchFlag=False
                 if self.qubitCounter<self.length:
-                    #Creates new qubit to be teleported
-                    qubit=create_qubits(1,system_name="Q")
-                    #Places in node memory
-                    self.node.qmemory.put(qubit,mem_pos)
-                    state=self.randomState(mem_pos)
+                    with self.profiler.phase("alice.prepare"):
+                        #Creates new qubit to be teleported
+                        qubit=create_qubits(1,system_name="Q")
+                        #Places in node memory
+                        self.node.qmemory.put(qubit,mem_pos)
+                        state=self.randomState(mem_pos)
+                        self.fidelity.prepared(len(self.qubitSendTimes), state)
                     #print("ALICE: Waiting for Entanglement")
                     #Waits for entanglement
                     yield self.await_port_input(self.node.ports["qin_charlie"])
                     #Completes Entanglement and does Bell Measurement
-                    self.qubitSendTimes.append(ns.sim_time())
-                    self.node.qmemory.operate(ns.CNOT, [0, 1])
-                    self.node.qmemory.operate(ns.H,0)
-                    m, _ = self.node.qmemory.measure([0, 1])
+                    with self.profiler.phase("alice.bell"):
+                        self.qubitSendTimes.append(ns.sim_time())
+                        self.node.qmemory.operate(ns.CNOT, [0, 1])
+                        self.node.qmemory.operate(ns.H,0)
+                        m, _ = self.node.qmemory.measure([0, 1])
                     #Sends measurement to Bob for correction
-                    self.node.ports["cout_bob"].tx_output(m)
+                    with self.profiler.phase("alice.classical"):
+                        self.node.ports["cout_bob"].tx_output(m)
                     #print("ALICE: QUBIT ENTANGLED")
                     #print("ALICE: WAITING FOR BOB QUBIT STATELIST")
                     yield self.await_port_input(self.node.ports["cin_bob"])
                     #print("ALICE: RECEIVED BOB QUBIT STATELIST")
-                    meas_results = self.node.ports["cin_bob"].rx_input().items
-                    #Strips buffer from list if one is present
-                    if meas_results.count("")>0:
-                        meas_results.remove("")
-                    statelist=[state]
-                    #Compares bits
-                    self.matchList=Compare_measurement(1,statelist,meas_results)
-                    #Confirms match is found
-                    if 0 in self.matchList or 1 in self.matchList:
-                        self.matchFlag=True
-                        self.node.ports["cout_bob"].tx_output(self.matchFlag)
-                    else:
-                        #print("ERROR")
-                        self.node.ports["cout_bob"].tx_output(self.matchFlag)
-                    #print("ALICE: SENT MATCH LIST")
-                    if self.matchFlag:
-                        #print("ALICE: MATCH FOUND")
-                        self.key_A.append(state%2) #quantum state 0,+:0    1,-:1
-                        self.qubitCounter+=1
+                    with self.profiler.phase("alice.classical"):
+                        meas_results = self.node.ports["cin_bob"].rx_input().items
+                        #Strips buffer from list if one is present
+                        if meas_results.count("")>0:
+                            meas_results.remove("")
+                        statelist=[state]
+                        #Compares bits
+                        self.matchList=Compare_measurement(1,statelist,meas_results)
+                        #Confirms match is found
+                        if 0 in self.matchList or 1 in self.matchList:
+                            self.matchFlag=True
+                            self.node.ports["cout_bob"].tx_output(self.matchFlag)
+                        else:
+                            #print("ERROR")
+                            self.node.ports["cout_bob"].tx_output(self.matchFlag)
+                        #print("ALICE: SENT MATCH LIST")
+                        if self.matchFlag:
+                            #print("ALICE: MATCH FOUND")
+                            self.key_A.append(state%2) #quantum state 0,+:0    1,-:1
+                            self.qber.alice(self.qubitCounter, state%2)
+                            self.qubitCounter+=1
                     #print("ALICE:WAITING FOR BOB TO FINISH PROCESS")
                     yield self.await_port_input(self.node.ports["cin_bob"])
                     yield_forNextEnt = self.node.ports["cin_bob"].rx_input().items 
                     #print(f"ALICE: Key Length={self.qubitCounter}")
                 else:
-                    printToFile('Sim_time',f"{ns.sim_time():.1f}",self.length)
+                    self.simTime=ns.sim_time()
                     break
-        printToFile(f'Secretkeys',f"Key at Alice: {self.key_A}", self.length)
         #print("END OF ALICE PROTOCOL")
-        ns.sim_stop()
+        self.onDone()
 
             
         
 class BobProtocol(NodeProtocol):
-    def __init__(self,node,length):
+    def __init__(self,node,length,writer=None,fidelity=None,rng=None,qber=None,profiler=None):
         super().__init__(node)
+        self.rng=random if rng is None else rng
+        self.qber=QBEREstimator() if qber is None else qber
+        self.profiler=NULL_PROFILER if profiler is None else profiler
+        #Called once the key is complete; QKD_star.py replaces it to keep the
+        #other pairs of a shared simulation running
+        self.onDone=ns.sim_stop
         self.length=length
+        self.writer=ResultWriter() if writer is None else writer
+        self.fidelity=FidelityTracker() if fidelity is None else fidelity
         self.qubitCounter=0
         self.stateList=[]
         self.result=[]
         self.B_basis=[]
-        self.key_B=[]
+        self.key_B=PackedBits(self.length)
         self.tempQubit=create_qubits(1,system_name="Q")
         self.entanglements = 0
-        self.qubitRecTimes=[]
+        self.qubitRecTimes=GrowingArray(2*self.length)
 
     def getKey(self):
         return self.key_B
@@ -216,24 +246,28 @@ class BobProtocol(NodeProtocol):
                 self.entanglements += 1
                 #Waiting for Alice Bell Measurements for Corrections
                 yield(self.await_port_input(self.node.ports["cin_alice"]))
-                meas_results = self.node.ports["cin_alice"].rx_input().items
-                #Correction of teleported qubit
-                if meas_results[0]:
-                    self.node.qmemory.operate(ns.Z, 0)
-                if meas_results[1]:
-                    self.node.qmemory.operate(ns.X, 0)
-                self.qubitRecTimes.append(ns.sim_time())
+                with self.profiler.phase("bob.correct"):
+                    meas_results = self.node.ports["cin_alice"].rx_input().items
+                    #Correction of teleported qubit
+                    if meas_results[0]:
+                        self.node.qmemory.operate(ns.Z, 0)
+                    if meas_results[1]:
+                        self.node.qmemory.operate(ns.X, 0)
+                    self.qubitRecTimes.append(ns.sim_time())
                 #print("BOB:QUBIT ENTANGLED")
                 #Redording Fidelity strength
-                fidelity = ns.qubits.fidelity(self.node.qmemory.peek(0)[0],ns.y0, squared=True)
-                printToFile('Fielity',f"{ns.sim_time():.1f}: Bob received entangled qubit and corrections! Fidelity = {fidelity:.3f}", self.length)
-                r=randint(0,1)
-                #Completeing random measure of qubit
-                if r == 0:
-                    self.result=self.node.qmemory.measure(observable=Z)
-                elif r==1:
-                    self.result=self.node.qmemory.measure(observable=X)
-                self.B_basis=r
+                with self.profiler.phase("bob.fidelity"):
+                    fidelity = self.fidelity.measure(self.entanglements-1, self.node.qmemory.peek(0)[0])
+                    if fidelity is not None:
+                        self.writer.add(fidelityTime=ns.sim_time(), fidelity=fidelity)
+                with self.profiler.phase("bob.measure"):
+                    r=self.rng.randint(0,1)
+                    #Completeing random measure of qubit
+                    if r == 0:
+                        self.result=self.node.qmemory.measure(observable=Z)
+                    elif r==1:
+                        self.result=self.node.qmemory.measure(observable=X)
+                    self.B_basis=r
                 if self.B_basis == 0 or self.B_basis == 1 or self.B_basis == 2:
                     # B send measurement
                     #print("BOB:SENDING STATE LIST")
@@ -245,12 +279,14 @@ class BobProtocol(NodeProtocol):
                 #Waiting for  Match list from Alice
                 yield(self.await_port_input(self.node.ports["cin_alice"]))
                 #print("BOB: RECEIVED MATCH LIST")
-                matchList=self.node.ports["cin_alice"].rx_input().items
-                #print(f"BOB:match {matchList}")
-                if matchList[0]:
-                    #print("BOB: MATCH FOUND!")
-                    self.key_B.append(self.result[int(0)][0])
-                    self.qubitCounter+=1
+                with self.profiler.phase("bob.classical"):
+                    matchList=self.node.ports["cin_alice"].rx_input().items
+                    #print(f"BOB:match {matchList}")
+                    if matchList[0]:
+                        #print("BOB: MATCH FOUND!")
+                        self.key_B.append(self.result[int(0)][0])
+                        self.qber.bob(self.qubitCounter, self.result[int(0)][0])
+                        self.qubitCounter+=1
                 #else:
                     #print("BOB: MATCH NOT FOUND")
                 #Sending buffer to inform Alice Bob is ready for next bit
@@ -259,24 +295,219 @@ class BobProtocol(NodeProtocol):
             else:
                # print(f"{ns.sim_time():.1f}")
                 break
-        printToFile(f'Secretkeys',f"Key at BOB: {self.key_B}", self.length)
-        printToFile('Emtanglements',f'{self.entanglements}', self.length)
         #print("END OF BOB PROTOCOL")
-#print("Please input length of key:")
-#length= int(sys.argv[1])
-[inputArgs, args] = addParserOptions()
-ns.set_qstate_formalism(ns.QFormalism.DM)
-alice, bob, qconn = example_network_setup(node_distance=inputArgs.nodeDistance/10000, depolar_rate=inputArgs.quantumNoise, source_frequency = inputArgs.sourceFrequency, delay=inputArgs.setDelay)
-aliceProtocol=AliceProtocol(alice,inputArgs.length).start()
-bobProtocol=BobProtocol(bob,inputArgs.length).start()
-stats = ns.sim_run(6000000000000)
-index=0
-errors=0
-for bit in aliceProtocol.getKey():
-    if bit != bobProtocol.getKey()[index]:
-        errors += 1
-    index += 1
+class PipelinedAliceProtocol(AliceProtocol):
+    #Alice does not wait for Bob between rounds: every arriving pair is used
+    #while fewer than window rounds are unanswered, and bases, match flags and
+    #losses are handled whenever they arrive.  Messages are tagged with the
+    #index of the pair, which both nodes count from the start of the run.
+    def __init__(self, node, length, window, fidelity=None, rng=None, qber=None, profiler=None):
+        super().__init__(node, length, fidelity, rng, qber, profiler)
+        self.window=window
+
+    def prepareQubit(self, mem_pos):
+        qubit=create_qubits(1,system_name="Q")
+        self.node.qmemory.put(qubit,mem_pos)
+        return self.randomState(mem_pos)
 
-for index2 in range(0,1):
-    printToFile(f'qunatumlatency',f"{bobProtocol.getRecTimes()[index2]-aliceProtocol.getSentTimes()[index2]}",inputArgs.length)
-printToFile('QBER',f"OBER: {errors/inputArgs.length}",inputArgs.length)
+    def run(self):
+        self.key_A=PackedBits(self.length)
+        self.qubitSendTimes=GrowingArray(2*self.length)
+        self.qubitCounter=0
+        self.simTime=None
+        #States of the rounds in flight, by pair index
+        states={}
+        pairIndex=0
+        mem_pos = self.node.qmemory.unused_positions[0]
+        state=self.prepareQubit(mem_pos)
+        while self.qubitCounter<self.length:
+            expression = yield self.await_port_input(self.node.ports["qin_charlie"]) | self.await_port_input(self.node.ports["cin_bob"])
+            if expression.first_term.value:
+                if len(states)<self.window:
+                    with self.profiler.phase("alice.bell"):
+                        self.qubitSendTimes.append(ns.sim_time())
+                        self.node.qmemory.operate(ns.CNOT, [0, 1])
+                        self.node.qmemory.operate(ns.H,0)
+                        m, _ = self.node.qmemory.measure([0, 1])
+                        self.node.ports["cout_bob"].tx_output(Message([("bell", pairIndex, m[0], m[1])]))
+                        states[pairIndex]=state
+                        self.fidelity.prepared(pairIndex, state)
+                    with self.profiler.phase("alice.prepare"):
+                        state=self.prepareQubit(mem_pos)
+                pairIndex+=1
+            if not expression.second_term.value:
+                continue
+            with self.profiler.phase("alice.classical"):
+                reply=[]
+                for item in self.node.ports["cin_bob"].rx_input().items:
+                    state_i=states.pop(item[1])
+                    if item[0]=="basis":
+                        self.matchFlag=len(Compare_measurement(1,[state_i],[item[2]]))>0 and self.qubitCounter<self.length
+                        if self.matchFlag:
+                            self.key_A.append(state_i%2) #quantum state 0,+:0    1,-:1
+                            self.qber.alice(self.qubitCounter, state_i%2)
+                            self.qubitCounter+=1
+                        reply.append(("match", item[1], self.matchFlag))
+                if self.qubitCounter>=self.length:
+                    reply.append(("done", pairIndex))
+                if reply:
+                    self.node.ports["cout_bob"].tx_output(Message(reply))
+        self.simTime=ns.sim_time()
+        #Bob stops the simulation once the last match flags reached him
+
+class PipelinedBobProtocol(BobProtocol):
+    def __init__(self, node, length, window, writer=None, fidelity=None, rng=None, qber=None, profiler=None):
+        super().__init__(node, length, writer, fidelity, rng, qber, profiler)
+        self.window=window
+
+    def run(self):
+        #Pair index held by every memory position, results and bases waiting for
+        #a match flag, and swap corrections of a repeater chain by pair index
+        slotOwner=[None]*self.window
+        results={}
+        chainFlips={}
+        pairIndex=0
+        while True:
+            expression = yield self.await_port_input(self.node.ports["qin_charlie"]) | self.await_port_input(self.node.ports["cin_alice"])
+            if expression.first_term.value:
+                slot=pairIndex%self.window
+                self.node.qmemory.put(self.node.ports["qin_charlie"].rx_input().items, positions=[slot], replace=True)
+                chainFlips.pop(slotOwner[slot], None)
+                slotOwner[slot]=pairIndex
+                pairIndex+=1
+            if not expression.second_term.value:
+                continue
+            with self.profiler.phase("bob.classical"):
+                reply=[]
+                for item in self.node.ports["cin_alice"].rx_input().items:
+                    if item[0]=="bell":
+                        slot=item[1]%self.window
+                        #The half was overwritten by a newer pair, the round is lost
+                        if slotOwner[slot]!=item[1]:
+                            reply.append(("lost", item[1]))
+                            self.fidelity.forget(item[1])
+                            chainFlips.pop(item[1], None)
+                            continue
+                        self.entanglements += 1
+                        with self.profiler.phase("bob.correct"):
+                            if item[2]:
+                                self.node.qmemory.operate(ns.Z, slot)
+                            if item[3]:
+                                self.node.qmemory.operate(ns.X, slot)
+                            #Swap frame of a repeater chain, so fidelity sees the corrected state;
+                            #a frame that only arrives later is XORed into the bit at match time
+                            z, x=chainFlips.pop(item[1], (0, 0))
+                            if z:
+                                self.node.qmemory.operate(ns.Z, slot)
+                            if x:
+                                self.node.qmemory.operate(ns.X, slot)
+                            self.qubitRecTimes.append(ns.sim_time())
+                        with self.profiler.phase("bob.fidelity"):
+                            fidelity = self.fidelity.measure(item[1], self.node.qmemory.peek(slot)[0])
+                            if fidelity is not None:
+                                self.writer.add(fidelityTime=ns.sim_time(), fidelity=fidelity)
+                        with self.profiler.phase("bob.measure"):
+                            r=self.rng.randint(0,1)
+                            result=self.node.qmemory.measure(positions=[slot], observable=Z if r == 0 else X)
+                        slotOwner[slot]=None
+                        results[item[1]]=(result[0][0], r)
+                        reply.append(("basis", item[1], r))
+                    elif item[0]=="swap":
+                        #XOR of the Bell results of all repeaters, ahead of Alice's message
+                        if slotOwner[item[1]%self.window]==item[1] or item[1] in results:
+                            chainFlips[item[1]]=(item[2], item[3])
+                    elif item[0]=="match":
+                        bit, r=results.pop(item[1])
+                        #Pending X flips a Z-basis result, pending Z an X-basis result
+                        z, x=chainFlips.pop(item[1], (0, 0))
+                        bit^=x if r == 0 else z
+                        if item[2]:
+                            self.key_B.append(bit)
+                            self.qber.bob(self.qubitCounter, bit)
+                            self.qubitCounter+=1
+                    elif item[0]=="done":
+                        self.onDone()
+                        return
+                if reply:
+                    self.node.ports["cout_alice"].tx_output(Message(reply))
+
+def buildNetwork(params):
+    #Nodes and swap protocols of a run; QKD_worker.py keeps them between runs
+    #and sets network["configure"] to retune them in place
+    formalism = getattr(params, "formalism", "DM")
+    window = getattr(params, "window", 0)
+    segments = getattr(params, "segments", 1)
+    if segments > 1:
+        from QKD_repeater import chain_network_setup
+        window = max(window, 1)
+        alice, bob, repeaters, swapProtocols, connections = chain_network_setup(node_distance=params.nodeDistance/10000, depolar_rate=params.quantumNoise, source_frequency = params.sourceFrequency, delay=params.setDelay, segments=segments, window=window, formalism=formalism)
+    else:
+        alice, bob, qconn = example_network_setup(node_distance=params.nodeDistance/10000, depolar_rate=params.quantumNoise, source_frequency = params.sourceFrequency, delay=params.setDelay, window=window, formalism=formalism)
+        repeaters, swapProtocols = [], []
+    return {"alice": alice, "bob": bob, "repeaters": repeaters, "swapProtocols": swapProtocols, "window": window, "protocols": []}
+
+def checkWindow(params, window):
+    #Bob reuses the slot of pair i for pair i+window, window source periods
+    #later; Alice's Bell result for pair i has to reach him before that, or
+    #every round is lost and the run only ends at the simulation time limit
+    timing = linkTiming(params.nodeDistance/10000, params.sourceFrequency, params.setDelay)
+    minimum = int(timing["cDelay"] // timing["period"]) + 1
+    if 0 < window < minimum:
+        raise ValueError(f"window {window} does not cover the classical delay of {timing['cDelay']:.0f} ns "
+                         f"at a source period of {timing['period']:.0f} ns, use a window of at least {minimum}")
+
+def runQKD(params, writer=None, network=None, profiler=NULL_PROFILER):
+    if params.engine == "fast":
+        return runFastQKD(params, writer, profiler)
+    #Nothing requests samples during a whole-key run, QKD_stream.keyBlocks does
+    if getattr(params, "fidelity", DEFAULTS["fidelity"]) == "demand":
+        raise ValueError("fidelity mode demand needs QKD_stream.py, which requests a sample per key block")
+    if writer is None:
+        writer = ResultWriter(runParams(params))
+    streams = runStreams(getattr(params, "seed", None), getattr(params, "replica", 0))
+    run = startRun(params, writer, streams, network, profiler)
+    aliceProtocol, bobProtocol, fidelity, estimator = run["alice"], run["bob"], run["fidelity"], run["estimator"]
+    #Protocol phases nest under "simulate", its self time is the simulator itself
+    with profiler.phase("simulate"):
+        stats = ns.sim_run(6000000000000)
+    #After an early stop Alice may hold one bit Bob has not received yet
+    keyLength=min(len(aliceProtocol.getKey()), len(bobProtocol.getKey()))
+    errors=aliceProtocol.getKey().hamming(bobProtocol.getKey())
+    writer.addColumn("sendTime", aliceProtocol.getSentTimes().array())
+    writer.addColumn("recTime", bobProtocol.getRecTimes().array())
+    simTime = aliceProtocol.getSimTime()
+    result = {"key_A": aliceProtocol.getKey().prefix(keyLength), "key_B": bobProtocol.getKey().prefix(keyLength),
+            "entanglements": bobProtocol.getEntanglements(), "simTime": ns.sim_time() if simTime is None else simTime,
+            "latency": bobProtocol.getRecTimes()[0]-aliceProtocol.getSentTimes()[0],
+            "qber": errors/max(keyLength, 1), "events": simEventCount(stats), **fidelity.summary(),
+            **estimator.summary(), "sampledBits": estimator.sampled}
+    return recordResults(writer, postProcess(params, result, streams, profiler))
+
+def startRun(params, writer, streams, network=None, profiler=NULL_PROFILER):
+    #Resets the simulator and starts the protocols of a DES run without running
+    #it, so QKD_stream.py can advance the simulation in slices
+    ns.sim_reset()
+    if streams["netsquid"] is not None:
+        ns.set_random_state(seed=streams["netsquid"])
+    setFormalism(getattr(params, "formalism", "DM"))
+    with profiler.phase("setup"):
+        if network is None:
+            network = buildNetwork(params)
+        else:
+            for protocol in network["protocols"]:
+                protocol.stop()
+            network["configure"](params)
+    alice, bob, window = network["alice"], network["bob"], network["window"]
+    checkWindow(params, window)
+    for protocol in network["swapProtocols"]:
+        protocol.reset()
+    fidelity = FidelityTracker(getattr(params, "fidelity", DEFAULTS["fidelity"]), getattr(params, "fidelityEvery", DEFAULTS["fidelityEvery"]))
+    estimator = qberEstimator(params, streams, ns.sim_stop)
+    if window > 0:
+        aliceProtocol=PipelinedAliceProtocol(alice,params.length,window,fidelity,streams["python"],estimator,profiler).start()
+        bobProtocol=PipelinedBobProtocol(bob,params.length,window,writer,fidelity,streams["python"],estimator,profiler).start()
+    else:
+        aliceProtocol=AliceProtocol(alice,params.length,fidelity,streams["python"],estimator,profiler).start()
+        bobProtocol=BobProtocol(bob,params.length,writer,fidelity,streams["python"],estimator,profiler).start()
+    network["protocols"] = [aliceProtocol, bobProtocol]
+    return {"alice": aliceProtocol, "bob": bobProtocol, "fidelity": fidelity, "estimator": estimator, "network": network}
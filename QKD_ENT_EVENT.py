@@ -1,12 +1,14 @@
 #! usr/bin/python3
 import netsquid as ns
 import sys
-from random import randint
+from collections import deque
+import random
 from netsquid.components.qchannel import QuantumChannel
 from netsquid.components import QuantumMemory
 from netsquid.qubits import StateSampler
 from netsquid.protocols import NodeProtocol, Signals
 from netsquid.components.qsource import QSource, SourceStatus
+from netsquid.components.component import Message
 from netsquid.nodes import DirectConnection
 from netsquid.qubits.operators import *
 from netsquid.qubits import create_qubits
@@ -18,7 +20,21 @@ from netsquid.nodes.connections import Connection
 from netsquid.components import ClassicalChannel
 from netsquid.components.models import FibreDelayModel
 from netsquid.protocols import Protocol
-from pydynaa import EventExpression
+from optparse import OptionParser
+from QKD_simstats import simEventCount, runSummary
+from QKD_formalism import FORMALISMS, setFormalism, makeNoiseModel
+from QKD_keystore import PackedBits
+from QKD_ENT_fast import linkTiming
+
+def addParserOptions():
+    parser = OptionParser(usage="%prog [options] length")
+    parser.add_option("-q", "--queue", default = 4,
+                      dest = "queue", type = "int", help = "prepared data qubits Alice keeps in memory")
+    parser.add_option("-w", "--window", default = 0,
+                      dest = "window", type = "int", help = "rounds in flight and Bob memory positions (0: enough to use every pair)")
+    parser.add_option("--formalism", default = "DM", choices = list(FORMALISMS),
+                      dest = "formalism", type = "choice", help = "quantum state formalism: DM, KET or STAB (stochastic noise)")
+    return parser.parse_args()
 
 class ClassicalConnectionA2B(Connection):
         def __init__(self, length):
@@ -28,13 +44,14 @@ class ClassicalConnectionA2B(Connection):
             self.subcomponents["Channel_A2B"].ports['recv'].forward_output(self.ports['B'])
 
 class EntanglingConnection(Connection):
-        def __init__(self, length, source_frequency):
+        def __init__(self, length, source_frequency, set_delay=1e9, noise_model=None):
                 super().__init__(name="EntanglingConnection")
-                timing_model = FixedDelayModel(delay=(1e9 / source_frequency))
+                timing_model = FixedDelayModel(delay=(set_delay / source_frequency))
+                noise = {} if noise_model is None else {"noise_model": noise_model}
                 qsource = QSource("qsource", StateSampler([ks.b00], [1.0]), num_ports=2,timing_model=timing_model, status=SourceStatus.INTERNAL)
                 self.add_subcomponent(qsource)
-                qchannel_c2a = QuantumChannel("qchannel_C2A", length=length / 2,models={"delay_model": FibreDelayModel()})
-                qchannel_c2b = QuantumChannel("qchannel_C2B", length=length / 2,models={"delay_model": FibreDelayModel()})
+                qchannel_c2a = QuantumChannel("qchannel_C2A", length=length / 2,models={"delay_model": FibreDelayModel(), **noise})
+                qchannel_c2b = QuantumChannel("qchannel_C2B", length=length / 2,models={"delay_model": FibreDelayModel(), **noise})
                 # Add channels and forward quantum channel output to external port output:
                 self.add_subcomponent(qchannel_c2a, forward_output=[("A", "recv")])
                 self.add_subcomponent(qchannel_c2b, forward_output=[("B", "recv")])
@@ -42,15 +59,17 @@ class EntanglingConnection(Connection):
                 qsource.ports["qout0"].connect(qchannel_c2a.ports["send"])
                 qsource.ports["qout1"].connect(qchannel_c2b.ports["send"])
 
-def example_network_setup(node_distance=4e-3, depolar_rate=1e7):
+def example_network_setup(node_distance=4e-3, depolar_rate=None, source_frequency=2e7, delay=1e9, queue=1, window=1, formalism="DM"):
     # Setup nodes Alice and Bob with quantum memories:
-    noise_model = DepolarNoiseModel(depolar_rate=depolar_rate)
+    #No noise unless a depolar rate is given, as the script always ran
+    noise_model = None if depolar_rate is None else makeNoiseModel(depolar_rate, formalism)
     #alice = Node("Alice", port_names=['qin_charlie', 'cout_bob','cin_bob'],qmemory=QuantumMemory("AliceMemory", num_positions=2,memory_noise_models=[noise_model] * 2))
-    alice = Node("Alice", port_names=['qin_charlie', 'cout_bob','cin_bob'],qmemory=QuantumMemory("AliceMemory", num_positions=2))
-    alice.ports['qin_charlie'].forward_input(alice.qmemory.ports['qin1'])
+    #Positions 0..queue-1 hold prepared data qubits, the last one the entangled half
+    alice = Node("Alice", port_names=['qin_charlie', 'cout_bob','cin_bob'],qmemory=QuantumMemory("AliceMemory", num_positions=queue+1,memory_noise_models=None if noise_model is None else [noise_model] * (queue+1)))
+    alice.ports['qin_charlie'].forward_input(alice.qmemory.ports[f'qin{queue}'])
     #bob = Node("Bob", port_names=['qin_charlie', 'cin_alice','cout_alice'], qmemory=QuantumMemory("BobMemory", num_positions=1, memory_noise_models=[noise_model]))
-    bob = Node("Bob", port_names=['qin_charlie', 'cin_alice','cout_alice'], qmemory=QuantumMemory("BobMemory", num_positions=1))
-    bob.ports['qin_charlie'].forward_input(bob.qmemory.ports['qin0']) 
+    #Bob puts the incoming halves into rotating positions himself
+    bob = Node("Bob", port_names=['qin_charlie', 'cin_alice','cout_alice'], qmemory=QuantumMemory("BobMemory", num_positions=window, memory_noise_models=None if noise_model is None else [noise_model] * window))
     # Setup classical connection between nodes:
     c_conn1 = ClassicalConnectionA2B(length=node_distance)
     c_conn2 = ClassicalConnectionA2B(length=node_distance)
@@ -59,7 +78,7 @@ def example_network_setup(node_distance=4e-3, depolar_rate=1e7):
     alice.ports['cin_bob'].connect(c_conn2.ports['B'])
     bob.ports['cout_alice'].connect(c_conn2.ports['A'])
     #Setup entangling connection between nodes:
-    q_conn = EntanglingConnection(length=node_distance, source_frequency=2e7)
+    q_conn = EntanglingConnection(length=node_distance, source_frequency=source_frequency, set_delay=delay, noise_model=noise_model)
     alice.ports['qin_charlie'].connect(q_conn.ports['A'])
     bob.ports['qin_charlie'].connect(q_conn.ports['B'])
     return alice, bob, q_conn
@@ -76,231 +95,205 @@ def Compare_measurement(num_bits,stateList,opList):
     return matchList
 
 
-class qubitCreation(NodeProtocol):
-    def run(self):
-        try:
-            mem_pos = self.node.qmemory.unused_positions[0]
-        except:
-            self.send_signal(signal_label=Signals.FAIL)
-           # print("Failed to get unused memory locations")
-            self.node.qmemory.discard(0)
-            mem_pos = self.node.qmemory.unused_positions[0]
-        qubit=create_qubits(1,system_name="Q")
-        self.node.qmemory.put(qubit,mem_pos)
-        self.send_signal(signal_label=Signals.SUCCESS, result=mem_pos)
-        self.stop()
+class PreparationProtocol(NodeProtocol):
+    #Keeps the spare memory positions filled with prepared data qubits.  Runs
+    #for the whole simulation and refills in one batch when the consumer
+    #signals REFILL, so a bit costs no subprotocol start or signal of its own.
+    def __init__(self, node, positions, lowWater=1, rng=None):
+        super().__init__(node)
+        self.rng=random if rng is None else rng
+        self.free=deque(positions)
+        self.ready=deque()
+        self.lowWater=lowWater
+        self.consumer=None
 
-            
+    def fill(self):
+        positions=list(self.free)
+        self.free.clear()
+        if not positions:
+            return
+        self.node.qmemory.put(create_qubits(len(positions),system_name="Q"),positions=positions,replace=True)
+        for mem_pos in positions:
+            state=self.rng.randint(0,3)
+            #Random operation
+            if   state == 0: # 0 state
+                pass
+            elif state == 1: # 1 state    #X
+                self.node.qmemory.operate(ns.X,mem_pos)
+            elif state == 2: # + state    #H
+                self.node.qmemory.operate(ns.H,mem_pos)
+            elif state == 3: # - state    #XH
+                self.node.qmemory.operate(ns.X,mem_pos)
+                self.node.qmemory.operate(ns.H,mem_pos)
+            self.ready.append((mem_pos,state))
+
+    def run(self):
+        evexpr_refill = self.await_signal(sender=self.consumer, signal_label="REFILL")
+        while True:
+            self.fill()
+            self.send_signal(signal_label=Signals.READY)
+            yield evexpr_refill
+            evexpr_refill.reprime()
 
 class AliceProtocol(NodeProtocol):
-    def __init__(self, node,length,createQubit):
+    #Alice does not wait for Bob between rounds: every arriving pair is used
+    #while fewer than window rounds are unanswered, as PipelinedAliceProtocol in
+    #QKD_ENT.py.  Messages are tagged with the index of the pair, which both
+    #nodes count from the start of the run.
+    def __init__(self, node,length,window,preparation,ent_pos):
         super().__init__(node)
-        self.matchList=[]
         self.length=length
-        self.ent_swap=False
-        self.add_subprotocol(createQubit, 'createQubit')
-        self.qubitFlag=False
-        self.entangled=False
-        self.matchFlag=False
+        self.window=window
+        self.ent_pos=ent_pos
+        self.add_signal("REFILL")
+        preparation.consumer=self
+        self.add_subprotocol(preparation, 'preparation')
 
     def run(self):
-        self.key_A=[]
+        self.key_A=PackedBits(self.length)
         self.qubitCounter=0
-        received_flag=False
-        sent_flag=False
-        mem_pos = self.node.qmemory.unused_positions[0]
-        evexpr_signal = self.await_signal(sender=self.subprotocols['createQubit'], signal_label=Signals.SUCCESS)
-        evexpr_port = self.await_port_input(self.node.ports["qin_charlie"])
-        evexpr_port_out_bob = self.await_port_output(self.node.ports["cout_bob"])
-        evexpr_port_in_bob = self.await_port_input(self.node.ports["cin_bob"])
-        while True:
-                #print("Start of ALice")
-                #evexpr_port.reprime()
-                if self.qubitCounter<self.length and self.is_connected:
-                    if not self.qubitFlag:
-                        self.start_subprotocols()
-                    if not self.qubitFlag or not self.entangled:
-                        #print(self.qubitFlag, self.entangled);
-                        #print("Alice: Waiting for Entanglement")
-                        expression = yield evexpr_signal | self.await_port_input(self.node.ports["qin_charlie"])
-                        #print(evexpr_port.triggered_events)
-                    if expression.first_term.value and not self.qubitFlag:
-                        #print("ALICE:Got qubit");
-                        state=randint(0,3)
-                        #print(state)
-                        #Random operation
-                        if   state == 0: # 0 state
-                            pass
-                        elif state == 1: # 1 state    #X
-                            self.node.qmemory.operate(ns.X,mem_pos)
-                        elif state == 2: # + state    #H
-                            self.node.qmemory.operate(ns.H,mem_pos)
-                        elif state == 3: # - state    #XH
-                            self.node.qmemory.operate(ns.X,mem_pos)
-                            self.node.qmemory.operate(ns.H,mem_pos)
-                        else :
-                            print("Create random bits ERROR!!")
-                        self.qubitFlag=True
-                        #evexpr_signal.reprime()
-                    else:
-                        #print("ALICE: Entanglement")
-                        self.entangled=True
-                        #evexpr_port.reprime()
-                    #yield self.await_port_input(self.node.ports["qin_charlie"])
+        preparation=self.subprotocols['preparation']
+        #States of the rounds in flight, by pair index
+        states={}
+        pairIndex=0
+        #Created once and reprimed after every trigger
+        evexpr_ready = self.await_signal(sender=preparation, signal_label=Signals.READY)
+        evexpr_input = self.await_port_input(self.node.ports["qin_charlie"]) | self.await_port_input(self.node.ports["cin_bob"])
+        while self.qubitCounter<self.length:
+            yield evexpr_input
+            charlie, bob = evexpr_input.first_term.value, evexpr_input.second_term.value
+            evexpr_input.reprime()
+            if charlie:
+                if len(states)<self.window:
+                    if not preparation.ready:
+                        yield evexpr_ready
+                        evexpr_ready.reprime()
+                    mem_pos, state = preparation.ready.popleft()
                     #Completes Entanglement and does Bell Measurement
-                    if self.qubitFlag and  self.entangled:
-                        if not received_flag and not sent_flag:
-                            self.node.qmemory.operate(ns.CNOT, [0, 1])
-                            self.node.qmemory.operate(ns.H,0)
-                            m, _ = self.node.qmemory.measure([0, 1])
+                    self.node.qmemory.operate(ns.CNOT, [mem_pos, self.ent_pos])
+                    self.node.qmemory.operate(ns.H,mem_pos)
+                    m, _ = self.node.qmemory.measure([mem_pos, self.ent_pos])
+                    preparation.free.append(mem_pos)
+                    if len(preparation.ready)<=preparation.lowWater:
+                        self.send_signal("REFILL")
                     #Sends measurement to Bob for correction
-                            self.node.ports["cout_bob"].tx_output(m)
-                        #print("ALICE: QUBIT ENTANGLED")
-                        #print("ALICE: WAITING FOR BOB QUBIT STATELIST")
-                        expression2= yield evexpr_port_in_bob | evexpr_port_out_bob
-                        if expression2.first_term.value and not received_flag:
-                            meas_results = self.node.ports["cin_bob"].rx_input().items
-                            received_flag=True
-                        elif received_flag:
-                            sent_flag=True
-
-                        if received_flag:
-                            evexpr_port_out_bob.reprime()
-                            #Strips buffer from list if one is present
-                            if meas_results.count("")>0:
-                                meas_results.remove("")
-                            statelist=[state]
-                        #Compares bits
-                            self.matchList=Compare_measurement(1,statelist,meas_results)
-                        #Confirms match is found
-                            if 0 in self.matchList or 1 in self.matchList:
-                                self.matchFlag=True
-                                self.node.ports["cout_bob"].tx_output(self.matchFlag)
-                            else:
-                                #print("ERROR")
-                                self.node.ports["cout_bob"].tx_output(self.matchFlag)
-                            #print("ALICE: SENT MATCH LIST")
-                        if sent_flag:
-                            if self.matchFlag:
-                               # print("ALICE: MATCH FOUND")
-                                self.key_A.append(state%2) #quantum state 0,+:0    1,-:1
-                                self.qubitCounter+=1
-                            self.qubitFlag=False
-                            self.entangled=False
-
-                            if received_flag:
-                            #evexpr_signal.reprime()
-                                self.matchFlag=False
-                                self.qubitFlag=False
-                                self.entangled=False
-                                received_flag=False
-                                sent_flag=False
-                                #print(f"ALICE: Key Length={self.qubitCounter}")
-                else:
-                    print(f"{ns.sim_time():.1f}")
-                    break
-        #print(f"Key at Alice: {self.key_A}")
-        #print("END OF ALICE PROTOCOL")
-        ns.sim_stop()
+                    self.node.ports["cout_bob"].tx_output(Message([("bell", pairIndex, m[0], m[1])]))
+                    states[pairIndex]=state
+                pairIndex+=1
+            if not bob:
+                continue
+            reply=[]
+            for item in self.node.ports["cin_bob"].rx_input().items:
+                state=states.pop(item[1])
+                if item[0]=="basis":
+                    #Compares bits and confirms match is found
+                    matchFlag=len(Compare_measurement(1,[state],[item[2]]))>0 and self.qubitCounter<self.length
+                    if matchFlag:
+                        self.key_A.append(state%2) #quantum state 0,+:0    1,-:1
+                        self.qubitCounter+=1
+                    reply.append(("match", item[1], matchFlag))
+            if self.qubitCounter>=self.length:
+                reply.append(("done", pairIndex))
+            if reply:
+                self.node.ports["cout_bob"].tx_output(Message(reply))
+        #Bob stops the simulation once the last match flags reached him
 
     def start(self):
         super().start()
-            
-        
+        self.start_subprotocols()
+
 class BobProtocol(NodeProtocol):
-    def __init__(self,node,length):
+    def __init__(self,node,length,window,rng=None):
         super().__init__(node)
+        self.rng=random if rng is None else rng
         self.length=length
+        self.window=window
         self.qubitCounter=0
-        self.stateList=[]
-        self.result=[]
-        self.B_basis=[]
-        self.key_B=[]
+        self.key_B=PackedBits(length)
         self.entanglements=0
 
     def run(self):
-        entangled=False
-        meas_results=None
+        #Pair index held by every memory position and results waiting for a
+        #match flag
+        slotOwner=[None]*self.window
+        results={}
+        pairIndex=0
+        #Created once and reprimed after every trigger
+        evexpr_input = self.await_port_input(self.node.ports["qin_charlie"]) | self.await_port_input(self.node.ports["cin_alice"])
         while True:
-            meas_results=None
-            if self.qubitCounter<length and self.is_connected:
-                self.node.ports["cout_alice"].tx_output([])
-                evexpr_port_a = self.await_port_input(self.node.ports["cin_alice"])
-                evexpr_port_c = self.await_port_input(self.node.ports["qin_charlie"])
-                expression = yield evexpr_port_a | evexpr_port_c
-               # print("BOB:Waiting for Entanglement")
-                #Waiting for entanglement control qubit
-                if expression.first_term.value:
-                    #Waiting for Alice Bell Measurements for Corrections
-                    meas_results = self.node.ports["cin_alice"].rx_input().items
-                    #evexpr_port_a.reprime()
-                #Correction of teleported qubit
-                else:
-                    #expression.reprime()
+            yield evexpr_input
+            charlie, alice = evexpr_input.first_term.value, evexpr_input.second_term.value
+            evexpr_input.reprime()
+            if charlie:
+                slot=pairIndex%self.window
+                self.node.qmemory.put(self.node.ports["qin_charlie"].rx_input().items, positions=[slot], replace=True)
+                slotOwner[slot]=pairIndex
+                pairIndex+=1
+            if not alice:
+                continue
+            reply=[]
+            for item in self.node.ports["cin_alice"].rx_input().items:
+                if item[0]=="bell":
+                    slot=item[1]%self.window
+                    #The half was overwritten by a newer pair, the round is lost
+                    if slotOwner[slot]!=item[1]:
+                        reply.append(("lost", item[1]))
+                        continue
                     self.entanglements += 1
-                    entangled=True
-                    #evexpr_port_c.reprime()
-                if meas_results is not None and entangled:
-                    if meas_results[0]:
-                        self.node.qmemory.operate(ns.Z, 0)
-                    if meas_results[1]:
-                        self.node.qmemory.operate(ns.X, 0)
-                    #print("BOB:QUBIT ENTANGLED")
-                    #Redording Fidelity strength
-                    fidelity = ns.qubits.fidelity(self.node.qmemory.peek(0)[0],ns.y0, squared=True)
-                   # print(f"{ns.sim_time():.1f}: Bob received entangled qubit and " f"corrections! Fidelity = {fidelity:.3f}")
-                    r=randint(0,1)
+                    #Correction of teleported qubit
+                    if item[2]:
+                        self.node.qmemory.operate(ns.Z, slot)
+                    if item[3]:
+                        self.node.qmemory.operate(ns.X, slot)
+                    r=self.rng.randint(0,1)
                     #Completeing random measure of qubit
-                    if r == 0:
-                        self.result=self.node.qmemory.measure(observable=Z)
-                    elif r==1:
-                        self.result=self.node.qmemory.measure(observable=X)
-                    self.B_basis=r
-                    if self.B_basis == 0 or self.B_basis == 1 or self.B_basis == 2:
-                        # B send measurement
-                        #print("BOB:SENDING STATE LIST")
-                        self.node.ports["cout_alice"].tx_output(self.B_basis)
-                    else :
-                        print("B measuring failed!!")
-                        print(self.B_basis[0])
-                    #print("BOB: WAITING FOR MATCH LIST") 
-                    #Waiting for  Match list from Alice
-                    yield(self.await_port_input(self.node.ports["cin_alice"]))
-                    #print("BOB: RECEIVED MATCH LIST")
-                    matchList=self.node.ports["cin_alice"].rx_input().items
-                    #print(f"BOB:match {matchList}")
-                    if matchList[0]:
-                        #print("BOB: MATCH FOUND!")
-                        self.key_B.append(self.result[int(0)][0])
+                    result=self.node.qmemory.measure(positions=[slot], observable=Z if r == 0 else X)
+                    slotOwner[slot]=None
+                    results[item[1]]=result[0][0]
+                    reply.append(("basis", item[1], r))
+                elif item[0]=="match":
+                    bit=results.pop(item[1])
+                    if item[2]:
+                        self.key_B.append(bit)
                         self.qubitCounter+=1
-                        #meas_results=None
-                        #entangled=False
-                    #else:
-                        #print("BOB: MATCH NOT FOUND")
-                    #Sending buffer to inform Alice Bob is ready for next bit
-                    self.node.ports["cout_alice"].tx_output("")
-                    #print(f"BOB:Key Length = {self.qubitCounter}")
-                    entangled=False
-                    meas_results=None
-                    #evexpr_port_a.reprime()
-                    #evexpr_port_c.reprime()
-                    #expression.reprime()
-            else:
-               # print(f"{ns.sim_time():.1f}")
-                break
-        #print(f"Key at BOB: {self.key_B}")
-        print(self.entanglements)
-        #print("END OF BOB PROTOCOL")
-#print("Please input length of key:")
-length= int(sys.argv[1])
-ns.set_qstate_formalism(ns.QFormalism.DM)
-alice, bob, qconn = example_network_setup()
-createQubits=qubitCreation(alice)
-aliceProtocol=AliceProtocol(alice,length,createQubits).start()
-bobProtocol=BobProtocol(bob,length).start()
-stats = ns.sim_run(6000000000)
-
-
-
+                elif item[0]=="done":
+                    ns.sim_stop()
+                    return
+            if reply:
+                self.node.ports["cout_alice"].tx_output(Message(reply))
 
+def runEvent(length, queue=4, formalism="DM", node_distance=4e-3, depolar_rate=None, source_frequency=2e7, delay=1e9, streams=None, window=0):
+    #One run; streams of QKD_seeding.runStreams make it reproducible.  Bob
+    #reuses the slot of pair i for pair i+window, so Alice's Bell result has to
+    #reach him within window source periods; window 0 covers the whole round
+    #trip, so Alice never has to skip a pair
+    timing = linkTiming(node_distance, source_frequency, delay)
+    minimum = int(timing["cDelay"] // timing["period"]) + 1
+    if window == 0:
+        window = int(2 * timing["cDelay"] // timing["period"]) + 2
+    elif window < minimum:
+        raise ValueError(f"window {window} does not cover the classical delay of {timing['cDelay']:.0f} ns "
+                         f"at a source period of {timing['period']:.0f} ns, use a window of at least {minimum}")
+    ns.sim_reset()
+    if streams is not None and streams["netsquid"] is not None:
+        ns.set_random_state(seed=streams["netsquid"])
+    rng = None if streams is None else streams["python"]
+    setFormalism(formalism)
+    alice, bob, qconn = example_network_setup(node_distance, depolar_rate, source_frequency, delay, queue=queue, window=window, formalism=formalism)
+    preparation=PreparationProtocol(alice, range(queue), lowWater=queue//2, rng=rng)
+    aliceProtocol=AliceProtocol(alice,length,window,preparation,queue)
+    aliceProtocol.start()
+    bobProtocol=BobProtocol(bob,length,window,rng)
+    bobProtocol.start()
+    stats = ns.sim_run(6000000000000)
+    #The qber of a partial key would look like a finished run
+    if len(bobProtocol.key_B)<length:
+        raise RuntimeError(f"simulation ended at {ns.sim_time():.0f} ns with {len(bobProtocol.key_B)} of {length} key bits")
+    errors=aliceProtocol.key_A.hamming(bobProtocol.key_B)
+    return {"key_A": aliceProtocol.key_A, "key_B": bobProtocol.key_B, "qber": errors/length, "simTime": ns.sim_time(),
+            "entanglements": bobProtocol.entanglements, "latency": None, "events": simEventCount(stats)}
 
+if __name__ == "__main__":
+    [inputArgs, args] = addParserOptions()
+    result = runEvent(int(args[0]), inputArgs.queue, inputArgs.formalism, window=inputArgs.window)
+    print(runSummary(result["qber"], result["simTime"], result["entanglements"], result["events"]))
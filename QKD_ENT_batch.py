@@ -2,7 +2,7 @@
 import os
 import sys
 import netsquid as ns 
-from random import randint
+import random
 from netsquid.components.qchannel import QuantumChannel
 from netsquid.components import QuantumMemory
 from netsquid.qubits import StateSampler
@@ -19,6 +19,20 @@ from netsquid.nodes.connections import Connection
 from netsquid.components import ClassicalChannel
 from netsquid.components.models import FibreDelayModel
 from netsquid.protocols import Protocol
+from optparse import OptionParser
+from QKD_simstats import simEventCount, runSummary
+from QKD_formalism import FORMALISMS, setFormalism, makeNoiseModel
+from QKD_keystore import PackedBits
+from QKD_ENT_fast import linkTiming
+from netsquid.components.component import Message
+
+def addParserOptions():
+    parser = OptionParser(usage="%prog [options] length")
+    parser.add_option("-w", "--window", default = 1024,
+                      dest = "window", type = "int", help = "rounds sifted per window of classical messages")
+    parser.add_option("--formalism", default = "DM", choices = list(FORMALISMS),
+                      dest = "formalism", type = "choice", help = "quantum state formalism: DM, KET or STAB (stochastic noise)")
+    return parser.parse_args()
 
 class ClassicalConnectionA2B(Connection):
         def __init__(self, length):
@@ -28,13 +42,14 @@ class ClassicalConnectionA2B(Connection):
             self.subcomponents["Channel_A2B"].ports['recv'].forward_output(self.ports['B'])
 
 class EntanglingConnection(Connection):
-        def __init__(self, length, source_frequency):
+        def __init__(self, length, source_frequency, set_delay=1e9, noise_model=None):
                 super().__init__(name="EntanglingConnection")
-                timing_model = FixedDelayModel(delay=(1e9 / source_frequency))
+                timing_model = FixedDelayModel(delay=(set_delay / source_frequency))
+                noise = {} if noise_model is None else {"noise_model": noise_model}
                 qsource = QSource("qsource", StateSampler([ks.b00], [1.0]), num_ports=2,timing_model=timing_model, status=SourceStatus.INTERNAL)
                 self.add_subcomponent(qsource)
-                qchannel_c2a = QuantumChannel("qchannel_C2A", length=length / 2,models={"delay_model": FibreDelayModel()})
-                qchannel_c2b = QuantumChannel("qchannel_C2B", length=length / 2,models={"delay_model": FibreDelayModel()})
+                qchannel_c2a = QuantumChannel("qchannel_C2A", length=length / 2,models={"delay_model": FibreDelayModel(), **noise})
+                qchannel_c2b = QuantumChannel("qchannel_C2B", length=length / 2,models={"delay_model": FibreDelayModel(), **noise})
                 # Add channels and forward quantum channel output to external port output:
                 self.add_subcomponent(qchannel_c2a, forward_output=[("A", "recv")])
                 self.add_subcomponent(qchannel_c2b, forward_output=[("B", "recv")])
@@ -42,14 +57,15 @@ class EntanglingConnection(Connection):
                 qsource.ports["qout0"].connect(qchannel_c2a.ports["send"])
                 qsource.ports["qout1"].connect(qchannel_c2b.ports["send"])
 
-def example_network_setup(node_distance=4e-3, depolar_rate=1e7):
+def example_network_setup(node_distance=4e-3, depolar_rate=None, source_frequency=2e7, delay=1e9, formalism="DM"):
     # Setup nodes Alice and Bob with quantum memories:
-    noise_model = DepolarNoiseModel(depolar_rate=depolar_rate)
+    #No noise unless a depolar rate is given, as the script always ran
+    noise_model = None if depolar_rate is None else makeNoiseModel(depolar_rate, formalism)
     #alice = Node("Alice", port_names=['qin_charlie', 'cout_bob','cin_bob'],qmemory=QuantumMemory("AliceMemory", num_positions=2,memory_noise_models=[noise_model] * 2))
-    alice = Node("Alice", port_names=['qin_charlie', 'cout_bob','cin_bob'],qmemory=QuantumMemory("AliceMemory", num_positions=2))
+    alice = Node("Alice", port_names=['qin_charlie', 'cout_bob','cin_bob'],qmemory=QuantumMemory("AliceMemory", num_positions=2,memory_noise_models=None if noise_model is None else [noise_model] * 2))
     alice.ports['qin_charlie'].forward_input(alice.qmemory.ports['qin1'])
     #bob = Node("Bob", port_names=['qin_charlie', 'cin_alice','cout_alice'], qmemory=QuantumMemory("BobMemory", num_positions=1, memory_noise_models=[noise_model]))
-    bob = Node("Bob", port_names=['qin_charlie', 'cin_alice','cout_alice'], qmemory=QuantumMemory("BobMemory", num_positions=1))
+    bob = Node("Bob", port_names=['qin_charlie', 'cin_alice','cout_alice'], qmemory=QuantumMemory("BobMemory", num_positions=1, memory_noise_models=None if noise_model is None else [noise_model]))
     bob.ports['qin_charlie'].forward_input(bob.qmemory.ports['qin0']) 
     # Setup classical connection between nodes:
     c_conn1 = ClassicalConnectionA2B(length=node_distance)
@@ -59,111 +75,95 @@ def example_network_setup(node_distance=4e-3, depolar_rate=1e7):
     alice.ports['cin_bob'].connect(c_conn2.ports['B'])
     bob.ports['cout_alice'].connect(c_conn2.ports['A'])
     #Setup entangling connection between nodes:
-    q_conn = EntanglingConnection(length=node_distance, source_frequency=2e7)
+    q_conn = EntanglingConnection(length=node_distance, source_frequency=source_frequency, set_delay=delay, noise_model=noise_model)
     alice.ports['qin_charlie'].connect(q_conn.ports['A'])
     bob.ports['qin_charlie'].connect(q_conn.ports['B'])
     return alice, bob, q_conn
 
 
-def Compare_measurement(num_bits,stateList,opList):
-    matchList=[]
-    for i in range(0,num_bits):
-        if stateList[i]<2 and opList[i]==0:    #measure in standard basis
-            matchList.append(i)
-        elif stateList[i]>=2 and opList[i]==1: #measure in Hadamard basis
-            matchList.append(i)
-        else:
-            pass
-    return matchList
+def siftMask(states, bases):
+    #Rounds where Bob measured in the basis Alice prepared in
+    return (states >= 2) == (bases == 1)
+
+def windowSize(remaining, window):
+    #About two rounds are needed per sifted bit, so the last windows shrink
+    #towards what is still missing instead of overshooting the key length
+    return min(window, 2 * remaining + 16)
+
+def packedMessage(bits):
+    return Message([np.packbits(bits).tobytes()])
+
+def unpackMessage(port, count):
+    return np.unpackbits(np.frombuffer(port.rx_input().items[0], dtype=np.uint8), count=count)
 
 class AliceProtocol(NodeProtocol):
-    def __init__(self, node,length):
+    def __init__(self, node,length,window,rng=None):
         super().__init__(node)
-       # self.stateList, self.qlist=Create_random_qubits(1)
-        self.matchList=[]
+        self.rng=random if rng is None else rng
         self.length=length
+        self.window=window
         self.ent_swap=False
 
     def run(self):
-        self.key_A=[]
-        self.state=[]
-        self.qubitCounter=0
+        self.key_A=PackedBits(self.length)
+        states=np.empty(self.window, dtype=np.uint8)
         mem_pos = self.node.qmemory.unused_positions[0]
-        while True:
-                self.matchFlag=False
-                if self.qubitCounter<self.length*3:
-                    #Creates new qubit to be teleported
-                    qubit=create_qubits(1,system_name="Q")
-                    #Places in node memory
-                    self.node.qmemory.put(qubit,mem_pos)
-                    state=randint(0,3)
-                    #Random operation
-                    if   state == 0: # 0 state
-                        pass
-                    elif state == 1: # 1 state    #X
-                        self.node.qmemory.operate(ns.X,mem_pos)
-                    elif state == 2: # + state    #H
-                        self.node.qmemory.operate(ns.H,mem_pos)
-                    elif state == 3: # - state    #XH
-                        self.node.qmemory.operate(ns.X,mem_pos)
-                        self.node.qmemory.operate(ns.H,mem_pos)
-                    else :
-                        print("Create random bits ERROR!!")
-                    self.state.append(state)
-                    #print("ALICE: Waiting for Entanglement")
-                    #Waits for entanglement
-                    yield self.await_port_input(self.node.ports["qin_charlie"])
-                    #Completes Entanglement and does Bell Measurement
-                    self.node.qmemory.operate(ns.CNOT, [0, 1])
-                    self.node.qmemory.operate(ns.H,0)
-                    m, _ = self.node.qmemory.measure([0, 1])
-                    #Sends measurement to Bob for correction
-                    self.node.ports["cout_bob"].tx_output(m)
-                    self.qubitCounter+=1
-                    #print("ALICE: QUBIT ENTANGLED")
-                    #print("ALICE: WAITING FOR BOB QUBIT STATELIST")
-                else:
-                    yield self.await_port_input(self.node.ports["cin_bob"])
-                    #print("ALICE: RECEIVED BOB QUBIT STATELIST")
-                    meas_results = self.node.ports["cin_bob"].rx_input().items
-                    #Strips buffer from list if one is present
-                    if meas_results.count("")>0:
-                        meas_results.remove("")
-                    #Compares bits
-                    self.matchList=Compare_measurement(self.length*3,self.state,meas_results)
-                    #Confirms match is found
-                    self.node.ports["cout_bob"].tx_output(self.matchList)
-                    #print("ALICE: SENT MATCH LIST")
-                    for j in self.matchList:
-                        #print("ALICE: MATCH FOUND")
-                        if len(self.key_A)<self.length:
-                            self.key_A.append(self.state[j]%2) #quantum state 0,+:0    1,-:1
-                    #print("ALICE:WAITING FOR BOB TO FINISH PROCESS")
-                    #print(f"ALICE: Key Length={self.qubitCounter}
-                    print(f"{ns.sim_time():.1f}")
-                    break
+        while len(self.key_A)<self.length:
+            rounds=windowSize(self.length-len(self.key_A), self.window)
+            for i in range(rounds):
+                #Creates new qubit to be teleported
+                qubit=create_qubits(1,system_name="Q")
+                #Places in node memory
+                self.node.qmemory.put(qubit,mem_pos)
+                state=self.rng.randint(0,3)
+                #Random operation
+                if   state == 0: # 0 state
+                    pass
+                elif state == 1: # 1 state    #X
+                    self.node.qmemory.operate(ns.X,mem_pos)
+                elif state == 2: # + state    #H
+                    self.node.qmemory.operate(ns.H,mem_pos)
+                elif state == 3: # - state    #XH
+                    self.node.qmemory.operate(ns.X,mem_pos)
+                    self.node.qmemory.operate(ns.H,mem_pos)
+                states[i]=state
+                #Waits for entanglement
+                yield self.await_port_input(self.node.ports["qin_charlie"])
+                #Completes Entanglement and does Bell Measurement
+                self.node.qmemory.operate(ns.CNOT, [0, 1])
+                self.node.qmemory.operate(ns.H,0)
+                m, _ = self.node.qmemory.measure([0, 1])
+                #Sends measurement to Bob for correction
+                self.node.ports["cout_bob"].tx_output(m)
+            #Bit-packed bases of the window from Bob, bit-packed match mask back
+            yield self.await_port_input(self.node.ports["cin_bob"])
+            bases=unpackMessage(self.node.ports["cin_bob"], rounds)
+            match=siftMask(states[:rounds], bases)
+            self.node.ports["cout_bob"].tx_output(packedMessage(match))
+            self.key_A.extend((states[:rounds][match]%2)[:self.length-len(self.key_A)]) #quantum state 0,+:0    1,-:1
+            if len(self.key_A)<self.length:
+                #Waits until Bob is ready for the next window
+                yield self.await_port_input(self.node.ports["cin_bob"])
         #print(f"Key at Alice: {self.key_A}")
         #print("END OF ALICE PROTOCOL")
 
             
         
 class BobProtocol(NodeProtocol):
-    def __init__(self,node,length):
+    def __init__(self,node,length,window,rng=None):
         super().__init__(node)
+        self.rng=random if rng is None else rng
         self.length=length
-        self.qubitCounter=0
-        self.stateList=[]
-        self.result=[]
-        self.B_basis=[]
-        self.key_B=[]
-        self.tempQubit=create_qubits(1,system_name="Q")
+        self.window=window
         self.entanglements = 0
 
     def run(self):
-        while True:
-            if self.qubitCounter<length*3 and self.is_connected:
-                self.node.ports["cout_alice"].tx_output([])
-                #print("BOB:Waiting for Entanglement")
+        self.key_B=PackedBits(self.length)
+        bases=np.empty(self.window, dtype=np.uint8)
+        results=np.empty(self.window, dtype=np.uint8)
+        while len(self.key_B)<self.length and self.is_connected:
+            rounds=windowSize(self.length-len(self.key_B), self.window)
+            for i in range(rounds):
                 #Waiting for entanglement control qubit
                 yield self.await_port_input(self.node.ports["qin_charlie"])
                 self.entanglements += 1
@@ -175,46 +175,47 @@ class BobProtocol(NodeProtocol):
                     self.node.qmemory.operate(ns.Z, 0)
                 if meas_results[1]:
                     self.node.qmemory.operate(ns.X, 0)
-                #print("BOB:QUBIT ENTANGLED")
-                #Redording Fidelity strength
-                fidelity = ns.qubits.fidelity(self.node.qmemory.peek(0)[0],ns.y0, squared=True)
-                #print(f"{ns.sim_time():.1f}: Bob received entangled qubit and " f"corrections! Fidelity = {fidelity:.3f}")
-                r=randint(0,1)
+                r=self.rng.randint(0,1)
                 #Completeing random measure of qubit
                 if r == 0:
-                    self.result.append(self.node.qmemory.measure(observable=Z))
+                    results[i]=self.node.qmemory.measure(observable=Z)[0][0]
                 elif r==1:
-                    self.result.append(self.node.qmemory.measure(observable=X))
-                self.B_basis.append(r)
-                self.qubitCounter+=1
-            else:
-                if self.B_basis[1] == 0 or self.B_basis[1] == 1 or self.B_basis[1] == 2:
-                    # B send measurement
-                    #print("BOB:SENDING STATE LIST")
-                    self.node.ports["cout_alice"].tx_output(self.B_basis)
-                else :
-                    print("B measuring failed!!")
-                    print(self.B_basis[0])
-                #print("BOB: WAITING FOR MATCH LIST") 
-                #Waiting for  Match list from Alice
-                yield(self.await_port_input(self.node.ports["cin_alice"]))
-                #print("BOB: RECEIVED MATCH LIST")
-                matchList=self.node.ports["cin_alice"].rx_input().items
-                for j in matchList:
-                    if len(self.key_B)<self.length:
-                        self.key_B.append(self.result[int(j)][0])
-                break
+                    results[i]=self.node.qmemory.measure(observable=X)[0][0]
+                bases[i]=r
+            self.node.ports["cout_alice"].tx_output(packedMessage(bases[:rounds]))
+            #Waiting for match mask from Alice
+            yield(self.await_port_input(self.node.ports["cin_alice"]))
+            match=unpackMessage(self.node.ports["cin_alice"], rounds).astype(bool)
+            self.key_B.extend(results[:rounds][match][:self.length-len(self.key_B)])
+            if len(self.key_B)<self.length:
+                #Sending buffer to inform Alice Bob is ready for next window
+                self.node.ports["cout_alice"].tx_output("")
         #print(f"Key at BOB: {self.key_B}")
-        print(self.entanglements)
         ns.sim_stop()
         #print("END OF BOB PROTOCOL")
-#print("Please input length of key:")
-length= int(sys.argv[1])
-#length=
-ns.set_qstate_formalism(ns.QFormalism.DM)
-alice, bob, qconn = example_network_setup()
-aliceProtocol=AliceProtocol(alice,length).start()
-bobProtocol=BobProtocol(bob,length).start()
-stats = ns.sim_run(6000000)
-    
 
+def runBatch(length, window=1024, formalism="DM", node_distance=4e-3, depolar_rate=None, source_frequency=2e7, delay=1e9, streams=None):
+    #One run; streams of QKD_seeding.runStreams make it reproducible.  Bob
+    #waits for the Bell result of a round before he takes the next qubit, so
+    #it has to arrive within one source period
+    timing = linkTiming(node_distance, source_frequency, delay)
+    if timing["cDelay"] >= timing["period"]:
+        raise ValueError(f"the classical delay of {timing['cDelay']:.0f} ns is not shorter than the source period "
+                         f"of {timing['period']:.0f} ns, the batch engine runs in lock-step; use the des engine with a window")
+    ns.sim_reset()
+    if streams is not None and streams["netsquid"] is not None:
+        ns.set_random_state(seed=streams["netsquid"])
+    rng = None if streams is None else streams["python"]
+    setFormalism(formalism)
+    alice, bob, qconn = example_network_setup(node_distance, depolar_rate, source_frequency, delay, formalism=formalism)
+    aliceProtocol=AliceProtocol(alice,length,window,rng).start()
+    bobProtocol=BobProtocol(bob,length,window,rng).start()
+    stats = ns.sim_run(6000000000000)
+    errors=aliceProtocol.key_A.hamming(bobProtocol.key_B)
+    return {"key_A": aliceProtocol.key_A, "key_B": bobProtocol.key_B, "qber": errors/length, "simTime": ns.sim_time(),
+            "entanglements": bobProtocol.entanglements, "latency": None, "events": simEventCount(stats)}
+
+if __name__ == "__main__":
+    [inputArgs, args] = addParserOptions()
+    result = runBatch(int(args[0]), inputArgs.window, inputArgs.formalism)
+    print(runSummary(result["qber"], result["simTime"], result["entanglements"], result["events"]))
@@ -0,0 +1,214 @@
+#! usr/bin/python3
+# Adaptive two-dimensional sweep.  Instead of a fixed grid it starts from a
+# coarse grid over two parameters (quantumNoise x nodeDistance by default, on
+# log axes when they span two decades or more) and refines a quadtree: the cell
+# whose corners differ most splits into four, which adds its centre and edge
+# midpoints.  The score of a cell is its size times the spread of QBER (or of
+# log10 key rate) over its corners beyond the binomial noise of the runs, plus a
+# share of that noise, so the transition gets the points and flat regions at
+# QBER 0 or 0.5 do not.  Refinement stops at the run budget.
+#
+# Points are run by a pluggable runner, a function from a list of points to
+# their summaries.  sweepRunner uses QKD_sweep.runPoints (process pool, reused
+# networks, result cache); modelRunner uses the QKD_model.py surrogate for dry
+# runs of the refinement.
+import heapq
+import math
+import time
+from optparse import OptionParser
+import numpy as np
+from QKD_sweep import GRID_KEYS, runPoints, writeSummary
+
+METRICS = ["qber", "keyRate"]
+RUNNERS = ["sweep", "model"]
+
+def addParserOptions():
+    parser = OptionParser(usage="%prog [options]  (axes take lo:hi, the other grid options a single value)")
+    parser.add_option("-x", "--xAxis", default = "quantumNoise", choices = GRID_KEYS,
+                      dest = "xAxis", type = "choice", help = "first refined parameter")
+    parser.add_option("-y", "--yAxis", default = "nodeDistance", choices = GRID_KEYS,
+                      dest = "yAxis", type = "choice", help = "second refined parameter")
+    parser.add_option("-l", "--length", default = "1024",
+                      dest = "length", help = "key length")
+    parser.add_option("-n", "--quantumNoise", default = "1:1e9",
+                      dest = "quantumNoise", help = "rate of depolar and dephase errors")
+    parser.add_option("-f", "--sourceFrequency", default = "2e7",
+                      dest = "sourceFrequency", help = "rate of entanglement pairs")
+    parser.add_option("-t", "--delay", default = "1e9",
+                      dest = "setDelay", help = "delay, based on fraction of source frequency")
+    parser.add_option("-d", "--distance", default = "1:1e6",
+                      dest = "nodeDistance", help = "distance between nodes")
+    parser.add_option("-S", "--segments", default = "1",
+                      dest = "segments", help = "repeater chain segments")
+    parser.add_option("-c", "--coarse", default = 5,
+                      dest = "coarse", type = "int", help = "points per axis of the starting grid")
+    parser.add_option("-b", "--budget", default = 200,
+                      dest = "budget", type = "int", help = "total number of runs")
+    parser.add_option("--batch", default = 4,
+                      dest = "batch", type = "int", help = "cells refined per round, their points run in parallel")
+    parser.add_option("--depth", default = 8,
+                      dest = "depth", type = "int", help = "maximum number of splits of a cell")
+    parser.add_option("-m", "--metric", default = "qber", choices = METRICS,
+                      dest = "metric", type = "choice", help = "refine on qber or on log10 key rate")
+    parser.add_option("--noiseWeight", default = 0.5,
+                      dest = "noiseWeight", type = "float", help = "weight of the binomial uncertainty in the score")
+    parser.add_option("--linear", default = False, action = "store_true",
+                      dest = "linear", help = "split the axes linearly instead of on a log scale")
+    parser.add_option("--runner", default = "sweep", choices = RUNNERS,
+                      dest = "runner", type = "choice", help = "sweep (simulations) or model (analytical surrogate)")
+    parser.add_option("-e", "--engine", default = "des", choices = ["des", "fast"],
+                      dest = "engine", type = "choice", help = "engine used for every point")
+    parser.add_option("-w", "--window", default = 0,
+                      dest = "window", type = "int", help = "pipelined protocol window, 0 for stop-and-wait")
+    parser.add_option("-s", "--seed", default = None,
+                      dest = "seed", type = "int", help = "base seed of the runs")
+    parser.add_option("-p", "--processes", default = None,
+                      dest = "processes", type = "int", help = "number of worker processes")
+    parser.add_option("--cache", default = ".qkd_cache",
+                      dest = "cache", help = "folder of the result cache, empty string to disable")
+    parser.add_option("-o", "--output", default = "adaptive.csv",
+                      dest = "output", help = "summary file of all points")
+    return parser.parse_args()
+
+def sweepRunner(processes=None, cache=None, reuse=True):
+    def run(points):
+        summaries = {}
+        for point, summary, cached in runPoints(points, processes, cache=cache, reuse=reuse):
+            summaries[id(point)] = summary
+        return [summaries[id(point)] for point in points]
+    return run
+
+def modelRunner():
+    from QKD_model import GRID_KEYS as MODEL_KEYS, predict
+    def run(points):
+        model = predict(*[np.array([point[key] for point in points]) for key in MODEL_KEYS])
+        columns = {key: np.broadcast_to(model[key], (len(points),)) for key in ("qber", "simTime", "entanglements", "latency")}
+        return [{key: float(values[i]) for key, values in columns.items()} for i in range(len(points))]
+    return run
+
+class Axis:
+    #Maps a parameter range to [0, 1], on a log scale when it spans >= 2 decades
+    def __init__(self, name, low, high, linear=False):
+        self.name = name
+        self.log = not linear and low > 0 and high / low >= 100
+        self.low, self.high = (math.log10(low), math.log10(high)) if self.log else (low, high)
+        self.cast = int if name in ("length", "segments") else float
+
+    def value(self, u):
+        value = self.low + u * (self.high - self.low)
+        return self.cast(10 ** value if self.log else value)
+
+class AdaptiveSweep:
+    def __init__(self, xAxis, yAxis, base, runner, metric="qber", noiseWeight=0.5, depth=8):
+        self.axes = (xAxis, yAxis)
+        self.base = base
+        self.runner = runner
+        self.metric = metric
+        self.noiseWeight = noiseWeight
+        self.depth = depth
+        #(u, v) in units of the finest cell -> (point, summary)
+        self.scale = 2 ** depth
+        self.results = {}
+        self.cells = []
+        self.runs = 0
+
+    def point(self, corner):
+        point = dict(self.base)
+        for axis, u in zip(self.axes, corner):
+            point[axis.name] = axis.value(u / self.scale)
+        return point
+
+    def evaluate(self, corners):
+        #Runs the corners not seen yet, all in one call of the runner
+        missing = [corner for corner in dict.fromkeys(corners) if corner not in self.results]
+        points = [self.point(corner) for corner in missing]
+        for corner, point, summary in zip(missing, points, self.runner(points) if points else []):
+            self.results[corner] = (point, summary)
+        self.runs += len(missing)
+
+    def value(self, corner):
+        point, summary = self.results[corner]
+        if self.metric == "qber":
+            qber = summary["qber"]
+            return qber, math.sqrt(max(qber * (1 - qber), 1 / point["length"]) / point["length"])
+        rate = point["length"] / summary["simTime"] * 1e9 if summary.get("simTime") else 0.0
+        return math.log10(max(rate, 1e-12)), 0.0
+
+    def score(self, cell):
+        level, u, v = cell
+        size = self.scale >> level
+        values, noise = zip(*(self.value(corner) for corner in self.corners(cell)))
+        spread = max(values) - min(values)
+        return size / self.scale * (max(0.0, spread - 2 * max(noise)) + self.noiseWeight * max(noise))
+
+    def corners(self, cell):
+        level, u, v = cell
+        size = self.scale >> level
+        return [(u, v), (u + size, v), (u, v + size), (u + size, v + size)]
+
+    def children(self, cell):
+        level, u, v = cell
+        half = (self.scale >> level) // 2
+        return [(level + 1, u + du, v + dv) for du in (0, half) for dv in (0, half)]
+
+    def push(self, cell):
+        if cell[0] < self.depth:
+            heapq.heappush(self.cells, (-self.score(cell), cell))
+
+    def start(self, coarse):
+        #Coarse grid: coarse - 1 cells per axis, rounded to a power of two
+        level = max(1, math.ceil(math.log2(max(coarse - 1, 1))))
+        step = self.scale >> level
+        cells = [(level, u, v) for u in range(0, self.scale, step) for v in range(0, self.scale, step)]
+        self.evaluate([corner for cell in cells for corner in self.corners(cell)])
+        for cell in cells:
+            self.push(cell)
+
+    def refine(self, budget, batch=4):
+        while self.cells and self.runs < budget:
+            chosen = [heapq.heappop(self.cells)[1] for _ in range(min(batch, len(self.cells)))]
+            children = [child for cell in chosen for child in self.children(cell)]
+            corners = [corner for child in children for corner in self.corners(child) if corner not in self.results]
+            if self.runs + len(set(corners)) > budget:
+                #Not enough budget for the whole batch, refine the best cell alone
+                chosen, rest = chosen[:1], chosen[1:]
+                for cell in rest:
+                    self.push(cell)
+                children = self.children(chosen[0])
+                corners = [corner for child in children for corner in self.corners(child) if corner not in self.results]
+                if self.runs + len(set(corners)) > budget:
+                    break
+            self.evaluate(corners)
+            for child in children:
+                self.push(child)
+
+    def rows(self):
+        return [self.results[corner] for corner in sorted(self.results)]
+
+def basePoint(options):
+    #Fixed parameters take their (first) value, the axes are set per point
+    point = {key: (int if key in ("length", "segments") else float)(float(str(getattr(options, key)).split(":")[0].split(",")[0]))
+             for key in GRID_KEYS}
+    point.update(engine=options.engine, window=options.window, formalism="DM", seed=options.seed, replica=0,
+                 qberSample=0.0, qberWidth=0.0, qberAbort=None)
+    return point
+
+def axisRange(options, name, linear):
+    low, high = (float(value) for value in str(getattr(options, name)).split(":")[:2])
+    return Axis(name, low, high, linear)
+
+if __name__ == "__main__":
+    [inputArgs, args] = addParserOptions()
+    if inputArgs.runner == "model":
+        runner = modelRunner()
+    else:
+        from QKD_cache import ResultCache
+        runner = sweepRunner(inputArgs.processes, ResultCache(inputArgs.cache) if inputArgs.cache else None)
+    sweep = AdaptiveSweep(axisRange(inputArgs, inputArgs.xAxis, inputArgs.linear), axisRange(inputArgs, inputArgs.yAxis, inputArgs.linear),
+                          basePoint(inputArgs), runner, inputArgs.metric, inputArgs.noiseWeight, inputArgs.depth)
+    start = time.perf_counter()
+    sweep.start(inputArgs.coarse)
+    print(f"Coarse grid: {sweep.runs} runs")
+    sweep.refine(inputArgs.budget, inputArgs.batch)
+    print(f"Refined to {sweep.runs} runs in {time.perf_counter() - start:.1f} s, {len(sweep.cells)} cells open")
+    writeSummary(inputArgs.output, sweep.rows())
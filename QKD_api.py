@@ -0,0 +1,140 @@
+#! usr/bin/python3
+# Library entry point of the QKD engines.  run_qkd(params) runs one key of any
+# engine and returns a Result, a dict whose entries are also attributes (qber,
+# simTime, entanglements, key_A, key_B, writer, ...); params is a dict or
+# optparse Values, missing entries take DEFAULTS and keyword arguments override
+# them.  Nothing heavy is imported up front: NetSquid is loaded by the first des,
+# batch or event run and SQUANCH by the first squanch run, so the fast engine
+# and --help start without either.  QKD_ENT.py is a thin wrapper around main().
+from optparse import OptionParser, Values
+from QKD_profile import Profiler, NULL_PROFILER
+from QKD_qber import INTERVALS as QBER_INTERVALS
+
+ENGINES = ["des", "fast", "squanch", "batch", "event"]
+#Names of QKD_formalism.FORMALISMS, QKD_fidelity.MODES and QKD_cascade.METHODS,
+#those modules import NetSquid or NumPy.  A whole-key run never calls
+#FidelityTracker.request(), so it has no demand mode; QKD_stream.py does.
+FORMALISMS = ["DM", "KET", "STAB"]
+FIDELITY_MODES = ["off", "sample"]
+RECONCILE_METHODS = ["cascade", "ldpc"]
+DEFAULTS = {"length": 4, "quantumNoise": 1e7, "sourceFrequency": 2e7, "setDelay": 1e9, "nodeDistance": 1,
+            "engine": "des", "window": 0, "segments": 1, "formalism": "DM", "fidelity": "sample",
+            "fidelityEvery": 100}
+
+def addParserOptions():
+    parser = OptionParser()
+    parser.add_option("-l", "--length",
+                      dest = "length", type = "int", help="Set length of secret key", default = 4)
+    parser.add_option("-n", "--quantumNoise", default = 1e7,
+                      dest = "quantumNoise", type = "int", help = "rate of depolar and dephase errors")
+    parser.add_option("-f", "--sourceFrequency", default = 2e7,
+                      dest = "sourceFrequency", type = "int", help = "rate of entanglement pairs")
+    parser.add_option("-t", "--delay", default = 1e9,
+                      dest = "setDelay", type = "int", help = "based on fraction of source frequency")
+    parser.add_option("-d", "--distance", default = 1,
+                      dest = "nodeDistance", type = "float", help = "Distance between nodes")
+    parser.add_option("-e", "--engine", default = "des", choices = ENGINES,
+                      dest = "engine", type = "choice", help = "des: NetSquid simulation, fast: vectorized NumPy engine, squanch: SQUANCH, batch/event: windowed and event driven NetSquid protocols")
+    parser.add_option("-w", "--window", default = 0,
+                      dest = "window", type = "int", help = "qubits in flight and Bob memory size of the pipelined protocol, 0 for stop-and-wait, must exceed the classical delay in source periods (des engine); rounds in flight (event engine, 0: the whole round trip); rounds per window (batch engine, 0: 1024)")
+    parser.add_option("-S", "--segments", default = 1,
+                      dest = "segments", type = "int", help = "segments of a repeater chain between Alice and Bob, uses the pipelined protocol (des engine)")
+    parser.add_option("--formalism", default = "DM", choices = FORMALISMS,
+                      dest = "formalism", type = "choice", help = "quantum state formalism: DM, KET or STAB (stochastic noise)")
+    parser.add_option("--fidelity", default = DEFAULTS["fidelity"], choices = FIDELITY_MODES,
+                      dest = "fidelity", type = "choice", help = "fidelity tracking: off or sample (every N-th round)")
+    parser.add_option("--fidelityEvery", default = DEFAULTS["fidelityEvery"],
+                      dest = "fidelityEvery", type = "int", help = "rounds between fidelity samples")
+    parser.add_option("--chunk", default = 4096,
+                      dest = "chunk", type = "int", help = "systems per QStream (squanch engine)")
+    parser.add_option("--parallel", default = 1,
+                      dest = "parallel", type = "int", help = "chunks simulated at the same time (squanch engine)")
+    parser.add_option("--queue", default = 4,
+                      dest = "queue", type = "int", help = "prepared data qubits Alice keeps in memory (event engine)")
+    parser.add_option("--reconcile", default = "none", choices = ["none"] + RECONCILE_METHODS,
+                      dest = "reconcile", type = "choice", help = "error correction of the sifted keys: none, cascade or ldpc")
+    parser.add_option("--amplify", default = False, action = "store_true",
+                      dest = "amplify", help = "privacy amplification of the (reconciled) keys by Toeplitz hashing")
+    parser.add_option("--paBlock", default = 1 << 20,
+                      dest = "paBlock", type = "int", help = "key bits per Toeplitz hashing block")
+    parser.add_option("--qberSample", default = 0.0,
+                      dest = "qberSample", type = "float", help = "fraction of sifted bits sacrificed for the streaming QBER estimate, 0 disables it")
+    parser.add_option("--qberConfidence", default = 0.95,
+                      dest = "qberConfidence", type = "float", help = "confidence level of the QBER interval")
+    parser.add_option("--qberInterval", default = "clopper", choices = QBER_INTERVALS,
+                      dest = "qberInterval", type = "choice", help = "QBER interval: clopper (Clopper-Pearson) or wilson")
+    parser.add_option("--qberWidth", default = 0.0,
+                      dest = "qberWidth", type = "float", help = "stop the run once the QBER interval half-width is below this (des engine)")
+    parser.add_option("--qberAbort", default = None,
+                      dest = "qberAbort", type = "float", help = "stop the run once QBER is above this with the given confidence (des engine)")
+    parser.add_option("--profile", default = None,
+                      dest = "profile", help = "profile the phases of the run, print a summary and write collapsed stacks to this file")
+    parser.add_option("-s", "--seed", default = None,
+                      dest = "seed", type = "int", help = "base seed, makes the run reproducible")
+    parser.add_option("-r", "--replica", default = 0,
+                      dest = "replica", type = "int", help = "replica index, selects an independent stream of the seed")
+    parser.add_option("-o", "--output", default = None,
+                      dest = "output", help = "result file of the run, .csv or .npz (default: generated name)")
+    parser.add_option("--format", default = "csv", choices = ["csv", "npz"],
+                      dest = "format", type = "choice", help = "file format when no output file is given")
+    return parser.parse_args()
+
+
+class Result(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+def run_qkd(params=None, writer=None, profiler=NULL_PROFILER, **overrides):
+    if isinstance(params, Values):
+        params = vars(params)
+    params = Values({**DEFAULTS, **(params or {}), **overrides})
+    if params.engine not in ENGINES:
+        raise ValueError(f"unknown engine {params.engine}")
+    if params.engine == "des":
+        from QKD_ENT import runQKD
+        return Result(runQKD(params, writer, profiler=profiler))
+    from QKD_distill import runFastQKD, distill
+    if params.engine == "fast":
+        return Result(runFastQKD(params, writer, profiler))
+    if getattr(params, "segments", 1) > 1:
+        raise ValueError("repeater chains need the des engine")
+    from QKD_results import ResultWriter, runParams
+    from QKD_seeding import runStreams
+    if writer is None:
+        writer = ResultWriter(runParams(params))
+    streams = runStreams(getattr(params, "seed", None), getattr(params, "replica", 0))
+    with profiler.phase("simulate"):
+        if params.engine == "squanch":
+            from SquanchQKD import runSquanch
+            result = runSquanch(params.length, params.quantumNoise, params.sourceFrequency, params.setDelay, params.nodeDistance,
+                                getattr(params, "chunk", 4096), getattr(params, "parallel", 1), streams["numpy"])
+        elif params.engine == "batch":
+            from QKD_ENT_batch import runBatch
+            result = runBatch(params.length, params.window or 1024, params.formalism, params.nodeDistance/10000, params.quantumNoise,
+                              params.sourceFrequency, params.setDelay, streams)
+        else:
+            from QKD_ENT_EVENT import runEvent
+            result = runEvent(params.length, getattr(params, "queue", 4), params.formalism, params.nodeDistance/10000, params.quantumNoise,
+                              params.sourceFrequency, params.setDelay, streams, getattr(params, "window", 0))
+    return Result(distill(params, result, writer, streams, profiler))
+
+def main():
+    [inputArgs, args] = addParserOptions()
+    from QKD_results import runFilename, runParams
+    from QKD_simstats import runSummary
+    profiler = Profiler() if inputArgs.profile else NULL_PROFILER
+    result = run_qkd(inputArgs, profiler=profiler)
+    output = inputArgs.output or runFilename(".", runParams(inputArgs), inputArgs.format)
+    with profiler.phase("write"):
+        result.writer.flush(output)
+    print(runSummary(result.qber, result.simTime, result.entanglements, result.get('events')) + f"  Results: {output}")
+    if inputArgs.profile:
+        print(profiler.summary(result.get('events')))
+        profiler.write(inputArgs.profile)
+        print(f"Collapsed stacks: {inputArgs.profile}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#! usr/bin/python3
+# Wall-clock benchmark of the QKD engines.  Every measurement runs in its own
+# process, so peak RSS and start-up cost are those of a single run:
+#   des, fast - QKD_api.py with -e des / -e fast at every noise:distance point
+#   squanch   - SquanchQKD.py at every noise:distance point
+#   batch     - QKD_ENT_batch.py (fixed built-in network)
+#   event     - QKD_ENT_EVENT.py (fixed built-in network)
+# The report is written as JSON and printed as a table of sifted bits per
+# wall-second.  With -c a previous report is compared and slow-downs flagged.
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+from QKD_sweep import parseRange
+
+ENGINES = ["des", "fast", "squanch", "batch", "event"]
+#Engines that take the noise:distance points
+POINT_ENGINES = ["des", "fast", "squanch"]
+SUMMARY = re.compile(r"QBER: (\S+)\s+Sim_time: (\S+)\s+Entanglements: (\S+)\s+Events: (\S+)")
+
+def addParserOptions():
+    parser = OptionParser()
+    parser.add_option("-e", "--engines", default = ",".join(ENGINES),
+                      dest = "engines", help = "comma separated engines to run")
+    parser.add_option("-l", "--length", default = "2:65536:*2",
+                      dest = "length", help = "key lengths, a,b,c or start:stop:*k")
+    parser.add_option("-p", "--points", default = "1e7:1,1e7:1000,1e9:1",
+                      dest = "points", help = "comma separated noise:distance points")
+    parser.add_option("-r", "--repeat", default = 1,
+                      dest = "repeat", type = "int", help = "runs per measurement, the fastest is kept")
+    parser.add_option("--timeout", default = 3600,
+                      dest = "timeout", type = "float", help = "seconds before a run is abandoned")
+    parser.add_option("-o", "--output", default = "benchmark.json",
+                      dest = "output", help = "report file")
+    parser.add_option("-c", "--compare", default = None,
+                      dest = "compare", help = "earlier report to check for regressions")
+    parser.add_option("--tolerance", default = 1.25,
+                      dest = "tolerance", type = "float", help = "wall time ratio above which a run counts as regression")
+    return parser.parse_args()
+
+def engineCommand(engine, length, noise, distance, folder):
+    here = os.path.dirname(os.path.abspath(__file__))
+    if engine in ("des", "fast"):
+        return [sys.executable, os.path.join(here, "QKD_api.py"), "-l", str(length), "-n", str(int(noise)),
+                "-d", str(distance), "-e", engine, "--fidelity", "off", "-o", os.path.join(folder, "run.npz")]
+    if engine == "squanch":
+        return [sys.executable, os.path.join(here, "SquanchQKD.py"), "-l", str(length), "-n", str(int(noise)),
+                "-d", str(distance), "-o", os.path.join(folder, "run.npz")]
+    script = {"batch": "QKD_ENT_batch.py", "event": "QKD_ENT_EVENT.py"}[engine]
+    return [sys.executable, os.path.join(here, script), str(length)]
+
+def measure(command, timeout):
+    #Runs one child and returns wall time, its own peak RSS [MB] and its output
+    with tempfile.TemporaryFile() as out:
+        start = time.perf_counter()
+        child = subprocess.Popen(command, stdout=out, stderr=subprocess.STDOUT)
+        deadline = start + timeout
+        while True:
+            pid, status, usage = os.wait4(child.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.perf_counter() > deadline:
+                child.kill()
+                pid, status, usage = os.wait4(child.pid, 0)
+                break
+            time.sleep(0.01)
+        wall = time.perf_counter() - start
+        out.seek(0)
+        text = out.read().decode(errors="replace")
+    return wall, usage.ru_maxrss / 1024, os.waitstatus_to_exitcode(status), text
+
+def runBenchmark(engines, lengths, points, repeat, timeout):
+    records = []
+    with tempfile.TemporaryDirectory() as folder:
+        for engine in engines:
+            enginePoints = points if engine in POINT_ENGINES else [(None, None)]
+            for noise, distance in enginePoints:
+                for length in lengths:
+                    best = None
+                    for _ in range(repeat):
+                        wall, rss, code, text = measure(engineCommand(engine, length, noise, distance, folder), timeout)
+                        if best is None or wall < best[0]:
+                            best = (wall, rss, code, text)
+                    wall, rss, code, text = best
+                    found = SUMMARY.search(text)
+                    record = {"engine": engine, "length": length, "quantumNoise": noise, "nodeDistance": distance,
+                              "wallTime": wall, "peakRSS": rss, "ok": code == 0 and found is not None,
+                              "qber": None, "simTime": None, "events": None, "bitsPerSecond": None}
+                    if record["ok"]:
+                        record.update(qber=float(found.group(1)), simTime=float(found.group(2)),
+                                      events=None if found.group(4) == "None" else int(found.group(4)),
+                                      bitsPerSecond=length / wall)
+                    print(f"{engine:>6} n={noise} d={distance} l={length}: {wall:.3f} s, {rss:.1f} MB"
+                          + ("" if record["ok"] else "  FAILED"))
+                    records.append(record)
+    return records
+
+def recordKey(record):
+    return (record["engine"], record["length"], record["quantumNoise"], record["nodeDistance"])
+
+def comparisonTable(records):
+    #Sifted bits per wall-second, one column per engine and point
+    columns = sorted({(r["engine"], r["quantumNoise"], r["nodeDistance"]) for r in records}, key=str)
+    cells = {recordKey(r): r for r in records}
+    labels = [engine if noise is None else f"{engine} {noise:g}/{distance:g}" for engine, noise, distance in columns]
+    width = max(12, max(len(label) for label in labels) + 2)
+    lines = ["length".rjust(8) + "".join(label.rjust(width) for label in labels)]
+    for length in sorted({r["length"] for r in records}):
+        line = str(length).rjust(8)
+        for engine, noise, distance in columns:
+            record = cells.get((engine, length, noise, distance))
+            value = "-" if record is None or record["bitsPerSecond"] is None else f"{record['bitsPerSecond']:.4g}"
+            line += value.rjust(width)
+        lines.append(line)
+    return "\n".join(lines)
+
+def regressions(records, baseline, tolerance):
+    previous = {recordKey(r): r for r in baseline["results"]}
+    found = []
+    for record in records:
+        old = previous.get(recordKey(record))
+        if old and old["ok"] and record["ok"] and record["wallTime"] > tolerance * old["wallTime"]:
+            found.append((record, old["wallTime"]))
+    return found
+
+if __name__ == "__main__":
+    [inputArgs, args] = addParserOptions()
+    engines = inputArgs.engines.split(",")
+    lengths = parseRange(inputArgs.length, int)
+    points = [tuple(float(v) for v in point.split(":")) for point in inputArgs.points.split(",")]
+    records = runBenchmark(engines, lengths, points, inputArgs.repeat, inputArgs.timeout)
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    report = {"meta": {"python": platform.python_version(), "machine": platform.machine(),
+                       "processor": platform.processor(), "cpus": os.cpu_count(), "commit": commit,
+                       "date": time.strftime("%Y-%m-%d %H:%M:%S")},
+              "results": records}
+    with open(inputArgs.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("\nSifted bits per wall-second (engine noise/distance)")
+    print(comparisonTable(records))
+    if inputArgs.compare:
+        with open(inputArgs.compare) as f:
+            slow = regressions(records, json.load(f), inputArgs.tolerance)
+        for record, oldWall in slow:
+            print(f"REGRESSION {record['engine']} l={record['length']} n={record['quantumNoise']} "
+                  f"d={record['nodeDistance']}: {oldWall:.3f} s -> {record['wallTime']:.3f} s")
+        if slow:
+            sys.exit(1)
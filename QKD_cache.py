@@ -0,0 +1,114 @@
+#! usr/bin/python3
+# Persistent on-disk cache of run summaries.  An entry is keyed by the SHA-256
+# of the full parameter set plus a version hash of the source files of the
+# engine, so results of changed code are never returned.  Entries are small JSON
+# files; a hit refreshes the modification time and the least recently used
+# entries are removed once the cache grows beyond its size limit.
+import ast
+import hashlib
+import json
+import os
+
+#Parameters that identify a run
+CACHE_PARAMS = ["length", "quantumNoise", "sourceFrequency", "setDelay", "nodeDistance",
+                "engine", "window", "segments", "formalism", "seed", "replica", "qberSample", "qberWidth", "qberAbort"]
+#Entry modules of an engine; every local module they import, directly or
+#inside functions, is part of its code version
+ENGINE_ENTRIES = {"des": ["QKD_worker.py"], "fast": ["QKD_distill.py"]}
+
+codeVersions = {}
+
+def localImports(here, name):
+    #File names of the modules of this folder imported anywhere in the file
+    with open(os.path.join(here, name), 'rb') as f:
+        tree = ast.parse(f.read(), name)
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.add(node.module)
+    return [module + ".py" for module in modules if os.path.isfile(os.path.join(here, module + ".py"))]
+
+def engineSources(engine, here):
+    sources = set()
+    pending = list(ENGINE_ENTRIES.get(engine, ENGINE_ENTRIES["des"]))
+    while pending:
+        name = pending.pop()
+        if name not in sources:
+            sources.add(name)
+            pending.extend(localImports(here, name))
+    return sorted(sources)
+
+def codeVersion(engine):
+    if engine not in codeVersions:
+        digest = hashlib.sha256()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in engineSources(engine, here):
+            digest.update(name.encode())
+            with open(os.path.join(here, name), 'rb') as f:
+                digest.update(f.read())
+        codeVersions[engine] = digest.hexdigest()[:16]
+    return codeVersions[engine]
+
+def canonical(value):
+    #1e7, 10000000 and 10000000.0 must give the same key
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+def paramKey(params):
+    point = {key: canonical(params.get(key)) for key in CACHE_PARAMS}
+    point["code"] = codeVersion(point["engine"] or "des")
+    return hashlib.sha256(json.dumps(point, sort_keys=True).encode()).hexdigest()
+
+class ResultCache:
+    def __init__(self, folder=".qkd_cache", maxBytes=256 * 2**20):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.size = None
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key + ".json")
+
+    def get(self, params):
+        path = self.path(paramKey(params))
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        return entry["result"]
+
+    def put(self, params, result):
+        path = self.path(paramKey(params))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, 'w') as f:
+            json.dump({"params": params, "result": result}, f, default=float)
+        os.replace(temp, path)
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        else:
+            self.size += os.path.getsize(path)
+        if self.size > self.maxBytes:
+            self.evict()
+
+    def entries(self):
+        for folder, _, files in os.walk(self.folder):
+            for name in files:
+                if name.endswith(".json"):
+                    info = os.stat(os.path.join(folder, name))
+                    yield os.path.join(folder, name), info.st_size, info.st_mtime
+
+    def evict(self):
+        #Removes least recently used entries down to 90% of the limit
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.size <= 0.9 * self.maxBytes:
+                break
+            os.remove(path)
+            self.size -= size
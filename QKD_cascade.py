@@ -0,0 +1,276 @@
+#! usr/bin/python3
+# Information reconciliation of the sifted keys.
+#
+# cascade - the Cascade protocol.  Both keys are kept bit-packed in the order
+#           of every pass with a prefix XOR over the bytes, so the parity of
+#           any block or half block is a few byte lookups, and all odd blocks
+#           of a pass are bisected together: one classical round trip per
+#           bisection level instead of one per block.  Blocks start at
+#           0.73/QBER bits and double every pass; corrections cascade back into
+#           the earlier passes until every block parity agrees.
+# ldpc    - one-way syndrome reconciliation with a random column-weight-3 LDPC
+#           code sized from the binary entropy of the QBER, decoded with
+#           layered normalized min-sum on all frames at once.  A 32 bit random
+#           parity hash of every frame catches wrong codewords; frames that do
+#           not converge or fail the hash get more syndrome bits and are
+#           decoded again, up to three times, before they are dropped.
+#
+# Both return the corrected keys with leaked bits, round trips and throughput.
+import math
+import time
+import numpy as np
+
+def binaryEntropy(p):
+    if p <= 0 or p >= 1:
+        return 0.0
+    return -p * math.log2(p) - (1 - p) * math.log2(1 - p)
+
+#Parity of every byte value, and the leading r bits of a byte
+PARITY = np.array([bin(i).count("1") & 1 for i in range(256)], dtype=np.uint8)
+HEAD_MASK = np.array([(0xFF00 >> r) & 0xFF for r in range(8)], dtype=np.uint8)
+
+class PackedParity:
+    #Parities of bit ranges of a bit-packed key (numpy.packbits order).  The
+    #prefix XOR of the bytes covers the whole bytes before a position, the
+    #leading bits of its own byte are masked, so parity(bits[:i]) is two
+    #lookups for any array of positions.  Flips mark the prefix stale, it is
+    #rebuilt over n/8 bytes on the next query.
+    def __init__(self, bits):
+        self.packed = np.zeros(bits.size // 8 + 1, dtype=np.uint8)
+        packed = np.packbits(bits)
+        self.packed[:packed.size] = packed
+        self.prefix = None
+
+    def flip(self, positions):
+        np.bitwise_xor.at(self.packed, positions >> 3, (0x80 >> (positions & 7)).astype(np.uint8))
+        self.prefix = None
+
+    def __getitem__(self, index):
+        if self.prefix is None:
+            self.prefix = np.zeros(self.packed.size + 1, dtype=np.uint8)
+            np.bitwise_xor.accumulate(self.packed, out=self.prefix[1:])
+        return PARITY[self.prefix[index >> 3] ^ (self.packed[index >> 3] & HEAD_MASK[index & 7])]
+
+def bisect(lo, hi, parityA, parityB):
+    #Narrows every interval with odd parity difference down to one error, all
+    #intervals in parallel.  Returns positions, leaked parities and round trips.
+    leaked = 0
+    trips = 0
+    while True:
+        active = np.flatnonzero(hi - lo > 1)
+        if active.size == 0:
+            return lo, leaked, trips
+        l, h = lo[active], hi[active]
+        mid = (l + h) // 2
+        left = (parityA[mid] ^ parityA[l]) != (parityB[mid] ^ parityB[l])
+        hi[active] = np.where(left, mid, h)
+        lo[active] = np.where(left, l, mid)
+        leaked += active.size
+        trips += 1
+
+def cascade(keyA, keyB, qber, passes=4, rng=None):
+    start = time.perf_counter()
+    rng = np.random.default_rng() if rng is None else rng
+    keyA = np.asarray(keyA, dtype=np.uint8)
+    corrected = np.array(keyB, dtype=np.uint8)
+    n = keyA.size
+    if n == 0:
+        #Nothing to reconcile, e.g. every sifted bit went to the QBER sample
+        return {"key_A": keyA, "key_B": corrected, "leakedBits": 0, "roundTrips": 0, "residualErrors": 0,
+                "discardedBits": 0, "seconds": time.perf_counter() - start, "throughputMbps": 0.0}
+    blockSize = min(n, max(4, int(0.73 / qber))) if qber > 0 else n
+    perms = [np.arange(n)] + [rng.permutation(n) for _ in range(passes - 1)]
+    inverses = []
+    for perm in perms:
+        inverse = np.empty(n, dtype=np.int64)
+        inverse[perm] = np.arange(n)
+        inverses.append(inverse)
+    #Both keys in the order of every pass, bit-packed
+    parityA = [PackedParity(keyA[perm]) for perm in perms]
+    parityB = [PackedParity(corrected[perm]) for perm in perms]
+    sizes = [min(n, blockSize * 2**i) for i in range(passes)]
+    leaked = 0
+    trips = 0
+    for current in range(passes):
+        #Alice's block parities of the new pass
+        leaked += -(-n // sizes[current])
+        trips += 1
+        pending = [current]
+        while pending:
+            p = pending.pop()
+            bounds = np.unique(np.minimum(np.arange(0, n + sizes[p], sizes[p]), n))
+            odd = np.flatnonzero((parityA[p][bounds[1:]] ^ parityA[p][bounds[:-1]]) != (parityB[p][bounds[1:]] ^ parityB[p][bounds[:-1]]))
+            if odd.size == 0:
+                continue
+            positions, bits, steps = bisect(bounds[odd].copy(), bounds[odd + 1].copy(), parityA[p], parityB[p])
+            leaked += bits
+            trips += steps
+            flipped = perms[p][positions]
+            corrected[flipped] ^= 1
+            for inverse, parity in zip(inverses, parityB):
+                parity.flip(inverse[flipped])
+            #Flipped bits change block parities of every other finished pass
+            pending = [q for q in range(current + 1) if q != p]
+    seconds = time.perf_counter() - start
+    return {"key_A": keyA, "key_B": corrected, "leakedBits": leaked, "roundTrips": trips,
+            "residualErrors": int(np.count_nonzero(keyA != corrected)), "discardedBits": 0,
+            "seconds": seconds, "throughputMbps": n / seconds / 1e6 if seconds > 0 else float("inf")}
+
+def randomEdges(n, m, columnWeight, rng):
+    #columnWeight layers of checks, every variable has one edge in each layer;
+    #a layer deals the variables round robin in a random order, so its checks
+    #get the same number of edges up to one.  Returns the (check, var) pairs
+    #sorted by check and the check bounds of the layers.
+    layers = np.linspace(0, m, min(columnWeight, m) + 1).astype(int)
+    check = np.concatenate([lo + rng.permutation(n) % (hi - lo) for lo, hi in zip(layers[:-1], layers[1:])])
+    var = np.tile(np.arange(n), layers.size - 1)
+    order = np.argsort(check, kind="stable")
+    return np.stack([check[order], var[order]]), layers
+
+#Largest message a check sends, and the value padding slots hold so that they
+#are never a minimum
+LLR_CAP = 1e3
+PADDING = 1e30
+
+class LDPCCode:
+    #Messages live in a table of width rows (edge rank within its check) by
+    #m + 1 checks by frames, frames innermost, so gathers copy whole rows and
+    #reductions over a check run along contiguous memory.  Padding slots read
+    #variable n, which always holds PADDING; check m is all padding.
+    def __init__(self, n, m, edges, layers):
+        check, var = edges
+        self.n = n
+        self.m = m
+        self.edges = edges
+        self.layers = layers
+        degree = np.bincount(check, minlength=m)
+        self.width = max(2, int(degree.max()))
+        rank = np.arange(check.size) - np.repeat(np.cumsum(degree) - degree, degree)
+        self.varOfSlot = np.full((self.width, m + 1), n)
+        self.varOfSlot[rank, check] = var
+
+    def extend(self, m, columnWeight, rng):
+        #Code with m more random checks, for frames that need more syndrome
+        (check, var), layers = randomEdges(self.n, m, columnWeight, rng)
+        return LDPCCode(self.n, self.m + m, np.concatenate([self.edges, np.stack([check + self.m, var])], axis=1),
+                        np.concatenate([self.layers, layers[1:] + self.m]))
+
+    def parity(self, bits):
+        #bits has a row per variable plus the padding row n, a column per frame
+        return np.bitwise_xor.reduce(np.take(bits, self.varOfSlot, axis=0), axis=0)
+
+    def syndrome(self, frames):
+        #A row per check plus the padding row, which is always 0
+        padded = np.zeros((self.n + 1, frames.shape[0]), dtype=np.uint8)
+        padded[:self.n] = frames.T
+        return self.parity(padded)
+
+    def decode(self, frames, syndrome, llr, iterations=15, scale=0.8):
+        #Layered normalized min-sum; llr holds the prior of every bit of every
+        #frame.  A layer touches each variable at most once, so its new
+        #messages go straight into the beliefs the next layer reads, which
+        #takes about half the iterations of updating all checks at once.  Each
+        #edge gets the smallest magnitude of the other edges of its check from
+        #a prefix and a suffix minimum.  Frames leave the working set as soon
+        #as their syndrome matches.
+        decoded = frames.copy()
+        done = np.zeros(frames.shape[0], dtype=bool)
+        active = np.arange(frames.shape[0])
+        total = np.full((self.n + 1, active.size), PADDING, dtype=np.float32)
+        total[:self.n] = llr.T
+        c2v = np.zeros((self.width, self.m + 1, active.size), dtype=np.float32)
+        sign = 1 - 2 * syndrome.astype(np.float32)
+        for _ in range(iterations):
+            for lo, hi in zip(self.layers[:-1], self.layers[1:]):
+                slots = self.varOfSlot[:, lo:hi]
+                v2c = np.take(total, slots, axis=0) - c2v[:, lo:hi]
+                magnitude = np.abs(v2c)
+                #Row by row, numpy's accumulate is slow across the outer axis
+                before = magnitude.copy()
+                after = magnitude
+                for k in range(1, self.width):
+                    np.minimum(before[k - 1], before[k], out=before[k])
+                    np.minimum(after[-k], after[-k - 1], out=after[-k - 1])
+                message = np.empty_like(magnitude)
+                message[0] = after[1]
+                message[-1] = before[-2]
+                np.minimum(before[:-2], after[2:], out=message[1:-1])
+                np.minimum(message, LLR_CAP, out=message)
+                np.copysign(message, v2c, out=message)
+                factor = scale * sign[lo:hi]
+                np.negative(factor, out=factor, where=np.logical_xor.reduce(v2c < 0, axis=0))
+                message *= factor
+                c2v[:, lo:hi] = message
+                #Padding slots all write variable n, which stays about PADDING
+                total[slots] = v2c + message
+            hard = (total < 0).view(np.uint8)
+            ok = np.all(self.parity(hard) == syndrome, axis=0)
+            if ok.any():
+                decoded[active[ok]] = hard[:self.n, ok].T
+                done[active[ok]] = True
+                keep = ~ok
+                active, syndrome, sign = active[keep], syndrome[:, keep], sign[:, keep]
+                total, c2v = total[:, keep], c2v[:, :, keep]
+                if active.size == 0:
+                    break
+        return decoded, done
+
+def ldpc(keyA, keyB, qber, frameSize=4096, efficiency=1.5, hashBits=32, retries=3, rng=None):
+    #Frames that do not decode, or decode to a word that fails the hash, get
+    #more syndrome bits (one round trip each) and are decoded again with the
+    #extended code; those still failing after the retries are dropped
+    start = time.perf_counter()
+    rng = np.random.default_rng() if rng is None else rng
+    keyA = np.asarray(keyA, dtype=np.uint8)
+    keyB = np.asarray(keyB, dtype=np.uint8)
+    n = keyA.size
+    if n == 0:
+        return {"key_A": keyA, "key_B": keyB, "leakedBits": 0, "roundTrips": 0, "residualErrors": 0,
+                "discardedBits": 0, "seconds": time.perf_counter() - start, "throughputMbps": 0.0}
+    frameSize = max(2, min(frameSize, n))
+    q = min(max(qber, 1e-4), 0.25)
+    checks = min(frameSize - 1, int(math.ceil(efficiency * binaryEntropy(q) * frameSize)) + 16)
+    code = LDPCCode(frameSize, checks, *randomEdges(frameSize, checks, 3, rng))
+    frames = -(-n // frameSize)
+    #The last frame is shortened with zeros known to both sides
+    padded = frames * frameSize
+    framesA = np.zeros(padded, dtype=np.uint8)
+    framesB = np.zeros(padded, dtype=np.uint8)
+    framesA[:n] = keyA
+    framesB[:n] = keyB
+    framesA = framesA.reshape(frames, frameSize)
+    framesB = framesB.reshape(frames, frameSize)
+    llr = np.full((frames, frameSize), math.log((1 - q) / q), dtype=np.float32)
+    llr.reshape(-1)[n:] = 1e3
+    llr *= 1 - 2 * framesB.astype(np.float32)
+    hashMatrix = rng.integers(0, 2, (frameSize, hashBits), dtype=np.uint8)
+    hashA = (framesA.astype(np.int64) @ hashMatrix) % 2
+    corrected = framesB.copy()
+    ok = np.zeros(frames, dtype=bool)
+    pending = np.arange(frames)
+    leaked = frames * (checks + hashBits)
+    trips = 0
+    extra = min(frameSize - 1, int(math.ceil(0.25 * binaryEntropy(q) * frameSize)) + 16)
+    for attempt in range(retries + 1):
+        trips += 1
+        decoded, done = code.decode(framesB[pending], code.syndrome(framesA[pending]), llr[pending])
+        done &= np.all((decoded.astype(np.int64) @ hashMatrix) % 2 == hashA[pending], axis=1)
+        corrected[pending[done]] = decoded[done]
+        ok[pending[done]] = True
+        pending = pending[~done]
+        if pending.size == 0 or attempt == retries:
+            break
+        code = code.extend(extra, max(1, round(code.width * extra / frameSize)), rng)
+        leaked += pending.size * extra
+    keep = np.repeat(ok, frameSize)[:n]
+    corrected = corrected.reshape(-1)[:n]
+    seconds = time.perf_counter() - start
+    return {"key_A": keyA[keep], "key_B": corrected[keep], "leakedBits": int(leaked), "roundTrips": trips,
+            "residualErrors": int(np.count_nonzero(keyA[keep] != corrected[keep])),
+            "discardedBits": int(n - keep.sum()), "seconds": seconds,
+            "throughputMbps": n / seconds / 1e6 if seconds > 0 else float("inf")}
+
+METHODS = {"cascade": cascade, "ldpc": ldpc}
+
+def reconcile(keyA, keyB, qber, method="cascade", rng=None):
+    return METHODS[method](keyA, keyB, qber, rng=rng)
@@ -0,0 +1,103 @@
+#! usr/bin/python3
+# Key distillation shared by the engines, without NetSquid: the QBER estimator
+# of a run, reconciliation and privacy amplification of the sifted keys and the
+# buffered record of the result.  runFastQKD is the whole run of the fast
+# engine, so it starts without importing the simulator.
+import numpy as np
+from QKD_cascade import reconcile
+from QKD_privacy import amplify
+from QKD_qber import QBEREstimator
+from QKD_profile import NULL_PROFILER
+from QKD_results import ResultWriter, runParams
+from QKD_seeding import runStreams
+
+def runFastQKD(params, writer=None, profiler=NULL_PROFILER):
+    if writer is None:
+        writer = ResultWriter(runParams(params))
+    if getattr(params, "segments", 1) > 1:
+        raise ValueError("repeater chains need the des engine")
+    from QKD_ENT_fast import runFast
+    streams = runStreams(getattr(params, "seed", None), getattr(params, "replica", 0))
+    result = runFast(params.length, params.quantumNoise, params.sourceFrequency, params.setDelay, params.nodeDistance, streams["numpy"])
+    return distill(params, result, writer, streams, profiler)
+
+def distill(params, result, writer, streams, profiler=NULL_PROFILER):
+    #Engines that hand over the finished keys: no early stop, the whole key is already there
+    estimator = qberEstimator(params, streams)
+    estimator.feed(np.asarray(result["key_A"], dtype=np.uint8), np.asarray(result["key_B"], dtype=np.uint8))
+    result.update(estimator.summary(), sampledBits=estimator.sampled)
+    return recordResults(writer, postProcess(params, result, streams, profiler))
+
+def qberEstimator(params, streams, onStop=None):
+    #The sacrificed indices are public, they are drawn from the reconcile stream
+    return QBEREstimator(getattr(params, "qberSample", 0.0), getattr(params, "qberConfidence", 0.95),
+                         getattr(params, "qberWidth", 0.0), getattr(params, "qberAbort", None),
+                         getattr(params, "qberInterval", "clopper"), onStop=onStop, rng=streams["reconcile"])
+
+def undisclosedKeys(result):
+    #Bits disclosed for the QBER estimate are not part of the key any more
+    keep = np.ones(len(result["key_A"]), dtype=bool)
+    keep[result.get("sampledBits", [])] = False
+    return np.asarray(result["key_A"], dtype=np.uint8)[keep], np.asarray(result["key_B"], dtype=np.uint8)[keep]
+
+def distillQber(result):
+    #The sampled estimate when there is one, the full comparison otherwise
+    return result["qberEstimate"] if result.get("qberEstimate") is not None else result["qber"]
+
+def postProcess(params, result, streams, profiler=NULL_PROFILER):
+    #Key distillation after sifting: reconciliation, then privacy amplification
+    with profiler.phase("reconcile"):
+        result = reconcileKeys(params, result, streams)
+    with profiler.phase("amplify"):
+        return amplifyKeys(params, result, streams)
+
+def reconcileKeys(params, result, streams):
+    #Corrects Bob's sifted key, the block permutations come from the reconcile stream
+    method = getattr(params, "reconcile", "none")
+    if method == "none":
+        return result
+    keyA, keyB = undisclosedKeys(result)
+    corrected = reconcile(keyA, keyB, distillQber(result), method, streams["reconcile"])
+    result.update(reconciled_A=corrected["key_A"], reconciled_B=corrected["key_B"],
+                  leakedBits=corrected["leakedBits"], roundTrips=corrected["roundTrips"],
+                  residualErrors=corrected["residualErrors"], discardedBits=corrected["discardedBits"],
+                  reconcileMbps=corrected["throughputMbps"])
+    return result
+
+def amplifyKeys(params, result, streams):
+    #Hashes the reconciled keys, or the sifted keys when nothing was reconciled
+    if not getattr(params, "amplify", False):
+        return result
+    if "reconciled_A" in result:
+        keyA, keyB = result["reconciled_A"], result["reconciled_B"]
+    else:
+        keyA, keyB = undisclosedKeys(result)
+    final = amplify(keyA, keyB, distillQber(result), result.get("leakedBits", 0), getattr(params, "paBlock", 1 << 20), rng=streams["reconcile"])
+    result.update(secret_A=final["key_A"], secret_B=final["key_B"], secretLength=final["secretLength"],
+                  keysMatch=final["keysMatch"], amplifyMbps=final["throughputMbps"])
+    return result
+
+def recordResults(writer, result):
+    #Buffers the summary and the keys, result["writer"] is flushed by the caller
+    writer.set(qber=result["qber"], simTime=result["simTime"], entanglements=result["entanglements"], latency=result["latency"])
+    if "events" in result:
+        writer.set(events=result["events"])
+    if "fidelityMean" in result:
+        writer.set(fidelityMean=result["fidelityMean"], fidelityStd=result["fidelityStd"], fidelitySamples=result["fidelitySamples"])
+    if result.get("qberSamples"):
+        writer.set(qberEstimate=result["qberEstimate"], qberLow=result["qberLow"], qberHigh=result["qberHigh"],
+                   qberSamples=result["qberSamples"], stopReason=result["stopReason"])
+    if "leakedBits" in result:
+        writer.set(leakedBits=result["leakedBits"], roundTrips=result["roundTrips"], residualErrors=result["residualErrors"],
+                   discardedBits=result["discardedBits"], reconcileMbps=result["reconcileMbps"])
+    writer.addBits("key_A", result["key_A"])
+    writer.addBits("key_B", result["key_B"])
+    if "reconciled_A" in result:
+        writer.addBits("reconciled_A", result["reconciled_A"])
+        writer.addBits("reconciled_B", result["reconciled_B"])
+    if "secret_A" in result:
+        writer.set(secretLength=result["secretLength"], keysMatch=result["keysMatch"], amplifyMbps=result["amplifyMbps"])
+        writer.addBits("secret_A", result["secret_A"])
+        writer.addBits("secret_B", result["secret_B"])
+    result["writer"] = writer
+    return result
@@ -0,0 +1,70 @@
+#! usr/bin/python3
+# Fidelity instrumentation of the teleported qubits.  Fidelity is only used for
+# logging, so it is computed for a subset of rounds:
+#   off    - never
+#   sample - every N-th round
+#   demand - the next round after request() was called; QKD_stream.keyBlocks
+#            requests one per key block
+# Alice registers the state she prepared for a tracked round and Bob compares
+# his corrected qubit against it.  Results are aggregated in memory.
+import math
+import netsquid as ns
+import netsquid.qubits.ketstates as ks
+
+MODES = ["off", "sample", "demand"]
+#Kets of the states AliceProtocol.randomState prepares for state 0..3
+REFERENCE_STATES = [ks.s0, ks.s1, ks.h0, ks.h1]
+
+class RunningStats:
+    #Welford's running mean and variance
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+class FidelityTracker:
+    def __init__(self, mode="off", every=100, references=REFERENCE_STATES):
+        self.mode = mode
+        self.every = every
+        self.references = references
+        self.requested = False
+        self.pending = {}
+        self.stats = RunningStats()
+
+    def request(self):
+        self.requested = True
+
+    def prepared(self, index, state):
+        if self.mode == "off":
+            return
+        if (self.mode == "sample" and index % self.every == 0) or (self.mode == "demand" and self.requested):
+            self.pending[index] = state
+            self.requested = False
+
+    def forget(self, index):
+        self.pending.pop(index, None)
+
+    def measure(self, index, qubit):
+        #Fidelity of Bob's corrected qubit for a tracked round, otherwise None
+        state = self.pending.pop(index, None)
+        if state is None:
+            return None
+        value = ns.qubits.fidelity(qubit, self.references[state], squared=True)
+        self.stats.add(value)
+        return value
+
+    def summary(self):
+        return {"fidelityMean": self.stats.mean if self.stats.count else None,
+                "fidelityStd": self.stats.std(), "fidelitySamples": self.stats.count}
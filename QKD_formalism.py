@@ -0,0 +1,66 @@
+#! usr/bin/python3
+# Selection of the NetSquid quantum-state formalism.  The protocols only use
+# Clifford gates and Pauli measurements, so KET and STAB are valid as long as
+# the depolarizing noise is applied stochastically: with the depolarizing
+# probability a uniformly random Pauli (I, X, Y or Z) is applied, which is the
+# same channel as DepolarNoiseModel but keeps every qubit in a pure state.
+#
+# Running this file compares the wall time per sifted bit of the formalisms.
+import time
+import numpy as np
+import netsquid as ns
+from optparse import OptionParser, Values
+from netsquid.components.models import DepolarNoiseModel
+from netsquid.components.models.qerrormodels import QuantumErrorModel
+from netsquid.util.simtools import get_random_state
+
+FORMALISMS = {"DM": ns.QFormalism.DM, "KET": ns.QFormalism.KET, "STAB": ns.QFormalism.STAB}
+
+class StochasticDepolarNoiseModel(QuantumErrorModel):
+    def __init__(self, depolar_rate):
+        super().__init__()
+        self.depolar_rate = depolar_rate
+
+    def error_operation(self, qubits, delta_time=0, **kwargs):
+        prob = 1 - np.exp(-self.depolar_rate * delta_time * 1e-9)
+        rng = get_random_state()
+        for qubit in qubits:
+            if qubit is None or rng.random_sample() >= prob:
+                continue
+            pauli = rng.randint(4)
+            if pauli:
+                ns.qubits.operate(qubit, (ns.X, ns.Y, ns.Z)[pauli - 1])
+
+def setFormalism(name):
+    ns.set_qstate_formalism(FORMALISMS[name])
+
+def makeNoiseModel(depolar_rate, formalism="DM"):
+    if formalism == "DM":
+        return DepolarNoiseModel(depolar_rate=depolar_rate)
+    return StochasticDepolarNoiseModel(depolar_rate)
+
+def addParserOptions():
+    parser = OptionParser()
+    parser.add_option("-l", "--length", default = 1024,
+                      dest = "length", type = "int", help = "Set length of secret key")
+    parser.add_option("-n", "--quantumNoise", default = "0,1e7",
+                      dest = "quantumNoise", help = "comma separated noise rates")
+    parser.add_option("-d", "--distance", default = 1,
+                      dest = "nodeDistance", type = "float", help = "Distance between nodes")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    import QKD_ENT
+    [inputArgs, args] = addParserOptions()
+    print(f"{'noise':>10} {'formalism':>9} {'QBER':>7} {'us/bit':>9} {'speedup':>8}")
+    for noise in inputArgs.quantumNoise.split(","):
+        reference = None
+        for formalism in FORMALISMS:
+            params = Values({"length": inputArgs.length, "quantumNoise": float(noise), "sourceFrequency": 2e7,
+                             "setDelay": 1e9, "nodeDistance": inputArgs.nodeDistance, "engine": "des",
+                             "window": 0, "formalism": formalism})
+            start = time.perf_counter()
+            result = QKD_ENT.runQKD(params)
+            perBit = (time.perf_counter() - start) / inputArgs.length * 1e6
+            reference = reference or perBit
+            print(f"{float(noise):>10g} {formalism:>9} {result['qber']:>7.4f} {perBit:>9.1f} {reference / perBit:>7.2f}x")
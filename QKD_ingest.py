@@ -0,0 +1,277 @@
+#! usr/bin/python3
+# Indexed SQLite store of run results.  "ingest" bulk-loads, in one transaction
+# per call:
+#   - result files of ResultWriter (.csv with "# key=value" header, .npz)
+#   - summary files of QKD_sweep.py / QKD_adaptive.py (one point per row)
+#   - entries of the result cache (.qkd_cache/**/*.json)
+#   - the old per-length text files QBER{length}.txt, which only know the length
+# A run is identified by the hash of its parameters (QKD_results.RUN_PARAMS);
+# unseeded runs are independent samples, so their hash also covers the file and
+# row they came from.  Files already loaded and unchanged since are skipped.
+# "query" prints a metric against one parameter (mean over replicas) and
+# "pivot" writes a parameter x parameter table of a metric.
+import csv
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from functools import lru_cache
+from itertools import zip_longest
+from operator import itemgetter
+from optparse import OptionParser
+import numpy as np
+from QKD_results import RUN_PARAMS, readResults
+from QKD_cache import canonical
+
+#Summary values with their own column, other scalars go to the JSON column extra
+RESULT_COLUMNS = ["qber", "simTime", "entanglements", "latency", "events", "fidelityMean", "qberEstimate",
+                  "qberLow", "qberHigh", "qberSamples", "stopReason", "leakedBits", "secretLength", "wallTime"]
+TEXT_COLUMNS = {"engine", "formalism", "reconcile", "stopReason"}
+INT_COLUMNS = {"length", "window", "segments", "seed", "replica"}
+#Query patterns of the sweeps: a metric against distance or noise at fixed other parameters
+INDEXES = [("engine", "quantumNoise", "nodeDistance"), ("engine", "nodeDistance", "quantumNoise"),
+           ("length", "setDelay"), ("source",)]
+
+def addParserOptions():
+    parser = OptionParser(usage="%prog [options] ingest PATH...  |  query  |  pivot")
+    parser.add_option("--db", default = "results.sqlite",
+                      dest = "db", help = "SQLite results store")
+    parser.add_option("-x", "--x", default = "nodeDistance",
+                      dest = "x", help = "parameter of the rows (query, pivot)")
+    parser.add_option("-c", "--columns", default = "quantumNoise",
+                      dest = "columns", help = "parameter of the columns (pivot)")
+    parser.add_option("-y", "--y", default = "qber",
+                      dest = "y", help = "metric")
+    parser.add_option("-w", "--where", default = [], action = "append",
+                      dest = "where", help = "filter key=value, may be repeated")
+    parser.add_option("-o", "--output", default = None,
+                      dest = "output", help = "CSV file of the query or pivot (default: print)")
+    return parser.parse_args()
+
+@lru_cache(maxsize=1 << 16)
+def parseText(text):
+    #Values of CSV cells and "# key=value" headers; sweeps repeat most of them
+    if text in ("", "None"):
+        return None
+    if text in ("True", "False"):
+        return text == "True"
+    try:
+        number = float(text)
+    except ValueError:
+        return text
+    return int(text) if text.lstrip("-").isdigit() else number
+
+def parseValue(value):
+    return parseText(value) if isinstance(value, str) else value
+
+def columnValue(key, value):
+    if key in TEXT_COLUMNS or value is None or isinstance(value, str):
+        return value
+    return float(value) if key not in INT_COLUMNS else int(float(value))
+
+def floatColumn(cells):
+    #Floats of a column of number texts, None when a cell is anything else
+    try:
+        return np.asarray(cells, dtype=float).tolist()
+    except ValueError:
+        return None
+
+def runKeys(canonicals, origins):
+    #canonicals: columns of the canonical values of RUN_PARAMS.  The key hashes
+    #repr(point) of the values in order, built from the column reprs at once
+    seeds = canonicals[RUN_PARAMS.index("seed")]
+    points = map(", ".join, zip(*(list(map(repr, values)) for values in canonicals)))
+    return [hashlib.sha256(f"({point}, {origin!r})".encode() if seed is None else f"({point})".encode()).hexdigest()
+            for point, seed, origin in zip(points, seeds, origins)]
+
+def connect(filename):
+    db = sqlite3.connect(filename)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA cache_size=-262144")
+    columns = ", ".join(f"{key} {'TEXT' if key in TEXT_COLUMNS else 'REAL'}" for key in RUN_PARAMS + RESULT_COLUMNS)
+    db.execute(f"CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, {columns}, extra TEXT, source TEXT, ingested REAL)")
+    db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL)")
+    createIndexes(db)
+    return db
+
+def createIndexes(db):
+    for index in INDEXES:
+        db.execute(f"CREATE INDEX IF NOT EXISTS runs_{'_'.join(index)} ON runs ({', '.join(index)})")
+
+def dropIndexes(db):
+    for index in INDEXES:
+        db.execute(f"DROP INDEX IF EXISTS runs_{'_'.join(index)}")
+
+def records(names, rows, source, table=True):
+    #(columns, rows) of a table as ingested.  Work is done column by column:
+    #every distinct cell of a column is converted once, a constant column is not
+    #mapped at all and columns that are empty throughout are left out.
+    #Rows of a table file are told apart by their row number, also while the
+    #file has only one row, since QBER{length}.txt files are appended to.
+    count = len(rows)
+    #Short rows are padded with empty cells
+    texts = dict(zip(names, zip_longest(*rows, fillvalue="")))
+    parsed = {}
+    numbers = {}
+    empty = set()
+
+    def column(name, convert, real=False):
+        #real: convert gives every number as float, so a column of number cells
+        #is converted by NumPy in one go
+        values = texts.get(name)
+        if values is None:
+            values = [None] * count
+        elif real and count > 1 and name not in TEXT_COLUMNS:
+            if name not in numbers:
+                numbers[name] = floatColumn(values)
+            if numbers[name] is not None:
+                return numbers[name]
+        if name not in parsed:
+            parsed[name] = {text: parseValue(text) for text in set(values)}
+        memo = {text: convert(value) for text, value in parsed[name].items()}
+        if all(value is None for value in memo.values()):
+            empty.add(name)
+        return [memo[values[0]]] * count if len(memo) == 1 else list(map(memo.__getitem__, values))
+
+    columns = {key: column(key, lambda value, key=key: columnValue(key, value), key not in INT_COLUMNS) for key in RUN_PARAMS + RESULT_COLUMNS}
+    canonicals = [column(key, canonical, True) for key in RUN_PARAMS]
+    origins = [f"{source}:{number}" for number in range(count)] if table else [source] * count
+    keys = runKeys(canonicals, origins)
+    extraNames = [name for name in names if name not in RUN_PARAMS and name not in RESULT_COLUMNS]
+    if extraNames:
+        columns["extra"] = [json.dumps(dict(zip(extraNames, values)), default=float)
+                            for values in zip(*(column(name, lambda value: value) for name in extraNames))]
+    columns = {key: values for key, values in columns.items() if key not in empty}
+    return ["key"] + list(columns) + ["source", "ingested"], list(zip(keys, *columns.values(), [source] * count, [time.time()] * count))
+
+def mappingRecords(mapping, source):
+    return records(list(mapping), [list(mapping.values())], source, table=False)
+
+def readFile(path):
+    #(columns, rows) of one file, or None when the file is of no known kind
+    name = os.path.basename(path)
+    if path.endswith(".npz"):
+        meta, _ = readResults(path)
+        return mappingRecords(meta, path)
+    if path.endswith(".json"):
+        with open(path) as f:
+            entry = json.load(f)
+        if "params" not in entry or "result" not in entry:
+            return None
+        return mappingRecords({**entry["params"], **entry["result"]}, path)
+    legacy = re.fullmatch(r"QBER(\d+)\.txt", name)
+    if legacy:
+        with open(path) as f:
+            rows = [[legacy.group(1), line.split(":", 1)[1].strip()] for line in f if ":" in line]
+        return records(["length", "qber"], rows, path)
+    if not path.endswith(".csv"):
+        return None
+    with open(path, newline='') as f:
+        first = f.readline()
+    if first.startswith("# "):
+        meta, _ = readResults(path)
+        return mappingRecords(meta, path)
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        names = next(reader, [])
+        if "qber" not in names:
+            return None
+        return records(names, list(reader), path)
+
+def expand(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in ("**/*.csv", "**/*.npz", "**/*.json", "**/QBER*.txt"):
+                yield from glob.glob(os.path.join(path, pattern), recursive=True)
+        else:
+            yield from glob.glob(path) or [path]
+
+def ingest(db, paths):
+    #Returns (files read, records new to the store)
+    seen = {path: (size, mtime) for path, size, mtime in db.execute("SELECT path, size, mtime FROM files")}
+    files = 0
+    added = 0
+    with db:
+        for path in expand(paths):
+            info = os.stat(path)
+            if seen.get(path) == (info.st_size, info.st_mtime):
+                continue
+            try:
+                table = readFile(path)
+            except (OSError, ValueError, KeyError, csv.Error):
+                table = None
+            if table is None:
+                continue
+            columns, rows = table
+            if not files:
+                #Bulk load without the query indexes, building them once afterwards
+                #is much cheaper than keeping them up to date row by row
+                dropIndexes(db)
+            #In key order the primary key index is appended to instead of updated at random
+            rows.sort(key=itemgetter(0))
+            insert = f"INSERT OR IGNORE INTO runs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+            added += db.executemany(insert, rows).rowcount
+            db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, info.st_size, info.st_mtime))
+            files += 1
+        if files:
+            createIndexes(db)
+    return files, added
+
+def whereClause(filters):
+    #"key=value" filters, numeric values compare as the stored REAL
+    terms, values = [], []
+    for item in filters:
+        key, value = item.split("=", 1)
+        if key not in RUN_PARAMS + RESULT_COLUMNS:
+            raise ValueError(f"unknown column {key}")
+        terms.append(f"{key} = ?")
+        values.append(columnValue(key, parseValue(value)))
+    return (" WHERE " + " AND ".join(terms) if terms else ""), values
+
+def checkColumns(*keys):
+    for key in keys:
+        if key not in RUN_PARAMS + RESULT_COLUMNS:
+            raise ValueError(f"unknown column {key}")
+
+def query(db, x, y="qber", filters=()):
+    #Mean, spread and count of y at every value of x
+    checkColumns(x, y)
+    where, values = whereClause(filters)
+    return db.execute(f"SELECT {x}, AVG({y}), MIN({y}), MAX({y}), COUNT({y}) FROM runs{where} GROUP BY {x} ORDER BY {x}", values).fetchall()
+
+def pivot(db, x, columns, y="qber", filters=()):
+    #Table of the mean of y with x as rows and columns as columns
+    checkColumns(x, columns, y)
+    where, values = whereClause(filters)
+    cells = db.execute(f"SELECT {x}, {columns}, AVG({y}) FROM runs{where} GROUP BY {x}, {columns}", values).fetchall()
+    rowKeys = sorted({cell[0] for cell in cells}, key=lambda value: (value is None, value))
+    columnKeys = sorted({cell[1] for cell in cells}, key=lambda value: (value is None, value))
+    table = {(cell[0], cell[1]): cell[2] for cell in cells}
+    return [[f"{x}\\{columns}"] + columnKeys] + [[row] + [table.get((row, column)) for column in columnKeys] for row in rowKeys]
+
+def writeRows(rows, output=None):
+    if output is None:
+        for row in rows:
+            print("\t".join("" if value is None else f"{value:g}" if isinstance(value, float) else str(value) for value in row))
+        return
+    with open(output, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
+if __name__ == "__main__":
+    [inputArgs, args] = addParserOptions()
+    if not args or args[0] not in ("ingest", "query", "pivot"):
+        raise SystemExit("usage: QKD_ingest.py [options] ingest PATH...  |  query  |  pivot")
+    db = connect(inputArgs.db)
+    start = time.perf_counter()
+    if args[0] == "ingest":
+        files, added = ingest(db, args[1:] or ["."])
+        print(f"Ingested {files} files, {added} new runs in {time.perf_counter() - start:.2f} s")
+    elif args[0] == "query":
+        rows = query(db, inputArgs.x, inputArgs.y, inputArgs.where)
+        writeRows([[inputArgs.x, f"mean {inputArgs.y}", "min", "max", "runs"]] + rows, inputArgs.output)
+    else:
+        writeRows(pivot(db, inputArgs.x, inputArgs.columns, inputArgs.y, inputArgs.where), inputArgs.output)
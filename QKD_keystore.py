@@ -0,0 +1,136 @@
+#! usr/bin/python3
+# Compact storage for the per-round data of a run.  Keys are bit-packed (one bit
+# per sifted round, numpy.packbits order) and timestamps are float64 arrays;
+# both grow geometrically, so appending stays amortised O(1) and a 10M-bit key
+# takes 1.25 MB instead of hundreds of MB of boxed ints.  Comparison, Hamming
+# distance and export work on whole arrays.
+import numpy as np
+
+#Set bits of every byte value
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+class PackedBits:
+    def __init__(self, capacity=1024, bits=None):
+        self.packed = np.zeros(max(1, -(-capacity // 8)), dtype=np.uint8)
+        self.size = 0
+        if bits is not None:
+            self.extend(bits)
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, size):
+        if size > 8 * self.packed.size:
+            grown = np.zeros(max(2 * self.packed.size, -(-size // 8)), dtype=np.uint8)
+            grown[:self.packed.size] = self.packed
+            self.packed = grown
+
+    def append(self, bit):
+        if self.size == 8 * self.packed.size:
+            self.reserve(self.size + 1)
+        if bit:
+            self.packed[self.size >> 3] |= 0x80 >> (self.size & 7)
+        self.size += 1
+
+    def extend(self, bits):
+        bits = np.asarray(bits, dtype=np.uint8)
+        self.reserve(self.size + bits.size)
+        #Fills the current byte bit by bit, the rest is packed byte aligned
+        head = min(-self.size % 8, bits.size)
+        for bit in bits[:head]:
+            self.append(bit)
+        rest = np.packbits(bits[head:])
+        self.packed[self.size >> 3:(self.size >> 3) + rest.size] = rest
+        self.size += bits.size - head
+
+    def prefix(self, size):
+        #Copy of the first size bits
+        size = min(size, self.size)
+        copy = PackedBits(size)
+        copy.packed[:-(-size // 8)] = self.packed[:-(-size // 8)]
+        copy.size = size
+        if size % 8:
+            copy.packed[size >> 3] &= (0xFF00 >> (size % 8)) & 0xFF
+        return copy
+
+    def bytes(self):
+        #Packed bits without the unused capacity, padded with zeros to a byte
+        return self.packed[:-(-self.size // 8)]
+
+    def bits(self):
+        return np.unpackbits(self.bytes(), count=self.size)
+
+    def __array__(self, dtype=None, copy=None):
+        bits = self.bits()
+        return bits if dtype is None else bits.astype(dtype, copy=False)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.size)
+            if step != 1:
+                return self.bits()[index]
+            #Unpacks only the bytes of the slice
+            first = start >> 3
+            return np.unpackbits(self.packed[first:max(first, -(-stop // 8))])[start - 8 * first:max(start, stop) - 8 * first]
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("bit index out of range")
+        return int(self.packed[index >> 3] >> (7 - (index & 7)) & 1)
+
+    def __iter__(self):
+        return iter(self.bits().tolist())
+
+    def __eq__(self, other):
+        return len(self) == len(other) and hamming(self, other) == 0
+
+    def hamming(self, other):
+        return hamming(self, other)
+
+def hamming(keyA, keyB):
+    #Differing bits over the common length, on the packed bytes
+    size = min(len(keyA), len(keyB))
+    packedA = keyA.prefix(size).bytes() if isinstance(keyA, PackedBits) else np.packbits(np.asarray(keyA, dtype=np.uint8)[:size])
+    packedB = keyB.prefix(size).bytes() if isinstance(keyB, PackedBits) else np.packbits(np.asarray(keyB, dtype=np.uint8)[:size])
+    return int(POPCOUNT[packedA ^ packedB].sum(dtype=np.int64))
+
+class GrowingArray:
+    #Append-only numeric array, float64 by default for simulation timestamps
+    def __init__(self, capacity=1024, dtype=np.float64):
+        self.data = np.empty(max(1, capacity), dtype=dtype)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, size):
+        if size > self.data.size:
+            grown = np.empty(max(2 * self.data.size, size), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+
+    def append(self, value):
+        if self.size == self.data.size:
+            self.reserve(self.size + 1)
+        self.data[self.size] = value
+        self.size += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        self.reserve(self.size + values.size)
+        self.data[self.size:self.size + values.size] = values
+        self.size += values.size
+
+    def array(self):
+        #View of the filled part
+        return self.data[:self.size]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.array()
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+    def __getitem__(self, index):
+        return self.array()[index]
+
+    def __iter__(self):
+        return iter(self.array().tolist())
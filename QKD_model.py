@@ -0,0 +1,113 @@
+#! usr/bin/python3
+# Analytical surrogate of the stop-and-wait run of QKD_ENT.py.  It uses the
+# round timing and depolarizing factors of QKD_ENT_fast.py (linkTiming,
+# roundDecay) and gives their expectations instead of sampling them:
+#   sifted bit error  e(lam) = (1 - lam) / 2
+#     (every state flips with (1 - lam)/2 when measured in its own basis)
+#   rounds per key    2 * length, only round 0 uses the first-round factor
+# Every function takes scalars or NumPy arrays that broadcast against each
+# other, so a million parameter sets take milliseconds.  --validate runs a few
+# points of the grid with the DES (through QKD_sweep.runPoints and its cache)
+# and checks the prediction against their Clopper-Pearson intervals.
+import time
+from optparse import OptionParser
+import numpy as np
+from QKD_ENT_fast import linkTiming, roundDecay
+from QKD_qber import clopperPearson
+from QKD_results import ResultWriter
+from QKD_sweep import parseRange
+
+GRID_KEYS = ["length", "quantumNoise", "sourceFrequency", "setDelay", "nodeDistance"]
+
+def addParserOptions():
+    parser = OptionParser(usage="%prog [options]  (every grid option takes a,b,c or start:stop:*k or start:stop:+k)")
+    parser.add_option("-l", "--length", default = "1024",
+                      dest = "length", help = "key lengths")
+    parser.add_option("-n", "--quantumNoise", default = "1e7",
+                      dest = "quantumNoise", help = "rates of depolar and dephase errors")
+    parser.add_option("-f", "--sourceFrequency", default = "2e7",
+                      dest = "sourceFrequency", help = "rates of entanglement pairs")
+    parser.add_option("-t", "--delay", default = "1e9",
+                      dest = "setDelay", help = "delays, based on fraction of source frequency")
+    parser.add_option("-d", "--distance", default = "1",
+                      dest = "nodeDistance", help = "distances between nodes")
+    parser.add_option("-o", "--output", default = None,
+                      dest = "output", help = "write the predictions of the grid to this .csv or .npz file")
+    parser.add_option("-V", "--validate", default = 0,
+                      dest = "validate", type = "int", help = "run this many grid points with the DES and compare")
+    parser.add_option("--confidence", default = 0.99,
+                      dest = "confidence", type = "float", help = "confidence of the DES QBER interval in the validation")
+    parser.add_option("-s", "--seed", default = 1,
+                      dest = "seed", type = "int", help = "seed of the validation runs")
+    parser.add_option("-p", "--processes", default = None,
+                      dest = "processes", type = "int", help = "worker processes of the validation")
+    parser.add_option("--cache", default = ".qkd_cache",
+                      dest = "cache", help = "result cache of the validation runs, empty string to disable")
+    return parser.parse_args()
+
+def bitError(lam):
+    return (1 - lam) / 2
+
+def predict(length, quantumNoise, sourceFrequency, setDelay, nodeDistance):
+    length = np.asarray(length, dtype=float)
+    timing = linkTiming(np.asarray(nodeDistance, dtype=float) / 10000, np.asarray(sourceFrequency, dtype=float), np.asarray(setDelay, dtype=float))
+    firstDecay, decay = roundDecay(timing, np.asarray(quantumNoise, dtype=float))
+    #Round 0 is sifted with probability 1/2 and is then the first key bit
+    qber = (0.5 * bitError(firstDecay) + (length - 0.5) * bitError(decay)) / length
+    rounds = 2 * length
+    simTime = timing["firstArrival"] + (rounds - 1) * timing["roundPeriod"] + 4 * timing["cDelay"]
+    return {"qber": qber, "qberStd": np.sqrt(qber * (1 - qber) / length), "entanglements": rounds,
+            "simTime": simTime, "latency": timing["cDelay"],
+            #Sifted bits per second of simulated time
+            "siftedRate": length / simTime * 1e9}
+
+def gridArrays(options):
+    axes = [parseRange(str(getattr(options, key)), int if key == "length" else float) for key in GRID_KEYS]
+    mesh = np.meshgrid(*[np.asarray(axis, dtype=float) for axis in axes], indexing="ij")
+    return {key: values.ravel() for key, values in zip(GRID_KEYS, mesh)}
+
+def validate(grid, count, seed=1, confidence=0.99, processes=None, cache=None):
+    #Spot-checks evenly spread grid points against the DES
+    from QKD_sweep import runPoints
+    size = grid["length"].size
+    picks = np.unique(np.linspace(0, size - 1, min(count, size)).round().astype(int))
+    points = [{**{key: (int(grid[key][i]) if key == "length" else float(grid[key][i])) for key in GRID_KEYS},
+               "engine": "des", "window": 0, "segments": 1, "formalism": "DM", "seed": seed, "replica": 0,
+               "qberSample": 0.0, "qberWidth": 0.0, "qberAbort": None} for i in picks]
+    rows = []
+    for point, summary, cached in runPoints(points, processes, cache=cache):
+        model = predict(*[point[key] for key in GRID_KEYS])
+        errors = int(round(summary["qber"] * point["length"]))
+        low, high = clopperPearson(errors, point["length"], confidence)
+        rows.append({**point, "qber": summary["qber"], "qberModel": float(model["qber"]),
+                     "simTime": summary["simTime"], "simTimeModel": float(model["simTime"]),
+                     "inInterval": bool(low <= model["qber"] <= high)})
+    return rows
+
+if __name__ == "__main__":
+    [inputArgs, args] = addParserOptions()
+    grid = gridArrays(inputArgs)
+    start = time.perf_counter()
+    model = predict(*[grid[key] for key in GRID_KEYS])
+    elapsed = time.perf_counter() - start
+    print(f"Predicted {grid['length'].size} points in {elapsed * 1e3:.2f} ms")
+    if inputArgs.output:
+        writer = ResultWriter()
+        for key in GRID_KEYS:
+            writer.addColumn(key, grid[key])
+        for key, values in model.items():
+            writer.addColumn(key, np.broadcast_to(values, grid["length"].shape))
+        writer.flush(inputArgs.output)
+    else:
+        for i in range(min(grid["length"].size, 20)):
+            print(" ".join(f"{key}={grid[key][i]:g}" for key in GRID_KEYS) +
+                  f"  QBER {model['qber'][i]:.4f}  simTime {model['simTime'][i]:.4g} ns  rate {model['siftedRate'][i]:.4g} b/s")
+    if inputArgs.validate:
+        from QKD_cache import ResultCache
+        cache = ResultCache(inputArgs.cache) if inputArgs.cache else None
+        rows = validate(grid, inputArgs.validate, inputArgs.seed, inputArgs.confidence, inputArgs.processes, cache)
+        for row in rows:
+            print(f"n={row['quantumNoise']:g} d={row['nodeDistance']:g} t={row['setDelay']:g} l={row['length']}: "
+                  f"QBER DES {row['qber']:.4f} model {row['qberModel']:.4f}  simTime DES {row['simTime']:.4g} model {row['simTimeModel']:.4g}"
+                  + ("" if row["inInterval"] else "  OUTSIDE INTERVAL"))
+        print(f"{sum(row['inInterval'] for row in rows)}/{len(rows)} points inside the {inputArgs.confidence:.0%} interval")
@@ -0,0 +1,49 @@
+#! usr/bin/python3
+# Privacy amplification of the reconciled keys by Toeplitz hashing.  The m x n
+# Toeplitz matrix is given by a public random seed of n+m-1 bits, so T*x is a
+# slice of the convolution of seed and key, computed with real FFTs in
+# O(n log n).  Long keys are hashed in blocks of blockSize bits; the FFT sums
+# stay far below 2^53 so rounding gives the exact parities.
+#
+# Secret length of a block of n bits: n*(1 - h(QBER)) minus its share of the
+# bits leaked during reconciliation minus 2*log2(1/epsilon).
+import math
+import time
+import numpy as np
+from QKD_cascade import binaryEntropy
+
+def secretLength(n, qber, leakedBits, epsilon=1e-10):
+    return max(0, int(math.floor(n * (1 - binaryEntropy(qber)) - leakedBits - 2 * math.log2(1 / epsilon))))
+
+def toeplitzHash(bits, seed, outLength):
+    #Row i of the matrix is seed[i:i+n] reversed: y[i] = sum_j seed[i-j+n-1]*x[j]
+    n = bits.size
+    if outLength == 0 or n == 0:
+        return np.zeros(outLength, dtype=np.uint8)
+    size = 1 << (n + seed.size - 2).bit_length()
+    spectrum = np.fft.rfft(seed.astype(np.float64), size) * np.fft.rfft(bits.astype(np.float64), size)
+    convolution = np.fft.irfft(spectrum, size)[n - 1:n - 1 + outLength]
+    return (np.rint(convolution).astype(np.int64) & 1).astype(np.uint8)
+
+def amplify(keyA, keyB, qber, leakedBits, blockSize=1 << 20, epsilon=1e-10, rng=None):
+    start = time.perf_counter()
+    rng = np.random.default_rng() if rng is None else rng
+    keyA = np.asarray(keyA, dtype=np.uint8)
+    keyB = np.asarray(keyB, dtype=np.uint8)
+    n = keyA.size
+    finalA = []
+    finalB = []
+    for begin in range(0, n, blockSize):
+        blockA = keyA[begin:begin + blockSize]
+        blockB = keyB[begin:begin + blockSize]
+        #Leaked bits are charged to the blocks in proportion to their size
+        outLength = secretLength(blockA.size, qber, leakedBits * blockA.size / n, epsilon)
+        seed = rng.integers(0, 2, blockA.size + max(outLength, 1) - 1, dtype=np.uint8)
+        finalA.append(toeplitzHash(blockA, seed, outLength))
+        finalB.append(toeplitzHash(blockB, seed, outLength))
+    finalA = np.concatenate(finalA) if finalA else np.zeros(0, dtype=np.uint8)
+    finalB = np.concatenate(finalB) if finalB else np.zeros(0, dtype=np.uint8)
+    seconds = time.perf_counter() - start
+    return {"key_A": finalA, "key_B": finalB, "secretLength": int(finalA.size),
+            "keysMatch": bool(np.array_equal(finalA, finalB)), "seconds": seconds,
+            "throughputMbps": 2 * n / seconds / 1e6 if seconds > 0 else float("inf")}
@@ -0,0 +1,91 @@
+#! usr/bin/python3
+# Opt-in wall-time profiling of the phases of a run.  Code marks a phase with
+#   with profiler.phase("bell"):
+# and phases nest, so every phase is recorded under the stack of phases around
+# it.  NULL_PROFILER hands out one shared do-nothing context, which is what the
+# protocols use unless profiling is switched on.  A profile prints as a table
+# and as collapsed stacks for flamegraph.pl / speedscope (self time in us).
+# Phases must not span a yield of a protocol, the time would include other
+# protocols.
+import time
+
+class Phase:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.stack.append(self.name)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = self.profiler.stack
+        entry = self.profiler.totals.get(tuple(stack))
+        if entry is None:
+            entry = self.profiler.totals[tuple(stack)] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+        stack.pop()
+        return False
+
+class NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_PHASE = NullPhase()
+
+class NullProfiler:
+    enabled = False
+
+    def phase(self, name):
+        return NULL_PHASE
+
+NULL_PROFILER = NullProfiler()
+
+class Profiler:
+    enabled = True
+
+    def __init__(self):
+        self.stack = []
+        #stack of phase names -> [calls, seconds]
+        self.totals = {}
+        self.start = time.perf_counter()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def selfTimes(self):
+        #Time of every stack without the time of the phases nested in it
+        own = {stack: seconds for stack, (_, seconds) in self.totals.items()}
+        for stack, (_, seconds) in self.totals.items():
+            if len(stack) > 1 and stack[:-1] in own:
+                own[stack[:-1]] -= seconds
+        return own
+
+    def summary(self, events=None):
+        wall = time.perf_counter() - self.start
+        own = self.selfTimes()
+        lines = [f"{'phase':<40} {'calls':>9} {'total s':>9} {'self s':>9} {'mean us':>9} {'self %':>7}"]
+        for stack, (calls, seconds) in sorted(self.totals.items(), key=lambda item: -item[1][1]):
+            name = "  " * (len(stack) - 1) + stack[-1]
+            lines.append(f"{name:<40} {calls:>9} {seconds:>9.3f} {own[stack]:>9.3f} "
+                         f"{seconds / calls * 1e6:>9.1f} {100 * own[stack] / wall:>6.1f}%")
+        lines.append(f"wall time {wall:.3f} s" + ("" if events is None else f", {events} simulator events"))
+        return "\n".join(lines)
+
+    def collapsed(self):
+        #One "a;b;c value" line per stack, value = self time in microseconds
+        return "\n".join(f"{';'.join(stack)} {max(0, int(round(seconds * 1e6)))}"
+                         for stack, seconds in sorted(self.selfTimes().items())) + "\n"
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.collapsed())
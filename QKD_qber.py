@@ -0,0 +1,169 @@
+#! usr/bin/python3
+# Streaming QBER estimate from a sacrificed sample of the sifted key.  Alice and
+# Bob report every sifted bit with its index; a fraction of the indices is
+# chosen for the public comparison and those bits are counted as sample.  The
+# estimator keeps a Wilson or Clopper-Pearson interval and can stop the
+# simulation once the interval is narrow enough, or once QBER is clearly above
+# the abort threshold.  Intervals are re-evaluated on a geometric schedule so the
+# cost stays logarithmic in the sample size.
+import math
+import random
+from statistics import NormalDist
+
+INTERVALS = ["wilson", "clopper"]
+
+def betacf(a, b, x):
+    #Continued fraction of the regularized incomplete beta function (modified Lentz)
+    tiny = 1e-300
+    c = 1.0
+    d = 1.0 - (a + b) * x / (a + 1.0)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 300):
+        m2 = 2 * m
+        for numerator in (m * (b - m) * x / ((a + m2 - 1) * (a + m2)),
+                          -(a + m) * (a + b + m) * x / ((a + m2) * (a + m2 + 1))):
+            d = 1.0 + numerator * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            h *= d * c
+        if abs(d * c - 1.0) < 1e-14:
+            break
+    return h
+
+def betainc(a, b, x):
+    #Regularized incomplete beta I_x(a, b)
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x))
+    if x < (a + 1) / (a + b + 2):
+        return front * betacf(a, b, x) / a
+    return 1.0 - front * betacf(b, a, 1 - x) / b
+
+def betaQuantile(p, a, b):
+    lo, hi = 0.0, 1.0
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if betainc(a, b, mid) < p:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+def wilson(errors, n, confidence):
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = errors / n
+    scale = 1 + z * z / n
+    centre = (p + z * z / (2 * n)) / scale
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / scale
+    return max(0.0, centre - half), min(1.0, centre + half)
+
+def clopperPearson(errors, n, confidence):
+    if n == 0:
+        return 0.0, 1.0
+    alpha = 1 - confidence
+    low = 0.0 if errors == 0 else betaQuantile(alpha / 2, errors, n - errors + 1)
+    high = 1.0 if errors == n else betaQuantile(1 - alpha / 2, errors + 1, n - errors)
+    return low, high
+
+class QBEREstimator:
+    def __init__(self, fraction=0.0, confidence=0.95, width=0.0, abort=None, interval="clopper", minSamples=30, onStop=None, rng=None):
+        self.fraction = fraction
+        self.confidence = confidence
+        self.width = width
+        self.abort = abort
+        self.interval = {"wilson": wilson, "clopper": clopperPearson}[interval]
+        self.minSamples = minSamples
+        self.onStop = onStop
+        self.rng = random if rng is None else rng
+        #index -> [sampled, reports so far] and [bit of Alice, bit of Bob] of
+        #the indices not yet reported by both sides
+        self.chosen = {}
+        self.pending = {}
+        self.sampled = []
+        self.samples = 0
+        self.errors = 0
+        self.bounds = (0.0, 1.0)
+        self.nextCheck = minSamples
+        self.stopReason = None
+
+    def isSampled(self, index):
+        #Public choice of the sacrificed bits, made once per sifted index
+        entry = self.chosen.get(index)
+        if entry is None:
+            entry = self.chosen[index] = [self.rng.random() < self.fraction, 0]
+        entry[1] += 1
+        if entry[1] == 2:
+            del self.chosen[index]
+        return entry[0]
+
+    def alice(self, index, bit):
+        self.report(index, 0, bit)
+
+    def bob(self, index, bit):
+        self.report(index, 1, bit)
+
+    def report(self, index, side, bit):
+        if self.fraction <= 0 or not self.isSampled(index):
+            return
+        bits = self.pending.setdefault(index, [None, None])
+        bits[side] = bit
+        if None in bits:
+            return
+        del self.pending[index]
+        self.sampled.append(index)
+        self.samples += 1
+        self.errors += int(bits[0] != bits[1])
+        if self.samples >= self.nextCheck:
+            self.nextCheck = self.samples + max(1, self.samples // 64)
+            self.check()
+
+    def check(self):
+        self.bounds = self.interval(self.errors, self.samples, self.confidence)
+        if self.stopReason is not None:
+            return
+        if self.abort is not None and self.bounds[0] > self.abort:
+            self.stopReason = "abort"
+        elif self.width > 0 and (self.bounds[1] - self.bounds[0]) / 2 <= self.width:
+            self.stopReason = "converged"
+        if self.stopReason is not None and self.onStop is not None:
+            self.onStop()
+
+    def feed(self, keyA, keyB):
+        #Whole keys at once, for engines without per-bit callbacks.  The sample
+        #is drawn with one mask and the checks run on the cumulative error count
+        if self.fraction <= 0:
+            return
+        import numpy as np
+        count = min(len(keyA), len(keyB))
+        if isinstance(self.rng, np.random.Generator):
+            draws = self.rng.random(count)
+        else:
+            draws = np.array([self.rng.random() for _ in range(count)])
+        indices = np.flatnonzero(draws < self.fraction)
+        keyA = np.asarray(keyA, dtype=np.uint8)[:count]
+        keyB = np.asarray(keyB, dtype=np.uint8)[:count]
+        errors = np.cumsum(keyA[indices] != keyB[indices])
+        self.sampled.extend(indices.tolist())
+        base, baseErrors = self.samples, self.errors
+        total = base + indices.size
+        if self.stopReason is None and (self.abort is not None or self.width > 0):
+            while self.nextCheck <= total and self.stopReason is None:
+                self.samples = self.nextCheck
+                self.errors = baseErrors + int(errors[self.samples - base - 1])
+                self.nextCheck = self.samples + max(1, self.samples // 64)
+                self.check()
+        self.samples = total
+        self.errors = baseErrors + (int(errors[-1]) if errors.size else 0)
+
+    def summary(self):
+        if self.samples:
+            self.bounds = self.interval(self.errors, self.samples, self.confidence)
+        return {"qberEstimate": self.errors / self.samples if self.samples else None,
+                "qberLow": self.bounds[0], "qberHigh": self.bounds[1],
+                "qberSamples": self.samples, "stopReason": self.stopReason}
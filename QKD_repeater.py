@@ -0,0 +1,90 @@
+#! usr/bin/python3
+# Repeater chain between Alice and Bob.  The distance is split into N segments,
+# each an EntanglingConnection with its source in the middle, joined by N-1
+# repeater nodes:
+#
+#   Alice =seg= R1 =seg= R2 ... R(N-1) =seg= Bob
+#
+# All sources share one timing model, so both halves of a pair index reach a
+# repeater at the same instant and it swaps them straight away (Bell
+# measurement).  Classical messages from Alice travel hop by hop along the
+# chain.  R1 sends its Bell results as ("swap", index, z, x); every later
+# repeater XORs its own results into that item before forwarding it, so Bob
+# receives one correction per pair, ahead of Alice's message for that pair.
+# Bob's messages to Alice use a direct link of the full distance.  The
+# pipelined protocols of QKD_ENT.py run on the end nodes.
+import netsquid as ns
+from netsquid.components import QuantumMemory
+from netsquid.components.component import Message
+from netsquid.nodes import Node
+from netsquid.protocols import NodeProtocol
+from QKD_ENT import ClassicalConnectionA2B, EntanglingConnection
+from QKD_formalism import makeNoiseModel
+
+class SwapProtocol(NodeProtocol):
+    def __init__(self, node, first):
+        super().__init__(node)
+        #The first repeater starts the swap item, the others fold into it
+        self.first = first
+
+    def run(self):
+        ports = self.node.ports
+        arrivals = [0, 0]
+        corrections = {}
+        while True:
+            expression = yield (self.await_port_input(ports["qin_left"]) | self.await_port_input(ports["qin_right"])) | self.await_port_input(ports["cin_left"])
+            arrived = False
+            for side, term in enumerate((expression.first_term.first_term, expression.first_term.second_term)):
+                if term.value:
+                    port = ports["qin_left" if side == 0 else "qin_right"]
+                    self.node.qmemory.put(port.rx_input().items, positions=[side], replace=True)
+                    arrivals[side] += 1
+                    arrived = True
+            if arrived and arrivals[0] == arrivals[1]:
+                index = arrivals[0] - 1
+                self.node.qmemory.operate(ns.CNOT, [0, 1])
+                self.node.qmemory.operate(ns.H, 0)
+                m, _ = self.node.qmemory.measure([0, 1])
+                if self.first:
+                    ports["cout_right"].tx_output(Message([("swap", index, m[0], m[1])]))
+                else:
+                    corrections[index] = (m[0], m[1])
+            if expression.second_term.value:
+                items = []
+                for item in ports["cin_left"].rx_input().items:
+                    if item[0] == "swap":
+                        z, x = corrections.pop(item[1])
+                        item = ("swap", item[1], item[2] ^ z, item[3] ^ x)
+                    items.append(item)
+                ports["cout_right"].tx_output(Message(items))
+
+def chain_network_setup(node_distance, depolar_rate, source_frequency, delay, segments, window=1, formalism="DM"):
+    noise_model = makeNoiseModel(depolar_rate, formalism)
+    segment = node_distance / segments
+    alice = Node("Alice", port_names=['qin_charlie', 'cout_bob', 'cin_bob'], qmemory=QuantumMemory("AliceMemory", num_positions=2, memory_noise_models=[noise_model] * 2))
+    alice.ports['qin_charlie'].forward_input(alice.qmemory.ports['qin1'])
+    bob = Node("Bob", port_names=['qin_charlie', 'cin_alice', 'cout_alice'], qmemory=QuantumMemory("BobMemory", num_positions=window, memory_noise_models=[noise_model] * window))
+    repeaters = [Node(f"Repeater{i}", port_names=['qin_left', 'qin_right', 'cin_left', 'cout_right'],
+                      qmemory=QuantumMemory(f"Repeater{i}Memory", num_positions=2, memory_noise_models=[noise_model] * 2))
+                 for i in range(1, segments)]
+    #Quantum segments: (node, port) pairs at both ends of every source
+    ends = [(alice, 'qin_charlie')] + [(node, port) for node in repeaters for port in ('qin_left', 'qin_right')] + [(bob, 'qin_charlie')]
+    connections = []
+    for (left, leftPort), (right, rightPort) in zip(ends[0::2], ends[1::2]):
+        q_conn = EntanglingConnection(length=segment, source_frequency=source_frequency, depolarRate=depolar_rate, set_delay=delay, formalism=formalism)
+        left.ports[leftPort].connect(q_conn.ports['A'])
+        right.ports[rightPort].connect(q_conn.ports['B'])
+        connections.append(q_conn)
+    #Alice to Bob hop by hop through the repeaters, Bob to Alice directly
+    hops = [(alice, 'cout_bob')] + [(node, port) for node in repeaters for port in ('cin_left', 'cout_right')] + [(bob, 'cin_alice')]
+    for (sender, sendPort), (receiver, recvPort) in zip(hops[0::2], hops[1::2]):
+        c_conn = ClassicalConnectionA2B(length=segment)
+        sender.ports[sendPort].connect(c_conn.ports['A'])
+        receiver.ports[recvPort].connect(c_conn.ports['B'])
+        connections.append(c_conn)
+    c_conn = ClassicalConnectionA2B(length=node_distance)
+    bob.ports['cout_alice'].connect(c_conn.ports['A'])
+    alice.ports['cin_bob'].connect(c_conn.ports['B'])
+    connections.append(c_conn)
+    protocols = [SwapProtocol(node, i == 0) for i, node in enumerate(repeaters)]
+    return alice, bob, repeaters, protocols, connections
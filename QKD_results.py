@@ -0,0 +1,130 @@
+#! usr/bin/python3
+# Buffered result sink.  Records of a run are kept in memory as columns and
+# written in one go to a single file per run, together with the run parameters.
+# Supported formats are CSV (parameters as "# key=value" header lines, columns
+# of different length padded with empty cells) and NPZ.  Key columns stay
+# bit-packed (QKD_keystore.PackedBits) and are stored packed in NPZ files.
+import csv
+import json
+import os
+import time
+import numpy as np
+from QKD_keystore import PackedBits
+
+#Rows of CSV text built and written at a time
+CSV_CHUNK = 1 << 16
+
+#Parameters of a run that are written with its records
+RUN_PARAMS = ["length", "quantumNoise", "sourceFrequency", "setDelay", "nodeDistance", "engine", "window", "segments", "formalism", "reconcile", "qberSample", "qberWidth", "qberAbort", "seed", "replica"]
+
+class ResultWriter:
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+        self.scalars = {}
+        self.columns = {}
+
+    def add(self, **record):
+        #Appends one value to every named column
+        for name, value in record.items():
+            self.columns.setdefault(name, []).append(value)
+
+    def addColumn(self, name, values):
+        #Whole columns are kept as numpy arrays, repeated calls append
+        if isinstance(values, PackedBits):
+            return self.addBits(name, values)
+        values = np.asarray(values)
+        if name in self.columns:
+            values = np.concatenate([np.asarray(self.columns[name]), values])
+        self.columns[name] = values
+
+    def addBits(self, name, bits):
+        #Key columns are kept bit-packed, repeated calls append
+        if name in self.columns:
+            merged = self.columns[name] if isinstance(self.columns[name], PackedBits) else PackedBits(bits=self.columns[name])
+            merged.extend(bits)
+            bits = merged
+        else:
+            #A copy, later calls extend it in place
+            bits = bits.prefix(len(bits)) if isinstance(bits, PackedBits) else PackedBits(len(bits), bits)
+        self.columns[name] = bits
+
+    def set(self, **scalars):
+        self.scalars.update(scalars)
+
+    def flush(self, filename):
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        if filename.endswith(".npz"):
+            self.writeNpz(filename)
+        else:
+            self.writeCsv(filename)
+        self.columns = {}
+
+    def writeCsv(self, filename):
+        #Column-wise: every column becomes its cell texts, rows are joined in chunks
+        names = list(self.columns)
+        rows = max((len(values) for values in self.columns.values()), default=0)
+        cells = [csvCells(self.columns[name], rows) for name in names]
+        with open(filename, 'w', newline='') as f:
+            for key, value in {**self.params, **self.scalars}.items():
+                f.write(f"# {key}={value}\n")
+            writer = csv.writer(f)
+            writer.writerow(names)
+            for start in range(0, rows, CSV_CHUNK):
+                chunk = [column[start:start + CSV_CHUNK] for column in cells]
+                f.write("\r\n".join(map(",".join, zip(*chunk))) + "\r\n")
+
+    def writeNpz(self, filename):
+        bits = {name: len(values) for name, values in self.columns.items() if isinstance(values, PackedBits)}
+        meta = json.dumps({"params": self.params, "scalars": self.scalars, "bits": bits}, default=float)
+        arrays = {name: values.bytes() if name in bits else np.asarray(values) for name, values in self.columns.items()}
+        np.savez_compressed(filename, meta=np.array(meta), **arrays)
+
+def csvCell(value):
+    #Text of a cell as csv.writer writes it (minimal quoting, None empty)
+    text = "" if value is None else str(value)
+    if any(char in text for char in ',"\r\n'):
+        text = '"' + text.replace('"', '""') + '"'
+    return text
+
+def csvCells(values, rows):
+    #Cell texts of a column, padded with empty cells to rows
+    if isinstance(values, PackedBits):
+        cells = np.array(["0", "1"])[values.bits()].tolist()
+    elif isinstance(values, np.ndarray) and values.dtype.kind in "biuf":
+        cells = list(map(str, values.tolist()))
+    else:
+        cells = list(map(csvCell, values.tolist() if isinstance(values, np.ndarray) else values))
+    return cells + [""] * (rows - len(cells))
+
+def readResults(filename):
+    #Returns (params and scalars, columns) of a file written by ResultWriter
+    if filename.endswith(".npz"):
+        with np.load(filename) as data:
+            meta = json.loads(str(data["meta"]))
+            bits = meta.get("bits", {})
+            columns = {name: np.unpackbits(data[name], count=bits[name]) if name in bits else data[name]
+                       for name in data.files if name != "meta"}
+        return {**meta["params"], **meta["scalars"]}, columns
+    meta = {}
+    with open(filename, newline='') as f:
+        line = f.readline()
+        while line.startswith("# "):
+            key, value = line[2:].rstrip("\n").split("=", 1)
+            meta[key] = value
+            line = f.readline()
+        names = next(csv.reader([line]))
+        columns = {name: [] for name in names}
+        for row in csv.reader(f):
+            for name, value in zip(names, row):
+                if value != "":
+                    columns[name].append(value)
+    return meta, columns
+
+def runFilename(folder, params, extension="csv"):
+    #Unique per process and time, so parallel runs never share a file
+    return os.path.join(folder, f"run{params['length']}_{params.get('engine', 'des')}_{os.getpid()}_{time.time_ns()}.{extension}")
+
+def runParams(params):
+    return {key: getattr(params, key) for key in RUN_PARAMS if hasattr(params, key)}
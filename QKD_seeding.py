@@ -0,0 +1,21 @@
+#! usr/bin/python3
+# Reproducible random streams for a run.  A base seed and a replica index give a
+# SeedSequence whose children seed the Python-level choices of the protocols
+# (Alice's states, Bob's bases), NetSquid's random state, the NumPy engines and
+# the public randomness of key reconciliation.
+# Replicas get different spawn keys, so their streams are independent and any
+# single replica can be re-run bit for bit.  Grid points that share seed and
+# replica use the same streams (common random numbers across a sweep).
+import random
+import numpy as np
+
+def runStreams(seed, replica=0):
+    #None gives the unseeded behaviour of the global generators
+    if seed is None:
+        return {"python": random, "netsquid": None, "numpy": np.random.default_rng(), "reconcile": np.random.default_rng()}
+    sequence = np.random.SeedSequence(seed, spawn_key=(replica,))
+    pythonSeq, netsquidSeq, numpySeq, reconcileSeq = sequence.spawn(4)
+    return {"python": random.Random(int.from_bytes(pythonSeq.generate_state(4).tobytes(), "little")),
+            "netsquid": int(netsquidSeq.generate_state(1)[0]),
+            "numpy": np.random.default_rng(numpySeq),
+            "reconcile": np.random.default_rng(reconcileSeq)}
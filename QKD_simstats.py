@@ -0,0 +1,16 @@
+#! usr/bin/python3
+# Helpers around the SimStats object returned by ns.sim_run.
+import re
+
+def simEventCount(stats):
+    #Number of events the simulator triggered, taken from the SimStats summary
+    try:
+        summary = stats.summary(print_to_console=False)
+    except (AttributeError, TypeError):
+        return None
+    found = re.search(r"Triggered events\s*:\s*(\d+)", str(summary))
+    return int(found.group(1)) if found else None
+
+def runSummary(qber, simTime, entanglements, events):
+    #One line summary printed by the NetSquid scripts and parsed by QKD_benchmark.py
+    return f"QBER: {qber}  Sim_time: {simTime:.1f}  Entanglements: {entanglements}  Events: {events}"
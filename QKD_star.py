@@ -0,0 +1,150 @@
+#! usr/bin/python3
+# Hub-and-spoke network: K Alice/Bob pairs served by one entanglement source at
+# the central node Charlie, all in a single NetSquid simulation.  Every pair is
+# the link of QKD_ENT.example_network_setup (Charlie half way between Alice and
+# Bob) but its source is switched to external triggering, and one scheduler
+# shares the source between the pairs:
+#   tdm - time multiplexed, the source fires every period and the slots go round
+#         robin, so pair k gets a pair every K periods, offset by k periods
+#   fdm - frequency multiplexed, K spectral channels at 1/K of the rate each,
+#         all pairs get a pair at the same instants
+# A pair that finished its key leaves its slot idle.  The simulation stops once
+# every pair is done; the cost grows linearly in K.
+import random
+from optparse import OptionParser
+import netsquid as ns
+from netsquid.components.qsource import SourceStatus
+from netsquid.protocols import Protocol
+from QKD_ENT import example_network_setup, checkWindow, AliceProtocol, BobProtocol, PipelinedAliceProtocol, PipelinedBobProtocol
+from QKD_formalism import FORMALISMS, setFormalism
+from QKD_results import ResultWriter, runParams, runFilename
+from QKD_seeding import runStreams
+from QKD_simstats import simEventCount
+
+MODES = ["tdm", "fdm"]
+
+def addParserOptions():
+    parser = OptionParser()
+    parser.add_option("-k", "--pairs", default = 8,
+                      dest = "pairs", type = "int", help = "number of Alice/Bob pairs")
+    parser.add_option("-m", "--mode", default = "tdm", choices = MODES,
+                      dest = "mode", type = "choice", help = "source sharing: tdm (round robin slots) or fdm (rate split)")
+    parser.add_option("-l", "--length",
+                      dest = "length", type = "int", help="Set length of secret key of every pair", default = 4)
+    parser.add_option("-n", "--quantumNoise", default = 1e7,
+                      dest = "quantumNoise", type = "int", help = "rate of depolar and dephase errors")
+    parser.add_option("-f", "--sourceFrequency", default = 2e7,
+                      dest = "sourceFrequency", type = "int", help = "rate of entanglement pairs")
+    parser.add_option("-t", "--delay", default = 1e9,
+                      dest = "setDelay", type = "int", help = "based on fraction of source frequency")
+    parser.add_option("-d", "--distance", default = 1,
+                      dest = "nodeDistance", type = "float", help = "Distance between the nodes of a pair")
+    parser.add_option("-w", "--window", default = 0,
+                      dest = "window", type = "int", help = "rounds in flight (0: stop-and-wait), must exceed the classical delay in source periods")
+    parser.add_option("--formalism", default = "DM", choices = list(FORMALISMS),
+                      dest = "formalism", type = "choice", help = "quantum state formalism: DM, KET or STAB (stochastic noise)")
+    parser.add_option("-s", "--seed", default = None,
+                      dest = "seed", type = "int", help = "base seed, makes the run reproducible")
+    parser.add_option("-r", "--replica", default = 0,
+                      dest = "replica", type = "int", help = "replica index, selects an independent stream of the seed")
+    parser.add_option("-o", "--output", default = None,
+                      dest = "output", help = "per-pair result file, .csv or .npz (default: generated name)")
+    return parser.parse_args()
+
+class SourceScheduler(Protocol):
+    #Triggers the sources of the pairs that still need key
+    def __init__(self, sources, period, mode="tdm"):
+        super().__init__()
+        self.sources = sources
+        self.period = period
+        self.mode = mode
+        self.active = [True] * len(sources)
+
+    def run(self):
+        tick = 0
+        while True:
+            if self.mode == "tdm":
+                yield self.await_timer(self.period)
+                pair = tick % len(self.sources)
+                if self.active[pair]:
+                    self.sources[pair].trigger()
+            else:
+                yield self.await_timer(self.period * len(self.sources))
+                for pair, source in enumerate(self.sources):
+                    if self.active[pair]:
+                        source.trigger()
+            tick += 1
+
+def star_network_setup(pairs, node_distance, depolar_rate, source_frequency, delay, window=0, formalism="DM"):
+    links = [example_network_setup(node_distance=node_distance, depolar_rate=depolar_rate, source_frequency=source_frequency,
+                                   delay=delay, window=window, formalism=formalism) for _ in range(pairs)]
+    sources = []
+    for _, _, q_conn in links:
+        source = q_conn.subcomponents["qsource"]
+        source.status = SourceStatus.EXTERNAL
+        sources.append(source)
+    return links, sources
+
+def runStar(params):
+    streams = runStreams(getattr(params, "seed", None), getattr(params, "replica", 0))
+    ns.sim_reset()
+    if streams["netsquid"] is not None:
+        ns.set_random_state(seed=streams["netsquid"])
+    setFormalism(getattr(params, "formalism", "DM"))
+    window = getattr(params, "window", 0)
+    checkWindow(params, window)
+    links, sources = star_network_setup(params.pairs, params.nodeDistance/10000, params.quantumNoise, params.sourceFrequency,
+                                        params.setDelay, window, getattr(params, "formalism", "DM"))
+    scheduler = SourceScheduler(sources, params.setDelay / params.sourceFrequency, params.mode)
+    finished = {}
+
+    def pairDone(pair):
+        #Frees the slot of the pair, the last one ends the simulation
+        scheduler.active[pair] = False
+        finished[pair] = ns.sim_time()
+        if len(finished) == params.pairs:
+            ns.sim_stop()
+
+    protocols = []
+    for pair, (alice, bob, _) in enumerate(links):
+        rng = random.Random(streams["python"].getrandbits(64))
+        if window > 0:
+            aliceProtocol = PipelinedAliceProtocol(alice, params.length, window, rng=rng)
+            bobProtocol = PipelinedBobProtocol(bob, params.length, window, rng=rng)
+            bobProtocol.onDone = lambda pair=pair: pairDone(pair)
+        else:
+            aliceProtocol = AliceProtocol(alice, params.length, rng=rng)
+            bobProtocol = BobProtocol(bob, params.length, rng=rng)
+            aliceProtocol.onDone = lambda pair=pair: pairDone(pair)
+        protocols.append((aliceProtocol.start(), bobProtocol.start()))
+    scheduler.start()
+    stats = ns.sim_run(6000000000000)
+    results = []
+    for pair, (aliceProtocol, bobProtocol) in enumerate(protocols):
+        keyLength = min(len(aliceProtocol.getKey()), len(bobProtocol.getKey()))
+        simTime = finished.get(pair, ns.sim_time())
+        results.append({"pair": pair, "keyLength": keyLength,
+                        "qber": aliceProtocol.getKey().hamming(bobProtocol.getKey()) / max(keyLength, 1),
+                        "entanglements": bobProtocol.getEntanglements(), "simTime": simTime,
+                        #Sifted bits per second of simulated time
+                        "keyRate": keyLength / simTime * 1e9 if simTime else 0.0})
+    simTime = ns.sim_time()
+    totalBits = sum(result["keyLength"] for result in results)
+    return {"pairs": results, "simTime": simTime, "aggregateKeyRate": totalBits / simTime * 1e9 if simTime else 0.0,
+            "qber": sum(result["qber"] * result["keyLength"] for result in results) / max(totalBits, 1),
+            "events": simEventCount(stats)}
+
+if __name__ == "__main__":
+    [inputArgs, args] = addParserOptions()
+    result = runStar(inputArgs)
+    params = {**runParams(inputArgs), "pairs": inputArgs.pairs, "mode": inputArgs.mode}
+    writer = ResultWriter(params)
+    writer.set(simTime=result["simTime"], aggregateKeyRate=result["aggregateKeyRate"], qber=result["qber"], events=result["events"])
+    print(f"{'pair':>4} {'bits':>8} {'QBER':>7} {'sim time ns':>14} {'key rate b/s':>14}")
+    for pair in result["pairs"]:
+        writer.add(**pair)
+        print(f"{pair['pair']:>4} {pair['keyLength']:>8} {pair['qber']:>7.4f} {pair['simTime']:>14.1f} {pair['keyRate']:>14.1f}")
+    output = inputArgs.output or runFilename(".", {**params, "engine": f"star{inputArgs.pairs}"})
+    writer.flush(output)
+    print(f"Aggregate key rate: {result['aggregateKeyRate']:.1f} b/s  QBER: {result['qber']:.4f}  "
+          f"Sim_time: {result['simTime']:.1f}  Events: {result['events']}  Results: {output}")
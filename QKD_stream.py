@@ -0,0 +1,139 @@
+#! usr/bin/python3
+# Key blocks of a DES run while it is being simulated.  keyBlocks() is a
+# generator: it advances the simulation in slices of simulated time and yields
+# every complete block of blockSize sifted rounds as soon as both Alice and Bob
+# hold it.  The simulation only runs while the consumer asks for the next block,
+# so a slow consumer pauses it.  With threaded=True the simulation runs in a
+# producer thread up to maxBlocks blocks ahead of the consumer.
+#
+# Bits disclosed for the QBER estimate are left out of a block, and with a
+# reconciliation method every block is corrected on its own (QKD_cascade.py).
+# With --fidelity demand every block requests one fidelity sample, taken from
+# the next round that starts after the block was handed out.
+import threading
+import time
+from optparse import OptionParser, Values
+from queue import Queue
+import numpy as np
+import netsquid as ns
+from QKD_ENT import startRun
+from QKD_ENT_fast import linkTiming
+from QKD_cascade import METHODS, reconcile
+from QKD_fidelity import MODES as FIDELITY_MODES
+from QKD_results import ResultWriter, runParams
+from QKD_seeding import runStreams
+from QKD_api import DEFAULTS
+
+#Upper limit of simulated time, as in QKD_ENT.runQKD [ns]
+END_TIME = 6000000000000
+
+def addParserOptions():
+    parser = OptionParser()
+    parser.add_option("-l", "--length",
+                      dest = "length", type = "int", help="Set length of secret key", default = 1 << 16)
+    parser.add_option("-n", "--quantumNoise", default = 1e7,
+                      dest = "quantumNoise", type = "int", help = "rate of depolar and dephase errors")
+    parser.add_option("-f", "--sourceFrequency", default = 2e7,
+                      dest = "sourceFrequency", type = "int", help = "rate of entanglement pairs")
+    parser.add_option("-t", "--delay", default = 1e9,
+                      dest = "setDelay", type = "int", help = "based on fraction of source frequency")
+    parser.add_option("-d", "--distance", default = 1,
+                      dest = "nodeDistance", type = "float", help = "Distance between nodes")
+    parser.add_option("-w", "--window", default = 0,
+                      dest = "window", type = "int", help = "rounds in flight (0: stop-and-wait)")
+    parser.add_option("-b", "--block", default = 4096,
+                      dest = "blockSize", type = "int", help = "sifted rounds per key block")
+    parser.add_option("--reconcile", default = "none", choices = ["none"] + list(METHODS),
+                      dest = "reconcile", type = "choice", help = "correct every block: none, cascade or ldpc")
+    parser.add_option("--fidelity", default = DEFAULTS["fidelity"], choices = FIDELITY_MODES,
+                      dest = "fidelity", type = "choice", help = "fidelity tracking: off, sample (every N-th round) or demand (one per block)")
+    parser.add_option("--threaded", default = False, action = "store_true",
+                      dest = "threaded", help = "simulate in a thread ahead of the consumer")
+    parser.add_option("--ahead", default = 4,
+                      dest = "maxBlocks", type = "int", help = "blocks the thread may simulate ahead")
+    parser.add_option("-s", "--seed", default = None,
+                      dest = "seed", type = "int", help = "base seed, makes the run reproducible")
+    return parser.parse_args()
+
+def sliceDuration(params, blockSize):
+    #Simulated time of about one block, two rounds per sifted bit
+    timing = linkTiming(params.nodeDistance / 10000, params.sourceFrequency, params.setDelay)
+    window = max(getattr(params, "window", 0), 1)
+    return float(2 * blockSize * timing["roundPeriod"] / window)
+
+def keyBlocks(params, blockSize=4096, writer=None, network=None, sliceTime=None):
+    if writer is None:
+        writer = ResultWriter(runParams(params))
+    streams = runStreams(getattr(params, "seed", None), getattr(params, "replica", 0))
+    run = startRun(params, writer, streams, network)
+    keyA, keyB, estimator, fidelity = run["alice"].getKey(), run["bob"].getKey(), run["estimator"], run["fidelity"]
+    fidelity.request()
+    sliceTime = sliceDuration(params, blockSize) if sliceTime is None else sliceTime
+    method = getattr(params, "reconcile", "none")
+    start = 0
+    sampled = 0
+    index = 0
+    while True:
+        ns.sim_run(duration=sliceTime)
+        done = len(keyB) >= params.length or estimator.stopReason is not None or ns.sim_time() >= END_TIME
+        available = min(len(keyA), len(keyB))
+        while available - start >= blockSize or (done and available > start):
+            end = min(start + blockSize, available)
+            #Disclosed indices complete in order, so a cursor finds those of the block
+            keep = np.ones(end - start, dtype=bool)
+            while sampled < len(estimator.sampled) and estimator.sampled[sampled] < end:
+                keep[estimator.sampled[sampled] - start] = False
+                sampled += 1
+            block = {"index": index, "start": start, "key_A": keyA[start:end][keep], "key_B": keyB[start:end][keep],
+                     "simTime": ns.sim_time()}
+            block["qber"] = np.count_nonzero(block["key_A"] != block["key_B"]) / max(block["key_A"].size, 1)
+            if method != "none":
+                estimate = estimator.summary()["qberEstimate"]
+                corrected = reconcile(block["key_A"], block["key_B"], block["qber"] if estimate is None else estimate, method, streams["reconcile"])
+                block.update(reconciled_A=corrected["key_A"], reconciled_B=corrected["key_B"],
+                             leakedBits=corrected["leakedBits"], residualErrors=corrected["residualErrors"])
+            block.update(fidelity.summary())
+            yield block
+            fidelity.request()
+            start = end
+            index += 1
+        if done:
+            return
+
+def threadedBlocks(blocks, maxBlocks=4):
+    #Runs a block generator in a producer thread; put() blocks once maxBlocks
+    #are waiting, which pauses the simulation until the consumer catches up
+    queue = Queue(maxBlocks)
+    end = object()
+
+    def produce():
+        try:
+            for block in blocks:
+                queue.put(block)
+        except BaseException as error:
+            queue.put(error)
+        finally:
+            queue.put(end)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        block = queue.get()
+        if block is end:
+            return
+        if isinstance(block, BaseException):
+            raise block
+        yield block
+
+def streamKey(params, blockSize=4096, threaded=False, maxBlocks=4, **kwargs):
+    blocks = keyBlocks(params, blockSize, **kwargs)
+    return threadedBlocks(blocks, maxBlocks) if threaded else blocks
+
+if __name__ == "__main__":
+    [inputArgs, args] = addParserOptions()
+    params = Values({**DEFAULTS, **vars(inputArgs)})
+    start = time.perf_counter()
+    for block in streamKey(params, inputArgs.blockSize, inputArgs.threaded, inputArgs.maxBlocks):
+        line = f"block {block['index']:>5}  bits {block['key_A'].size:>7}  QBER {block['qber']:.4f}  simTime {block['simTime']:.4g} ns"
+        if "leakedBits" in block:
+            line += f"  leaked {block['leakedBits']:>6}  residual {block['residualErrors']}"
+        print(line + f"  wall {time.perf_counter() - start:.2f} s", flush=True)
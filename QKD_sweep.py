@@ -0,0 +1,169 @@
+#! usr/bin/python3
+# Runs a grid of QKD_ENT.py points (noise x distance x delay x key length x
+# segments x replicas) on a process pool.  Every worker imports NetSquid once
+# and keeps one network per shape (QKD_worker.py) while it runs points, the
+# results are collected and written by the parent.
+# Points found in the result cache are not run again.
+import csv
+import itertools
+import json
+import os
+import time
+from multiprocessing import Pool
+from optparse import OptionParser, Values
+from QKD_results import runFilename
+from QKD_cache import ResultCache
+
+#Columns of the summary file, besides the grid parameters
+RESULT_COLUMNS = ["qber", "simTime", "entanglements", "latency", "fidelityMean",
+                  "qberEstimate", "qberLow", "qberHigh", "stopReason", "wallTime"]
+GRID_KEYS = ["length", "quantumNoise", "sourceFrequency", "setDelay", "nodeDistance", "segments"]
+
+def parseRange(text, cast=float):
+    #"a,b,c" is a list, "start:stop:*k" multiplies and "start:stop:+k" adds like
+    #the loops of the runTests*.sh scripts, stop is inclusive
+    if ":" not in text:
+        return [cast(float(value)) for value in str(text).split(",")]
+    start, stop, step = text.split(":")
+    start, stop = float(start), float(stop)
+    multiply = step.startswith("*")
+    factor = float(step[1:]) if multiply else float(step.lstrip("+"))
+    #Steps that never reach stop
+    if multiply and (factor <= 1 or start <= 0):
+        raise ValueError(f"range {text}: a *k step needs k > 1 and a start above 0")
+    if not multiply and factor <= 0:
+        raise ValueError(f"range {text}: a +k step needs k > 0")
+    values = []
+    value = start
+    while value <= stop:
+        values.append(cast(value))
+        if multiply:
+            value *= factor
+        else:
+            value += factor
+    return values
+
+def addParserOptions():
+    parser = OptionParser(usage="%prog [options]  (every grid option takes a,b,c or start:stop:*k or start:stop:+k)")
+    parser.add_option("-l", "--length", default = "1024",
+                      dest = "length", help = "key lengths")
+    parser.add_option("-n", "--quantumNoise", default = "1e7",
+                      dest = "quantumNoise", help = "rates of depolar and dephase errors")
+    parser.add_option("-f", "--sourceFrequency", default = "2e7",
+                      dest = "sourceFrequency", help = "rates of entanglement pairs")
+    parser.add_option("-t", "--delay", default = "1e9",
+                      dest = "setDelay", help = "delays, based on fraction of source frequency")
+    parser.add_option("-d", "--distance", default = "1",
+                      dest = "nodeDistance", help = "distances between nodes")
+    parser.add_option("-S", "--segments", default = "1",
+                      dest = "segments", help = "repeater chain segments, >1 uses the pipelined protocol")
+    parser.add_option("-r", "--replicas", default = 1,
+                      dest = "replicas", type = "int", help = "runs per grid point")
+    parser.add_option("-e", "--engine", default = "des", choices = ["des", "fast"],
+                      dest = "engine", type = "choice", help = "engine used for every point")
+    parser.add_option("-w", "--window", default = 0,
+                      dest = "window", type = "int", help = "pipelined protocol window for every point, 0 for stop-and-wait")
+    parser.add_option("--formalism", default = "DM", choices = ["DM", "KET", "STAB"],
+                      dest = "formalism", type = "choice", help = "quantum state formalism for every point")
+    parser.add_option("--qberSample", default = 0.0,
+                      dest = "qberSample", type = "float", help = "fraction of sifted bits sacrificed for the streaming QBER estimate")
+    parser.add_option("--qberWidth", default = 0.0,
+                      dest = "qberWidth", type = "float", help = "stop a run once the QBER interval half-width is below this")
+    parser.add_option("--qberAbort", default = None,
+                      dest = "qberAbort", type = "float", help = "stop a run once QBER is clearly above this")
+    parser.add_option("-s", "--seed", default = None,
+                      dest = "seed", type = "int", help = "base seed, every replica gets an independent stream of it")
+    parser.add_option("-g", "--grid", default = None,
+                      dest = "grid", help = "JSON file with the grid, keys as the long options")
+    parser.add_option("-p", "--processes", default = os.cpu_count(),
+                      dest = "processes", type = "int", help = "number of worker processes")
+    parser.add_option("-o", "--output", default = "sweep.csv",
+                      dest = "output", help = "summary file of all points")
+    parser.add_option("--cache", default = ".qkd_cache",
+                      dest = "cache", help = "folder of the result cache, empty string to disable")
+    parser.add_option("--cacheSize", default = 256,
+                      dest = "cacheSize", type = "float", help = "cache size limit in MB")
+    parser.add_option("--rebuild", default = False, action = "store_true",
+                      dest = "rebuild", help = "build a new network for every point instead of reusing one per worker")
+    parser.add_option("--runDir", default = None,
+                      dest = "runDir", help = "also write the full result file of every run into this folder")
+    return parser.parse_args()
+
+def buildGrid(options):
+    grid = {key: getattr(options, key) for key in GRID_KEYS}
+    if options.grid is not None:
+        with open(options.grid) as f:
+            grid.update(json.load(f))
+    axes = []
+    for key in GRID_KEYS:
+        values = grid[key]
+        if not isinstance(values, list):
+            values = parseRange(str(values), int if key in ("length", "segments") else float)
+        axes.append(values)
+    replicas = int(grid.get("replicas", options.replicas))
+    points = []
+    for values in itertools.product(*axes):
+        for replica in range(replicas):
+            point = dict(zip(GRID_KEYS, values))
+            point.update(engine=grid.get("engine", options.engine), window=int(grid.get("window", options.window)),
+                         formalism=grid.get("formalism", options.formalism), seed=grid.get("seed", options.seed),
+                         replica=replica, qberSample=grid.get("qberSample", options.qberSample),
+                         qberWidth=grid.get("qberWidth", options.qberWidth), qberAbort=grid.get("qberAbort", options.qberAbort))
+            points.append(point)
+    return points
+
+def initWorker(runDir=None, reuse=True):
+    #Imported once per worker, every point then reuses NetSquid, the modules and
+    #the network of its shape
+    global worker, workerRunDir
+    from QKD_worker import Worker
+    worker = Worker(reuse)
+    workerRunDir = runDir
+
+def runPoint(indexedPoint):
+    index, point = indexedPoint
+    start = time.perf_counter()
+    result = worker.run(Values(point))
+    summary = {key: result[key] for key in RESULT_COLUMNS if key in result}
+    summary["wallTime"] = time.perf_counter() - start
+    if workerRunDir is not None:
+        result["writer"].flush(runFilename(workerRunDir, point))
+    return index, summary
+
+def runPoints(points, processes=None, runDir=None, cache=None, reuse=True):
+    #Yields (point, summary, cached) as results become available
+    missing = []
+    for index, point in enumerate(points):
+        summary = cache.get(point) if cache is not None else None
+        if summary is None:
+            missing.append((index, point))
+        else:
+            yield point, summary, True
+    if not missing:
+        return
+    with Pool(min(processes or os.cpu_count(), len(missing)), initializer=initWorker, initargs=(runDir, reuse)) as pool:
+        for index, summary in pool.imap_unordered(runPoint, missing):
+            if cache is not None:
+                cache.put(points[index], summary)
+            yield points[index], summary, False
+
+def writeSummary(filename, rows):
+    columns = GRID_KEYS + ["engine", "window", "formalism", "seed", "replica", "qberSample", "qberWidth", "qberAbort"] + RESULT_COLUMNS
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for point, summary in rows:
+            writer.writerow({**point, **summary})
+
+if __name__ == "__main__":
+    [inputArgs, args] = addParserOptions()
+    points = buildGrid(inputArgs)
+    cache = ResultCache(inputArgs.cache, inputArgs.cacheSize * 2**20) if inputArgs.cache else None
+    print(f"Running {len(points)} points on {inputArgs.processes} processes")
+    rows = []
+    for point, summary, cached in runPoints(points, inputArgs.processes, inputArgs.runDir, cache, not inputArgs.rebuild):
+        print(f"{len(rows)+1}/{len(points)} n={point['quantumNoise']:g} d={point['nodeDistance']:g} "
+              f"t={point['setDelay']:g} l={point['length']}: QBER {summary['qber']:.4f}" + (" (cached)" if cached else ""))
+        rows.append((point, summary))
+    rows.sort(key=lambda row: [row[0][key] for key in GRID_KEYS] + [row[0]["replica"]])
+    writeSummary(inputArgs.output, rows)
@@ -0,0 +1,98 @@
+#! usr/bin/python3
+# Persistent simulation worker.  NetSquid and the modules are imported once and
+# the network of every shape (segments, window, formalism) is built once; later
+# points of the same shape reuse the nodes and connections after ns.sim_reset,
+# with channel lengths, depolarizing rates and source periods set in place.
+#
+# Running this file serves a job queue over pipes: one JSON parameter set per
+# line on stdin (keys as the long options of QKD_ENT.py), one JSON line with the
+# scalar results per job on stdout.
+import json
+import sys
+import time
+from optparse import Values
+import numpy as np
+from netsquid.components import ClassicalChannel
+from netsquid.components.qchannel import QuantumChannel
+from netsquid.components.qsource import SourceStatus
+import QKD_ENT
+from QKD_api import DEFAULTS
+
+def networkShape(params):
+    return (getattr(params, "segments", 1), getattr(params, "window", 0), getattr(params, "formalism", "DM"))
+
+def networkComponents(network):
+    #Every component reachable from the nodes: memories, connections, channels, sources
+    nodes = [network["alice"], network["bob"]] + network["repeaters"]
+    stack = list(nodes)
+    for node in nodes:
+        for port in node.ports.values():
+            if port.connected_port is not None:
+                stack.append(port.connected_port.component)
+    found = {}
+    while stack:
+        component = stack.pop()
+        if component is None or id(component) in found:
+            continue
+        found[id(component)] = component
+        stack.extend(component.subcomponents.values())
+        stack.extend(getattr(component, "mem_positions", []))
+    return list(found.values())
+
+def makeConfigure(network):
+    #Built with 1 km between the end nodes, so channel lengths are per km
+    components = networkComponents(network)
+    channels = [(c, c.properties["length"]) for c in components if isinstance(c, (QuantumChannel, ClassicalChannel))]
+    noiseModels = {id(m): m for c in components for m in c.models.values() if hasattr(m, "depolar_rate")}.values()
+    entangling = [c for c in components if isinstance(c, QKD_ENT.EntanglingConnection)]
+
+    def configure(params):
+        distance = params.nodeDistance/10000
+        for channel, perKm in channels:
+            channel.properties["length"] = perKm * distance
+        for model in noiseModels:
+            model.depolar_rate = params.quantumNoise
+        for connection in entangling:
+            connection.timing_model.properties["delay"] = params.setDelay / params.sourceFrequency
+            #Restarts the internal clock after the reset
+            source = connection.subcomponents["qsource"]
+            source.status = SourceStatus.OFF
+            source.status = SourceStatus.INTERNAL
+    return configure
+
+class Worker:
+    def __init__(self, reuse=True):
+        self.reuse = reuse
+        self.networks = {}
+
+    def network(self, params):
+        shape = networkShape(params)
+        if shape not in self.networks:
+            QKD_ENT.setFormalism(shape[2])
+            network = QKD_ENT.buildNetwork(Values({**vars(params), "nodeDistance": 10000}))
+            network["configure"] = makeConfigure(network)
+            self.networks[shape] = network
+        return self.networks[shape]
+
+    def run(self, params, writer=None):
+        if params.engine != "des" or not self.reuse:
+            return QKD_ENT.runQKD(params, writer)
+        return QKD_ENT.runQKD(params, writer, self.network(params))
+
+def scalars(result):
+    return {key: value for key, value in result.items() if isinstance(value, (int, float, str, bool, np.generic, type(None)))}
+
+def serve(jobs, results, worker=None):
+    worker = Worker() if worker is None else worker
+    for line in jobs:
+        if not line.strip():
+            continue
+        start = time.perf_counter()
+        result = worker.run(Values({**DEFAULTS, **json.loads(line)}))
+        summary = scalars(result)
+        summary["wallTime"] = time.perf_counter() - start
+        results.write(json.dumps(summary, default=lambda value: value.item()) + "\n")
+        results.flush()
+
+if __name__ == "__main__":
+    serve(sys.stdin, sys.stdout)
@@ -1,116 +1,187 @@
 #! usr/bin/python3
-import os
-import sys
+# SQUANCH engine for the teleportation based BB84 run of QKD_ENT.py.  Takes
+# the same parameters and gives the same outputs so it can be cross-checked
+# against NetSquid and used for high-volume runs.
+#
+# The rounds are simulated in chunks of QStream(3, chunk) systems: q is Alice's
+# state, a and b the Bell pair.  Alice and Bob of a chunk are separate agent
+# processes on the shared stream, b crosses a quantum channel with
+# depolarizing noise, and the classical messages of a chunk (Bell results,
+# Bob's bases, match flags) are sent as one array each.  Several chunks can run
+# at the same time.  Timing follows the stop-and-wait protocol of QKD_ENT.py
+# (QKD_ENT_fast.linkTiming), which also gives the depolarizing strength.
 import numpy as np
+from optparse import OptionParser
 from squanch import *
-from random import randint
+from squanch.errors import QError
+from QKD_ENT_fast import linkTiming, roundDecay
+from QKD_seeding import runStreams
+from QKD_results import ResultWriter, runFilename
+from QKD_simstats import runSummary
+
+def addParserOptions():
+    parser = OptionParser()
+    parser.add_option("-l", "--length",
+                      dest = "length", type = "int", help="Set length of secret key", default = 4)
+    parser.add_option("-n", "--quantumNoise", default = 1e7,
+                      dest = "quantumNoise", type = "int", help = "rate of depolar and dephase errors")
+    parser.add_option("-f", "--sourceFrequency", default = 2e7,
+                      dest = "sourceFrequency", type = "int", help = "rate of entanglement pairs")
+    parser.add_option("-t", "--delay", default = 1e9,
+                      dest = "setDelay", type = "int", help = "based on fraction of source frequency")
+    parser.add_option("-d", "--distance", default = 1,
+                      dest = "nodeDistance", type = "float", help = "Distance between nodes")
+    parser.add_option("-c", "--chunk", default = 4096,
+                      dest = "chunk", type = "int", help = "systems per QStream")
+    parser.add_option("-p", "--parallel", default = 1,
+                      dest = "parallel", type = "int", help = "chunks simulated at the same time (two processes each)")
+    parser.add_option("-s", "--seed", default = None,
+                      dest = "seed", type = "int", help = "base seed, makes the run reproducible")
+    parser.add_option("-r", "--replica", default = 0,
+                      dest = "replica", type = "int", help = "replica index, selects an independent stream of the seed")
+    parser.add_option("-o", "--output", default = None,
+                      dest = "output", help = "result file of the run, .csv or .npz (default: generated name)")
+    return parser.parse_args()
+
+class DepolarizingError(QError):
+    #With the given probability a uniformly random Pauli (I, X, Y or Z), which is
+    #DepolarNoiseModel with factor 1 - probability.  The first qubit of a run
+    #waited longer for its pair and has its own probability.
+    def __init__(self, qchannel, probability, firstProbability, seed):
+        QError.__init__(self, qchannel)
+        self.probability = probability
+        self.firstProbability = firstProbability
+        self.rng = np.random.default_rng(seed)
+
+    def apply(self, qubit):
+        probability = self.probability if self.firstProbability is None else self.firstProbability
+        self.firstProbability = None
+        if qubit is not None and self.rng.random() < probability:
+            pauli = self.rng.integers(4)
+            if pauli:
+                (X, Y, Z)[pauli - 1](qubit)
+        return qubit
 
 class Alice(Agent):
-    
-    def distribute_bell_pair(self, a, b):
-            # Create a Bell pair and send one particle to Bob
+    def random_state(self, q):
+        #Same states as AliceProtocol.randomState in QKD_ENT.py: |0>, |1>, |+>, |->
+        state = self.rng.integers(0, 4)
+        if state == 1 or state == 3:
+            X(q)
+        if state >= 2:
+            H(q)
+        return state
+
+    def run(self):
+        self.rng = np.random.default_rng(self.seed)
+        states = np.empty(self.qstream.num_systems, dtype=np.int64)
+        corrections = np.empty((self.qstream.num_systems, 2), dtype=np.uint8)
+        for i, qsystem in enumerate(self.qstream):
+            q, a, b = qsystem.qubits
+            states[i] = self.random_state(q)
             H(a)
             CNOT(a, b)
-            self.qsend(bob, b)
-
-    def teleport(self, q, a):
-            # Perform the teleportation
             CNOT(q, a)
             H(q)
-            # Tell Bob whether to apply Pauli-X and -Z over classical channel
-            bob_should_apply_x = a.measure() # if Bob should apply X
-            bob_should_apply_z = q.measure() # if Bob should apply Z
-            self.csend(bob, [bob_should_apply_x, bob_should_apply_z])
-            
-    def random_state(self,q):
-            state=randint(0,3)
-            #Random operation
-            if  state == 0: # 0 state
-                pass
-            elif state == 1: # 1 state    #X
-                X(q)
-            elif state == 2: # + state    #H
-                H(q)
-            elif state == 3: # - state    #XH
-                X(q)
-                H(q)
-            else :
-                print("Create random bits ERROR!!")
-            return state
-            
-    def compare_measurement(self,opList):
-        
-        if self.state<2 and opList==0:    #measure in standard basis
-            matchList = 1
-        elif self.state>=2 and opList==1: #measure in Hadamard basis
-            matchList = 1
-        else:
-            matchList = 0
-        return matchList
-    
-    def run(self):
-        self.state = None
-        self.key_Alice = []
-        for qsystem in self.qstream:
-                #self.state=self.random_state(qsystem.qubit(0))
-                print(qsystem.state)
-                q, a, b = qsystem.qubits # q is state to teleport, a and b are Bell pair
-                self.state=self.random_state(q)
-                print(self.state)
-                print(qsystem.state)
-                self.distribute_bell_pair(a, b)
-                self.teleport(q, a)
-                op_bob = self.crecv(bob)
-                match = self.compare_measurement(op_bob)
-                self.csend(bob, match)
-                if match:
-                    self.key_Alice.append(self.state%2) #quantum state 0,+:0    1,-:1    
-                else:
-                    continue
-        print("Alice:",self.key_Alice)
-                    
-        
+            corrections[i] = (a.measure(), q.measure())
+            #Channel errors are applied when Bob takes b out of the channel, in
+            #his process; sending only after Alice is done with the system keeps
+            #the two processes from writing its density matrix at the same time
+            self.qsend(self.peer, b)
+        self.csend(self.peer, corrections)
+        bases = self.crecv(self.peer)
+        match = (states >= 2) == (bases == 1)
+        self.csend(self.peer, match)
+        self.output({"key": (states[match] % 2).astype(np.uint8), "match": match})
+
 class Bob(Agent):
     def random_measure(self, b):
-        measure_for=randint(0,1)
-        if measure_for == 0:
-            meas = b.measure(Z)
-        else:
-            meas = b.measure(X)
-        meas=b.measure()
-        print(meas, measure_for)
-        return meas, measure_for
+        #The X basis is measured as H followed by a Z measurement
+        basis = self.rng.integers(0, 2)
+        if basis == 1:
+            H(b)
+        return b.measure(), basis
 
-            
     def run(self):
-        self.key_bob=[]
-        for _ in self.qstream:
-                # Bob receives a qubit from Alice
-                b = self.qrecv(alice)
-                # Bob receives classical instructions from alice
-                should_apply_x, should_apply_z = self.crecv(alice)
-                if should_apply_x: X(b)
-                if should_apply_z: Z(b)
-                meas_result, state = self.random_measure(b)
-                self.csend(alice, state)
-                match = self.crecv(alice)
-                print(b)
-                if match == 1:
-                    print("Appending")
-                    self.key_bob.append(meas_result)
-                else:
-                    continue
-        print("Bob:",self.key_bob)
-                               
-qstream=QStream(3,10)    
-# Make and connect the agents
-out = Agent.shared_output()
-alice = Alice(qstream, out)
-bob = Bob(qstream, out)
-alice.qconnect(bob) # add a quantum channel
-alice.cconnect(bob) # add a classical channel
-bob.start()
-alice.start()
-alice.join()
-bob.join()
+        self.rng = np.random.default_rng(self.seed)
+        received = [self.qrecv(self.peer) for _ in range(self.qstream.num_systems)]
+        corrections = self.crecv(self.peer)
+        results = np.empty(len(received), dtype=np.uint8)
+        bases = np.empty(len(received), dtype=np.int64)
+        for i, b in enumerate(received):
+            if corrections[i][0]: X(b)
+            if corrections[i][1]: Z(b)
+            results[i], bases[i] = self.random_measure(b)
+        self.csend(self.peer, bases)
+        match = self.crecv(self.peer)
+        self.output({"key": results[match]})
+
+def startChunk(index, size, out, probability, firstProbability, seeds):
+    qstream = QStream(3, size)
+    alice = Alice(qstream, out, name=f"Alice{index}")
+    bob = Bob(qstream, out, name=f"Bob{index}")
+    alice.peer, bob.peer = bob, alice
+    alice.seed, bob.seed = seeds[0], seeds[1]
+    alice.qconnect(bob, errors=[DepolarizingError(None, probability, firstProbability, seeds[2])])
+    alice.cconnect(bob)
+    bob.start()
+    alice.start()
+    return alice, bob
+
+def runSquanch(length, quantumNoise, sourceFrequency, setDelay, nodeDistance, chunk=4096, parallel=1, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    timing = linkTiming(nodeDistance / 10000, sourceFrequency, setDelay)
+    firstDecay, decay = roundDecay(timing, quantumNoise)
+    out = Agent.shared_output()
+    keys_A, keys_B = [], []
+    found = 0
+    rounds = 0
+    index = 0
+    while found < length:
+        #Half of the rounds are sifted, start just enough systems for the rest
+        size = min(chunk, int(2.2 * (length - found)) + 64)
+        batch = min(parallel, -(-int(2.2 * (length - found)) // size))
+        agents = []
+        for _ in range(batch):
+            first = 1 - float(firstDecay) if index == 0 else None
+            agents.append((index, startChunk(index, size, out, 1 - float(decay), first, rng.integers(2**63, size=3))))
+            index += 1
+        for chunkIndex, (alice, bob) in agents:
+            alice.join()
+            bob.join()
+        for chunkIndex, _ in agents:
+            aliceOut, bobOut = out[f"Alice{chunkIndex}"], out[f"Bob{chunkIndex}"]
+            take = min(length - found, aliceOut["key"].size)
+            if take == 0:
+                rounds += size
+                continue
+            keys_A.append(aliceOut["key"][:take])
+            keys_B.append(bobOut["key"][:take])
+            found += take
+            #Rounds up to the last sifted bit that is used
+            rounds += np.flatnonzero(aliceOut["match"])[take - 1] + 1 if found == length else size
+            if found == length:
+                break
+    key_A = np.concatenate(keys_A)
+    key_B = np.concatenate(keys_B)
+    errors = np.count_nonzero(key_A != key_B)
+    simTime = timing["firstArrival"] + (rounds - 1) * timing["roundPeriod"] + 4 * timing["cDelay"]
+    return {"key_A": key_A, "key_B": key_B, "entanglements": int(rounds),
+            "simTime": float(simTime), "latency": float(timing["cDelay"]),
+            "qber": errors / length}
 
+if __name__ == "__main__":
+    [inputArgs, args] = addParserOptions()
+    streams = runStreams(inputArgs.seed, inputArgs.replica)
+    result = runSquanch(inputArgs.length, inputArgs.quantumNoise, inputArgs.sourceFrequency, inputArgs.setDelay,
+                        inputArgs.nodeDistance, inputArgs.chunk, inputArgs.parallel, streams["numpy"])
+    params = {key: getattr(inputArgs, key) for key in ["length", "quantumNoise", "sourceFrequency", "setDelay", "nodeDistance", "seed", "replica"]}
+    params["engine"] = "squanch"
+    writer = ResultWriter(params)
+    writer.set(qber=result["qber"], simTime=result["simTime"], entanglements=result["entanglements"], latency=result["latency"])
+    writer.addBits("key_A", result["key_A"])
+    writer.addBits("key_B", result["key_B"])
+    output = inputArgs.output or runFilename(".", params)
+    writer.flush(output)
+    print(runSummary(result["qber"], result["simTime"], result["entanglements"], None) + f"  Results: {output}")
@@ -1,9 +1 @@
-for ((i=10000; i<=1000000000; i=i*10))
-do 
-	echo "NEXT NOISE LEVEL $i"
-	for ((j=10; j<=1000; j=j*10))
-	do
-	        echo "node distance of $j"
-	        python3 ./QKD_ENT.py -l 1024 -d "$j" -n "$i"
-	done	
-done
+python3 ./QKD_sweep.py -l 1024 -n "10000:1000000000:*10" -d "10:1000:*10" -o NoiseNodeDistance2_1024.csv
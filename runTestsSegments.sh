@@ -0,0 +1 @@
+python3 ./QKD_sweep.py -l 1024 -d 1000 -w 11 -S "1:8:+1" -o Segments1024.csv
@@ -0,0 +1,23 @@
+#! usr/bin/python3
+# Checks of QKD_cascade.py; run with python3 -m pytest
+import numpy as np
+import pytest
+from QKD_cascade import reconcile
+
+@pytest.mark.parametrize("method", ["cascade", "ldpc"])
+def test_empty_key(method):
+    #Reachable when every sifted bit goes to the QBER sample
+    empty = np.zeros(0, dtype=np.uint8)
+    result = reconcile(empty, empty, 0.05, method, np.random.default_rng(1))
+    assert result["key_A"].size == 0 and result["key_B"].size == 0
+    assert result["leakedBits"] == 0 and result["roundTrips"] == 0
+    assert result["residualErrors"] == 0 and result["discardedBits"] == 0
+
+@pytest.mark.parametrize("method", ["cascade", "ldpc"])
+def test_corrects_errors(method):
+    rng = np.random.default_rng(2)
+    keyA = rng.integers(0, 2, 20000, dtype=np.uint8)
+    keyB = keyA ^ (rng.random(keyA.size) < 0.05).astype(np.uint8)
+    result = reconcile(keyA, keyB, 0.05, method, np.random.default_rng(3))
+    assert result["residualErrors"] == 0
+    assert np.array_equal(result["key_A"], result["key_B"])